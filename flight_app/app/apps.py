@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class AppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'app'
+
+    def ready(self):
+        # Connect cache invalidation signals
+        import app.registry  # noqa: F401
+        import app.connections  # noqa: F401
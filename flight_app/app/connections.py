@@ -0,0 +1,400 @@
+"""
+Connecting itineraries, e.g. YMML -> NZNE -> NZRO, searched in memory over a
+time-expanded graph of upcoming schedules rather than with SQL self-joins.
+"""
+
+import bisect
+import hashlib
+import threading
+from itertools import chain
+from typing import NamedTuple, Optional
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta, timezone
+gmt = timezone.utc
+
+from django.core.cache import cache, caches
+from django.utils.connection import ConnectionProxy
+
+import app.models as m
+from app.utils import dynamic_price
+from app.metrics import metrics
+from app.registry import Registry, reference_data, route_graph, route_version
+from app.singleflight import single_flight
+
+
+MIN_CONNECTION_TIME = timedelta(minutes=45)
+
+MAX_CONNECTION_TIME = timedelta(hours=24)
+
+MAX_LEGS = 3
+
+# Legs scanned per search before giving up on further connections
+MAX_SEARCH_WORK = 200_000
+
+CONNECTIONS_CACHE_BUCKET = 60  # seconds; flights depart and prices drift with the clock
+
+data_cache = ConnectionProxy(caches, 'data')
+
+
+class Leg(NamedTuple):
+    id: int
+    flight_no: str
+    dep_dt: datetime
+    arr_dt: datetime
+    aircraft_id: str
+    dep_icao_id: str
+    arr_icao_id: str
+    base_price: float
+    dep_local_date: date
+
+
+LEG_FIELDS = list(Leg._fields)
+
+
+class Network:
+    """
+    Upcoming legs with each airport's departures in time order. Each route's
+    legs and seats are re-read whenever its inventory version moves (see
+    refresh), so schedule changes and bookings don't rebuild the graph. The
+    digest of the routes' versions keys cached search results.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.seats = {}
+        self.departures = defaultdict(list)
+        self.times = defaultdict(list)
+        self.versions = {}
+        self.digest = None
+
+    def read_route(self, origin: str, destination: str, now: datetime) -> list[Leg]:
+        rows = (
+            m.Schedule.objects
+            .filter(dep_icao=origin, arr_icao=destination, dep_dt__gte=now)
+            .order_by('dep_dt')
+            .values_list(*LEG_FIELDS, 'seats_avail')
+        )
+        legs = []
+        for *fields, seats in rows:
+            leg = Leg(*fields)
+            self.seats[leg.id] = seats
+            legs.append(leg)
+        return legs
+
+    def add_route(self, origin: str, destination: str, now: datetime) -> None:
+        self.versions[(origin, destination)] = route_version(origin, destination)
+        self.departures[origin].extend(self.read_route(origin, destination, now))
+
+    def replace_route(self, origin: str, destination: str, now: datetime) -> None:
+        """
+        Swap in the route's legs if any were added, moved or removed, as new lists
+        so that searches in progress keep the departures they started with.
+        """
+        legs = self.read_route(origin, destination, now)
+        departures = [leg for leg in self.departures.get(origin, []) if leg.dep_dt >= now]
+        if legs == [leg for leg in departures if leg.arr_icao_id == destination]:
+            return
+        departures = sorted(
+            [leg for leg in departures if leg.arr_icao_id != destination] + legs, key=lambda leg: leg.dep_dt
+        )
+        self.departures[origin] = departures
+        self.times[origin] = [leg.dep_dt for leg in departures]
+
+    def sort(self) -> None:
+        for airport, legs in self.departures.items():
+            legs.sort(key=lambda leg: leg.dep_dt)
+            self.times[airport] = [leg.dep_dt for leg in legs]
+        self.update_digest()
+
+    def update_digest(self) -> None:
+        self.digest = hashlib.sha1(repr(sorted(self.versions.items())).encode()).hexdigest()
+
+    def refresh(self, now: datetime) -> None:
+        """
+        Re-read the legs and seats of the routes that are new or whose inventory
+        version changed, one indexed query per route, and drop legs that departed
+        days ago. No queries if nothing was scheduled, booked or cancelled.
+        """
+        routes = set(self.versions) | {(o, d) for o, ds in route_graph.data.items() for d in ds}
+        keys = {route: f'route_version:{route[0]}:{route[1]}' for route in routes}
+        current = cache.get_many(keys.values())
+        for route, key in keys.items():
+            if route in self.versions and current.get(key) == self.versions[route]:
+                continue
+            with self._lock:
+                # Read before the legs, so a change in between is seen next time
+                self.versions[route] = route_version(*route)
+                self.replace_route(*route, now)
+                self.update_digest()
+
+        # At most once a day per airport
+        departed = now - timedelta(days=1)
+        for airport, times in list(self.times.items()):
+            if times and times[0] < departed - timedelta(days=1):
+                with self._lock:
+                    legs, times = self.departures[airport], self.times[airport]
+                    i = bisect.bisect_left(times, departed)
+                    for leg in legs[:i]:
+                        self.seats.pop(leg.id, None)
+                    self.departures[airport], self.times[airport] = legs[i:], times[i:]
+
+    def search(
+        self,
+        origin: str,
+        destination: str,
+        local_date: date,
+        tickets: int,
+        now: datetime,
+        max_legs: int
+    ) -> list[tuple[Leg, ...]]:
+        """
+        Pareto-optimal itineraries departing `origin` on its `local_date`: none
+        departs earlier, arrives later and has more legs than another. Paths
+        arriving at an airport are labels of (arrival, legs) and are extended
+        in rounds, one more leg per round, within their connection windows.
+
+        Each airport keeps the windows scanned by labels with up to so many legs,
+        shared by the first legs, which are searched latest first. A label only
+        scans the departures no label with as few legs could take before, as
+        those paths depart no earlier with no more legs, and is dropped if its
+        window is covered. Paths arriving no earlier than a previous round's
+        arrival at `destination` are dropped too. Only direct flights are kept
+        from earlier first legs once MAX_SEARCH_WORK legs have been scanned.
+        """
+        with self._lock:
+            departures, times = dict(self.departures), dict(self.times)
+
+        # Local dates are within a day of UTC dates
+        day = datetime.combine(local_date, time.min, tzinfo=gmt)
+        lo = bisect.bisect_left(times.get(origin, []), max(day - timedelta(days=1), now))
+        hi = bisect.bisect_right(times.get(origin, []), day + timedelta(days=2))
+
+        # Per number of legs so far: each airport's scanned windows, and the
+        # departures in them skipped as they'd revisit an airport of the path
+        windows = [defaultdict(list) for _ in range(max_legs)]
+        looped = [defaultdict(set) for _ in range(max_legs)]
+        candidates = []
+        work, truncated = 0, False
+        for first in reversed(departures.get(origin, [])[lo:hi]):
+            if first.dep_local_date != local_date or first.dep_dt < now or self.seats[first.id] < tickets:
+                continue
+            if first.arr_icao_id == destination:
+                candidates.append((first,))
+                continue
+            if work > MAX_SEARCH_WORK:
+                truncated = True
+                continue
+
+            bound = datetime.max.replace(tzinfo=gmt)
+            marked = [(first,)]
+            for legs in range(1, max_legs):
+                last_round = legs == max_legs - 1
+                reached = []
+                arrivals = []
+                for path in sorted(marked, key=lambda path: path[-1].arr_dt):
+                    airport = path[-1].arr_icao_id
+                    visited = {leg.dep_icao_id for leg in path} | {airport}
+                    arrived = path[-1].arr_dt
+                    departs = times.get(airport, [])
+                    first_dep = bisect.bisect_left(departs, arrived + MIN_CONNECTION_TIME)
+                    last_dep = bisect.bisect_right(departs, arrived + MAX_CONNECTION_TIME)
+                    retry = sorted(i for i in looped[legs][airport] if first_dep <= i < last_dep)
+                    spans = claim_window(windows[legs][airport], first_dep, last_dep)
+                    for more in range(legs + 1, max_legs):
+                        claim_window(windows[more][airport], first_dep, last_dep)
+
+                    for i in chain(retry, *(range(*span) for span in spans)):
+                        leg = departures[airport][i]
+                        work += 1
+                        if leg.arr_icao_id != destination and (last_round or leg.arr_icao_id == origin):
+                            continue
+                        if leg.arr_icao_id in visited:
+                            for more in range(legs, max_legs):
+                                looped[more][airport].add(i)
+                            continue
+                        for more in range(legs, max_legs):
+                            looped[more][airport].discard(i)
+                        if self.seats[leg.id] < tickets or leg.arr_dt >= bound:
+                            continue
+                        if leg.arr_icao_id == destination:
+                            arrivals.append(path + (leg,))
+                        else:
+                            reached.append(path + (leg,))
+                if arrivals:
+                    candidates.extend(arrivals)
+                    bound = min(path[-1].arr_dt for path in arrivals)
+                if not reached:
+                    break
+                marked = reached
+        if truncated:
+            metrics.inc('app_connection_searches_truncated_total')
+
+        def dominates(a, b):
+            return (
+                a[0].dep_dt >= b[0].dep_dt and a[-1].arr_dt <= b[-1].arr_dt and len(a) <= len(b)
+                and (a[0].dep_dt, a[-1].arr_dt, len(a)) != (b[0].dep_dt, b[-1].arr_dt, len(b))
+            )
+
+        pareto = [c for c in candidates if not any(dominates(o, c) for o in candidates)]
+        return sorted(pareto, key=lambda c: (c[0].dep_dt, c[-1].arr_dt, len(c)))
+
+
+def claim_window(windows: list[tuple[int, int]], lo: int, hi: int) -> list[tuple[int, int]]:
+    """
+    The parts of the index range [lo, hi) not yet in `windows`, a sorted list of
+    disjoint [start, end) ranges, which is updated to cover them.
+    """
+    if lo >= hi:
+        return []
+    spans = []
+    kept = []
+    cursor, merged_lo, merged_hi = lo, lo, hi
+    for start, end in windows:
+        if end < lo or start > hi:
+            kept.append((start, end))
+            continue
+        if cursor < start:
+            spans.append((cursor, start))
+        cursor = max(cursor, end)
+        merged_lo, merged_hi = min(merged_lo, start), max(merged_hi, end)
+    if cursor < hi:
+        spans.append((cursor, hi))
+    windows[:] = sorted(kept + [(merged_lo, merged_hi)])
+    return spans
+
+
+class ConnectionGraph(Registry):
+    """
+    The Network of schedules departing from load time on, kept up to date route
+    by route (see Network.refresh) rather than rebuilt.
+    """
+    version_key = 'registry:connections'
+
+    def load(self) -> Network:
+        # One index search per route rather than a scan of the whole table
+        now = datetime.now(gmt)
+        network = Network()
+        for origin in reference_data.airports():
+            for destination in route_graph.destinations(origin):
+                network.add_route(origin, destination, now)
+        network.sort()
+        return network
+
+
+connection_graph = ConnectionGraph()
+
+
+class Itinerary:
+    """
+    Legs (Schedule instances priced like ScheduleQuerySet.with_price) flown in turn.
+    """
+    def __init__(self, legs: list[m.Schedule]):
+        self.legs = legs
+
+    @property
+    def dep_dt_local(self):
+        return self.legs[0].dep_dt_local
+
+    @property
+    def arr_dt_local(self):
+        return self.legs[-1].arr_dt_local
+
+    @property
+    def duration(self):
+        return self.legs[-1].arr_dt - self.legs[0].dep_dt
+
+    @property
+    def stops(self) -> int:
+        return len(self.legs) - 1
+
+    @property
+    def price(self) -> float:
+        return round(sum(leg.price for leg in self.legs), 2)
+
+    @property
+    def seats_avail(self) -> int:
+        return min(leg.seats_avail for leg in self.legs)
+
+    @property
+    def stages(self) -> list[tuple[m.Schedule, Optional[m.Airport], Optional[timedelta]]]:
+        """
+        Each leg with the airport and layover before the next, or None after the last.
+        """
+        return [
+            (a, b and a.arr_icao, b and b.dep_dt - a.arr_dt)
+            for a, b in zip(self.legs, self.legs[1:] + [None])
+        ]
+
+    def as_dict(self) -> dict:
+        return {
+            'depart': self.dep_dt_local.isoformat(),
+            'arrive': self.arr_dt_local.isoformat(),
+            'duration_minutes': int(self.duration.total_seconds() // 60),
+            'stops': self.stops,
+            'price': self.price,
+            'seats_avail': self.seats_avail,
+            'legs': [
+                {
+                    'id': leg.id,
+                    'flight_no': leg.flight_no,
+                    'origin': leg.dep_icao_id,
+                    'destination': leg.arr_icao_id,
+                    'depart': leg.dep_dt_local.isoformat(),
+                    'arrive': leg.arr_dt_local.isoformat(),
+                    'price': leg.price,
+                }
+                for leg in self.legs
+            ],
+        }
+
+
+def search_connections(
+    origin: str,
+    destination: str,
+    local_date: date,
+    tickets: int = 1,
+    now: Optional[datetime] = None,
+    max_legs: int = MAX_LEGS
+) -> list[Itinerary]:
+    """
+    Itineraries from `origin` on its `local_date` to `destination` with at least
+    `tickets` seats on every leg, at least MIN_CONNECTION_TIME and at most
+    MAX_CONNECTION_TIME between legs, and up to `max_legs` legs. Includes direct
+    flights. The search is cached under the network's digest of route versions,
+    as of the start of the time bucket of `now`, and coalesced across workers.
+    """
+    now = now or datetime.now(gmt)
+    network = connection_graph.data
+    network.refresh(now)
+
+    bucket = int(now.timestamp()) // CONNECTIONS_CACHE_BUCKET
+    searched_at = datetime.fromtimestamp(bucket * CONNECTIONS_CACHE_BUCKET, gmt)
+    key = (
+        f'connections:{origin}:{destination}:{local_date.isoformat()}:{tickets}:{max_legs}:'
+        f'{network.digest}:{bucket}'
+    )
+
+    def compute():
+        paths = network.search(origin, destination, local_date, tickets, searched_at, max_legs)
+        data_cache.set(key, paths, timeout=2 * CONNECTIONS_CACHE_BUCKET)
+        return paths
+
+    if (paths := data_cache.get(key)) is not None:
+        metrics.inc('app_cache_requests_total', cache='connections', result='hit')
+    else:
+        metrics.inc('app_cache_requests_total', cache='connections', result='miss')
+        paths = single_flight(key, compute, lambda: data_cache.get(key))
+
+    itineraries = []
+    # Any itinerary dominated by one that has departed since has departed too
+    for path in paths:
+        if path[0].dep_dt < now:
+            continue
+        legs = []
+        for leg in path:
+            s = m.Schedule(**leg._asdict(), seats_avail=network.seats[leg.id])
+            reference_data.attach(s)
+            s.price = dynamic_price(s.base_price, s.dep_dt, s.seats_avail, s.aircraft.max_seats, now)
+            legs.append(s)
+        itineraries.append(Itinerary(legs))
+    return itineraries
+
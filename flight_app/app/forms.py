@@ -1,4 +1,9 @@
+from typing import Optional
+
 from django import forms
+from django.core import signing
+
+from app.views_utils import read_quote
 
 
 class FlightSearchForm(forms.Form):
@@ -43,30 +48,41 @@ class FlightSearchForm(forms.Form):
         self.fields['destination'].choices = destination_choices
 
 
+class QuoteField(forms.CharField):
+    """
+    A signed fare quote from views_utils.issue_quote, cleaned to the quote dict.
+    """
+    def to_python(self, value):
+        value = super().to_python(value)
+        if not value:
+            return None
+        try:
+            return read_quote(value)
+        except signing.SignatureExpired:
+            raise forms.ValidationError('This fare has expired, please select again.', code='expired')
+        except signing.BadSignature:
+            raise forms.ValidationError('Invalid flight selection.', code='invalid')
+
+
 class FlightBookForm(forms.Form):
-    select_depart = forms.ChoiceField(
+    search = forms.CharField(widget=forms.HiddenInput())
+    select_depart = QuoteField(
         label="Select departure",
         label_suffix='',
         widget=forms.RadioSelect,
-        choices=[],
     )
-    select_return = forms.ChoiceField(
+    select_return = QuoteField(
         label="Select return",
         label_suffix='',
         widget=forms.RadioSelect,
         required=False,
-        choices=[],
     )
 
     def __init__(self, *args, **kwargs):
-        depart_choices = kwargs.pop('depart_choices', [])
-        return_choices = kwargs.pop('return_choices', [])
+        return_trip = kwargs.pop('return_trip', False)
         super().__init__(*args, **kwargs)
 
-        self.fields['select_depart'].choices = depart_choices
-        if return_choices:
-            self.fields['select_return'].choices = return_choices
-            self.fields['select_return'].required = True
+        self.fields['select_return'].required = return_trip
 
 
 class CustomerDetailsForm(forms.Form):
@@ -127,6 +143,24 @@ class EmailForm(forms.Form):
 class ConfirmForm(forms.Form):
     pass
 
+
+class QuotesForm(forms.Form):
+    """
+    The fare quote tokens of a booking and the search they were selected from, as
+    hidden fields of the register and confirm forms. The quotes are verified by
+    views_utils.verify_quotes, which re-prices expired quotes.
+    """
+    depart_quote = forms.CharField(widget=forms.HiddenInput(), required=False)
+    return_quote = forms.CharField(widget=forms.HiddenInput(), required=False)
+    search = forms.CharField(widget=forms.HiddenInput(), required=False)
+
+    def tokens(self) -> dict:
+        data = self.cleaned_data if self.is_valid() else {}
+        return {'depart': data.get('depart_quote') or None, 'return': data.get('return_quote') or None}
+
+    def search_token(self) -> Optional[str]:
+        return (self.cleaned_data if self.is_valid() else {}).get('search') or None
+
 class CancelForm(forms.Form):
     ref = forms.CharField(widget=forms.HiddenInput())
 
@@ -0,0 +1,154 @@
+"""
+Counters and histograms in Prometheus text format, e.g. request latency, bookings
+and cache hit rates.
+
+Each process keeps its own values in memory and, when settings.METRICS_DIR is set,
+a background thread, started with the first value, writes them to <pid>.json there
+every FLUSH_INTERVAL seconds, so requests never wait on the file. A scrape sums
+the files of every process, so METRICS_DIR should be emptied when the server starts.
+"""
+
+import os
+import json
+import time
+import atexit
+import threading
+from pathlib import Path
+from collections import defaultdict
+
+from django.conf import settings
+
+
+FLUSH_INTERVAL = 1.0  # seconds
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Name, type, help
+METRICS = [
+    ('app_request_duration_seconds', 'histogram', 'View latency by URL name.'),
+    ('app_bookings_created_total', 'counter', 'Bookings created by book_flight.'),
+    ('app_bookings_cancelled_total', 'counter', 'Bookings cancelled by delete_booking.'),
+    ('app_sold_out_total', 'counter', 'Bookings rejected for lack of seats.'),
+    ('app_session_writes_total', 'counter', 'Session rows written.'),
+    ('app_session_write_bytes_total', 'counter', 'Encoded session data written.'),
+    ('app_cache_requests_total', 'counter', 'Cache lookups by cache and result (hit or miss).'),
+    ('app_coalesced_requests_total', 'counter', 'Computations shared with a concurrent caller, by scope.'),
+]
+
+
+class Metrics:
+    """
+    Series are (name, labels) with labels a sorted tuple of (key, value) pairs.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._values = defaultdict(float)
+        self._pid = os.getpid()
+        self._flusher = None
+
+    def _add(self, items):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked; the parent's values and flush thread are its own
+                self._values.clear()
+                self._pid = os.getpid()
+                self._flusher = None
+            for series, amount in items:
+                self._values[series] += amount
+            if self._flusher is None and self._directory() is not None:
+                self._flusher = threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True)
+                self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except OSError:
+                pass  # Retried next interval
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        self._add([((name, tuple(sorted(labels.items()))), amount)])
+
+    def observe(self, name: str, value: float, buckets=LATENCY_BUCKETS, **labels) -> None:
+        """
+        Add `value` to a histogram: every bucket it falls in, _sum and _count.
+        """
+        labels = tuple(sorted(labels.items()))
+        bounds = [str(le) for le in buckets if value <= le] + ['+Inf']
+        self._add(
+            [((f'{name}_bucket', tuple(sorted(labels + (('le', le),)))), 1) for le in bounds] + [
+                ((f'{name}_count', labels), 1),
+                ((f'{name}_sum', labels), value),
+            ]
+        )
+
+    def _directory(self):
+        directory = getattr(settings, 'METRICS_DIR', None)
+        return Path(directory) if directory else None
+
+    def flush(self) -> None:
+        if (directory := self._directory()) is None:
+            return
+        with self._lock:
+            rows = [[name, list(labels), value] for (name, labels), value in self._values.items()]
+
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f'{os.getpid()}.json'
+        tmp = path.with_suffix('.tmp')
+        with self._flush_lock:
+            tmp.write_text(json.dumps(rows))
+            os.replace(tmp, path)
+
+    def collect(self) -> dict:
+        """
+        Values summed over every process writing to METRICS_DIR, or this process's
+        own if unset.
+        """
+        if (directory := self._directory()) is None:
+            with self._lock:
+                return dict(self._values)
+
+        self.flush()
+        values = defaultdict(float)
+        for path in directory.glob('*.json'):
+            try:
+                rows = json.loads(path.read_text())
+            except (OSError, ValueError):
+                continue  # Replaced mid-read
+            for name, labels, value in rows:
+                values[(name, tuple(map(tuple, labels)))] += value
+        return values
+
+    def value(self, name: str, **labels) -> float:
+        return self.collect().get((name, tuple(sorted(labels.items()))), 0)
+
+    def render(self) -> str:
+        values = self.collect()
+
+        def order(series):
+            name, labels = series
+            le = dict(labels).get('le')
+            return (name, [kv for kv in labels if kv[0] != 'le'], float(le) if le else 0)
+
+        lines = []
+        for metric, kind, help_text in METRICS:
+            lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} {kind}']
+            names = {metric} if kind != 'histogram' else {f'{metric}_{s}' for s in ('bucket', 'sum', 'count')}
+            for series in sorted((s for s in values if s[0] in names), key=order):
+                name, labels = series
+                value = values[series]
+                value = int(value) if value.is_integer() else value
+                if labels:
+                    name += '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
+                lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+metrics = Metrics()
+atexit.register(metrics.flush)
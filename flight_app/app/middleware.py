@@ -0,0 +1,289 @@
+import io
+import os
+import time
+import random
+import pstats
+import cProfile
+import logging
+import threading
+from pathlib import Path
+from contextvars import ContextVar
+from contextlib import ExitStack
+from asgiref.sync import async_to_sync, iscoroutinefunction, markcoroutinefunction
+from datetime import datetime, timezone
+gmt = timezone.utc
+
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.template.backends.django import DjangoTemplates
+
+from app.metrics import metrics
+
+logger = logging.getLogger('app.perf')
+
+_timings = ContextVar('perf_timings', default=None)
+
+
+class Timings:
+    """
+    Measurements for one request. Used as the execute wrapper for every database.
+    """
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.statements = set()
+        self.repeats = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_time += time.perf_counter() - start
+            self.queries += 1
+            # The same statement with different parameters is the mark of an N+1
+            if sql in self.statements:
+                self.repeats += 1
+            else:
+                self.statements.add(sql)
+
+
+class TimedTemplate:
+    """
+    Backend template adding its render time to the PerfMiddleware timings of the
+    current request, if any.
+    """
+    def __init__(self, template):
+        self._template = template
+
+    def __getattr__(self, name):
+        return getattr(self._template, name)
+
+    def render(self, context=None, request=None):
+        timings = _timings.get()
+        if timings is None:
+            return self._template.render(context, request)
+        start = time.perf_counter()
+        try:
+            return self._template.render(context, request)
+        finally:
+            timings.template_time += time.perf_counter() - start
+
+
+class PerfTemplates(DjangoTemplates):
+    """
+    Django template backend timing top-level renders for PerfMiddleware; includes
+    are rendered inside these.
+    """
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
+
+
+class PerfMiddleware:
+    """
+    Opt-in (settings.PERF_INSTRUMENTATION) per-request timing of the view, the SQL
+    it issues and template rendering (with the PerfTemplates backend). Reported in a Server-Timing header and a
+    logfmt line on the app.perf logger tagged with the URL name.
+    """
+    def __init__(self, get_response):
+        if not getattr(settings, 'PERF_INSTRUMENTATION', False):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timings = Timings()
+        token = _timings.set(timings)
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(timings))
+                start = time.perf_counter()
+                response = self.get_response(request)
+                total = time.perf_counter() - start
+        finally:
+            _timings.reset(token)
+
+        match = request.resolver_match
+        url_name = match.url_name if match and match.url_name else '-'
+        view_ms, sql_ms, template_ms = (round(t * 1000, 2) for t in (total, timings.sql_time, timings.template_time))
+
+        response['Server-Timing'] = (
+            f'view;dur={view_ms}, '
+            f'sql;dur={sql_ms};desc="{timings.queries} queries", '
+            f'tpl;dur={template_ms}'
+        )
+        logger.info(
+            f'url={url_name} method={request.method} status={response.status_code} view_ms={view_ms} '
+            f'queries={timings.queries} repeated={timings.repeats} sql_ms={sql_ms} template_ms={template_ms}',
+            extra={
+                'url_name': url_name,
+                'view_ms': view_ms,
+                'queries': timings.queries,
+                'repeated_queries': timings.repeats,
+                'sql_ms': sql_ms,
+                'template_ms': template_ms,
+            }
+        )
+        return response
+
+
+class MetricsMiddleware:
+    """
+    Observe view latency by URL name in app.metrics. Async-capable, so that under
+    ASGI it doesn't push async views onto a thread.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        start = time.perf_counter()
+        response = self.get_response(request)
+        self.observe(request, start)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        self.observe(request, start)
+        return response
+
+    def observe(self, request, start):
+        match = request.resolver_match
+        view = match.url_name if match and match.url_name else 'unmatched'
+        metrics.observe('app_request_duration_seconds', time.perf_counter() - start, view=view)
+
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_SALT = 'app.middleware.profile'
+
+
+def profile_token() -> str:
+    """
+    Signed value for the X-Profile header, valid for settings.PROFILE_TOKEN_MAX_AGE seconds.
+    """
+    return signing.TimestampSigner(salt=PROFILE_SALT).sign('profile')
+
+
+class SQLLog:
+    """
+    Execute wrapper recording each statement with its duration and, if `params`,
+    its parameters. They hold customer details, so are left out by default.
+    """
+    def __init__(self, params=False):
+        self.params = params
+        self.statements = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.statements.append((time.perf_counter() - start, sql, params if self.params else None))
+
+
+class ProfilerMiddleware:
+    """
+    Opt-in (settings.PROFILING) cProfile of individual views, for a sampled fraction
+    (settings.PROFILE_SAMPLE_RATE) of requests or those carrying a valid X-Profile
+    header from profile_token(). A call-tree report and the SQL executed (with
+    parameters only if settings.PROFILE_SQL_PARAMS) are written to
+    settings.PROFILE_DIR, keeping the newest settings.PROFILE_KEEP.
+
+    Must come last in MIDDLEWARE since it calls the view from process_view. Async
+    views are run with async_to_sync, so only the parts run in this thread (e.g.
+    the ORM) appear in the call tree.
+    """
+    # One profile at a time; cProfile can't nest and requests don't wait for it
+    lock = threading.Lock()
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILING', False):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'PROFILE_SAMPLE_RATE', 0)
+        self.directory = Path(settings.PROFILE_DIR)
+        self.keep = getattr(settings, 'PROFILE_KEEP', 50)
+        self.sql_params = getattr(settings, 'PROFILE_SQL_PARAMS', False)
+        self.max_age = getattr(settings, 'PROFILE_TOKEN_MAX_AGE', 3600)
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def wanted(self, request) -> bool:
+        if token := request.headers.get(PROFILE_HEADER):
+            try:
+                signing.TimestampSigner(salt=PROFILE_SALT).unsign(token, max_age=self.max_age)
+                return True
+            except signing.BadSignature:
+                pass
+        return random.random() < self.sample_rate
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not self.wanted(request) or not self.lock.acquire(blocking=False):
+            return None
+
+        if iscoroutinefunction(view_func):
+            view_func = async_to_sync(view_func)
+
+        try:
+            profiler = cProfile.Profile()
+            sql = SQLLog(params=self.sql_params)
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(sql))
+                start = time.perf_counter()
+                profiler.enable()
+                try:
+                    response = view_func(request, *view_args, **view_kwargs)
+                    if hasattr(response, 'render') and callable(response.render):
+                        response = response.render()
+                finally:
+                    profiler.disable()
+                    elapsed = time.perf_counter() - start
+            self.write(request, profiler, sql, elapsed, response.status_code)
+        finally:
+            self.lock.release()
+        return response
+
+    def write(self, request, profiler, sql, elapsed, status):
+        url_name = request.resolver_match.url_name or 'view'
+        stamp = datetime.now(gmt).strftime('%Y%m%dT%H%M%S%f')
+        name = f'{stamp}-{url_name}-{os.getpid()}'
+
+        out = io.StringIO()
+        out.write(f'{request.method} {request.get_full_path()} -> {status} in {elapsed * 1000:.2f} ms\n\n')
+        stats = pstats.Stats(profiler, stream=out)
+        stats.sort_stats('cumulative').print_stats(40)
+        stats.print_callees(20)
+
+        total = sum(t for t, _, _ in sql.statements)
+        out.write(f'SQL: {len(sql.statements)} statements in {total * 1000:.2f} ms\n\n')
+        for t, statement, params in sql.statements:
+            out.write(f'{t * 1000:8.2f} ms  {statement}\n')
+            if params is not None:
+                out.write(f'            {params!r}\n')
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(self.directory / f'{name}.prof')
+        (self.directory / f'{name}.txt').write_text(out.getvalue())
+        logger.info(f'profile={name} url={url_name} view_ms={elapsed * 1000:.2f}')
+        self.rotate()
+
+    def rotate(self):
+        reports = sorted(self.directory.glob('*.txt'))
+        for report in reports[:-self.keep] if self.keep else reports:
+            report.unlink(missing_ok=True)
+            report.with_suffix('.prof').unlink(missing_ok=True)
@@ -0,0 +1,25 @@
+# Generated by Django 5.1.8 on 2026-10-18 13:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['customer', '-created_at'], name='booking_customer_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='schedule',
+            index=models.Index(fields=['dep_icao', 'arr_icao', 'dep_dt'], name='schedule_route_dep_dt_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='schedule',
+            index=models.Index(condition=models.Q(('seats_avail__gte', 1)), fields=['dep_icao', 'arr_icao', 'dep_dt'], name='schedule_route_avail_idx'),
+        ),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 5.1.8 on 2026-10-18 13:07
+
+from datetime import timedelta, timezone
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+# Copied rather than imported from app.utils, so this migration doesn't change with them
+
+def convert_gmt_offset(offset):
+    pm = 1 if offset[0] == '+' else -1
+    h_str, m_str = offset[1:].split(':')
+    return timezone(timedelta(hours=pm * int(h_str), minutes=pm * int(m_str)))
+
+
+def summarise_availability(rows, gmt_offsets):
+    local_tzs = {icao: convert_gmt_offset(offset) for icao, offset in gmt_offsets.items()}
+    summary = {}
+    for dep_icao, arr_icao, dep_dt, seats_avail, base_price in rows:
+        key = (dep_icao, arr_icao, dep_dt.astimezone(local_tzs[dep_icao]).date())
+        flights, min_fare = summary.get(key, (0, None))
+        if seats_avail >= 1:
+            flights += 1
+            min_fare = base_price if min_fare is None else min(min_fare, base_price)
+        summary[key] = (flights, min_fare)
+    return summary
+
+
+def populate_availability(apps, schema_editor):
+    Airport = apps.get_model('app', 'Airport')
+    Schedule = apps.get_model('app', 'Schedule')
+    RouteAvailability = apps.get_model('app', 'RouteAvailability')
+
+    offsets = dict(Airport.objects.values_list('icao', 'gmt_offset'))
+    rows = Schedule.objects.values_list('dep_icao', 'arr_icao', 'dep_dt', 'seats_avail', 'base_price')
+    summary = summarise_availability(rows.iterator(), offsets)
+    RouteAvailability.objects.bulk_create(
+        [
+            RouteAvailability(
+                dep_icao_id=dep_icao,
+                arr_icao_id=arr_icao,
+                local_date=local_date,
+                flights=flights,
+                min_fare=min_fare
+            )
+            for (dep_icao, arr_icao, local_date), (flights, min_fare) in summary.items()
+        ],
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_route_time_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RouteAvailability',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('local_date', models.DateField()),
+                ('flights', models.IntegerField()),
+                ('min_fare', models.FloatField(null=True)),
+                ('arr_icao', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='app.airport')),
+                ('dep_icao', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='app.airport')),
+            ],
+            options={
+                'db_table': 'RouteAvailability',
+                'constraints': [models.UniqueConstraint(fields=('dep_icao', 'arr_icao', 'local_date'), name='route_availability_unique')],
+            },
+        ),
+        migrations.RunPython(populate_availability, migrations.RunPython.noop),
+    ]
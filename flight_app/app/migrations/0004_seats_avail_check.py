@@ -0,0 +1,17 @@
+# Generated by Django 5.1.8 on 2026-10-18 13:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0003_route_availability'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='schedule',
+            constraint=models.CheckConstraint(condition=models.Q(('seats_avail__gte', 0)), name='schedule_seats_avail_gte_0'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.8 on 2026-10-18 13:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_counter'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='booking',
+            name='booking_customer_created_idx',
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['customer', '-created_at', '-ref'], name='booking_customer_keyset_idx'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.1.8 on 2026-10-18 13:41
+
+from datetime import timedelta, timezone
+
+from django.db import migrations, models
+from django.db.models.functions import TruncDate
+
+
+# Copied rather than imported from app.utils, so this migration doesn't change with it
+def convert_gmt_offset(offset):
+    pm = 1 if offset[0] == '+' else -1
+    h_str, m_str = offset[1:].split(':')
+    return timezone(timedelta(hours=pm * int(h_str), minutes=pm * int(m_str)))
+
+
+def populate_local_dates(apps, schema_editor):
+    Airport = apps.get_model('app', 'Airport')
+    Schedule = apps.get_model('app', 'Schedule')
+
+    for icao, offset in Airport.objects.values_list('icao', 'gmt_offset'):
+        Schedule.objects.filter(dep_icao=icao).update(
+            dep_local_date=TruncDate('dep_dt', tzinfo=convert_gmt_offset(offset))
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_booking_keyset_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='schedule',
+            name='dep_local_date',
+            field=models.DateField(null=True),
+        ),
+        migrations.RunPython(populate_local_dates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='schedule',
+            name='dep_local_date',
+            field=models.DateField(),
+        ),
+        migrations.AddIndex(
+            model_name='schedule',
+            index=models.Index(fields=['dep_icao', 'arr_icao', 'dep_local_date'], name='schedule_route_local_date_idx'),
+        ),
+    ]
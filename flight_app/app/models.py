@@ -1,6 +1,9 @@
 from django.db import models
-from app.utils import gmt_to_local
-from datetime import datetime, timezone
+from django.db.models import Case, F, FloatField, Q, Value, When
+from django.db.models.functions import Cast, Floor, Least, TruncDate
+from django.utils.functional import cached_property
+from app.utils import convert_gmt_offset, dynamic_price
+from datetime import datetime, timedelta, timezone
 gmt = timezone.utc
 from django.utils.timezone import now
 
@@ -20,10 +23,62 @@ class Airport(models.Model):
     region = models.CharField(max_length=50)
     gmt_offset = models.CharField(max_length=6, default='+12:00')  # [+/-]HH:MM
 
+    @property
+    def tzinfo(self) -> timezone:
+        """
+        The timezone for gmt_offset, shared by all airports with that offset.
+        """
+        return convert_gmt_offset(self.gmt_offset)
+
+    def refresh_local_dates(self) -> int:
+        """
+        Recompute Schedule.dep_local_date for departures from here, e.g. after
+        gmt_offset changes. Returns the number of schedules whose date moved.
+        """
+        local_date = TruncDate('dep_dt', tzinfo=self.tzinfo)
+        return (
+            Schedule.objects
+            .filter(dep_icao=self)
+            .exclude(dep_local_date=local_date)
+            .update(dep_local_date=local_date)
+        )
+
     class Meta:
         db_table = 'Airport'
 
 
+class ScheduleQuerySet(models.QuerySet):
+    def with_price(self, now: datetime = None):
+        """
+        Annotate `price` with the same rules as Schedule.current_price, evaluated
+        in the database relative to `now`. The whole days until departure are
+        expressed as comparisons against `now`, so no date arithmetic is needed
+        in SQL.
+        """
+        now = now or datetime.now(gmt)
+
+        days = Case(
+            *[
+                When(dep_dt__lt=now + timedelta(days=n + 1), then=Value(28 - n))
+                for n in range(4, 28)
+            ],
+            default=Value(0),
+        )
+        max_seats = Cast('aircraft__max_seats', FloatField())
+        seat_ratio = (max_seats - F('seats_avail')) / max_seats
+        pct = Least(0.015 * days + 0.5 * seat_ratio, Value(0.4), output_field=FloatField())
+        # Rounded as in dynamic_price
+        price = Floor(F('base_price') * (1 + pct) * 100 + 0.5, output_field=FloatField()) / 100
+
+        return self.annotate(
+            price=Case(
+                When(dep_dt__lt=now + timedelta(days=4), then=F('base_price')),
+                default=price,
+                output_field=FloatField(),
+            )
+        )
+
+
 class Schedule(models.Model):
     flight_no = models.CharField(max_length=6)
     dep_dt = models.DateTimeField()
@@ -45,6 +100,15 @@ class Schedule(models.Model):
         on_delete=models.CASCADE
     )
     base_price = models.FloatField()
+    # Denormalised from dep_dt and the origin's gmt_offset by save() (set it
+    # directly for bulk_create) and Airport.refresh_local_dates
+    dep_local_date = models.DateField()
+
+    objects = ScheduleQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        self.dep_local_date = self.dep_dt.astimezone(self.dep_icao.tzinfo).date()
+        super().save(*args, **kwargs)
 
     @property
     def duration(self):
@@ -58,33 +122,95 @@ class Schedule(models.Model):
          - +1.5% for each day within 28 days
          - base price 3 days before departure
          - cap of +40% over base price
+        See ScheduleQuerySet.with_price for the equivalent annotation.
         """
-        n_days = (self.dep_dt - datetime.now(gmt)).days
+        return dynamic_price(
+            self.base_price,
+            self.dep_dt,
+            self.seats_avail,
+            self.aircraft.max_seats,
+            datetime.now(gmt)
+        )
 
-        if n_days <= 3:
-            return self.base_price
-
-        days = max(0, 28 - n_days)
-        max_seats = self.aircraft.max_seats 
-        seat_ratio = (max_seats - self.seats_avail) / max_seats
-        pct = min(0.015 * days + 0.5 * seat_ratio, 0.4)
-        mult = 1 + pct
-        return round(self.base_price * mult, 2)
-
-    @property
+    # Computed once per instance; templates read them several times per card
+    @cached_property
     def dep_dt_local(self):
-        return gmt_to_local(self.dep_dt, self.dep_icao.gmt_offset)
+        return self.dep_dt.astimezone(self.dep_icao.tzinfo)
 
-    @property
+    @cached_property
     def arr_dt_local(self):
-        return gmt_to_local(self.arr_dt, self.arr_icao.gmt_offset)
+        return self.arr_dt.astimezone(self.arr_icao.tzinfo)
 
     @property
     def next_day_tag(self):
         return '(next day)' if self.arr_dt_local.date() > self.dep_dt_local.date() else ''
 
+    @property
+    def details_key(self) -> str:
+        """
+        Changes with any field shown by partials/schedule_details.html, for template
+        fragment caching. Airports and aircraft are versioned by the registry.
+        """
+        return f'{self.id}:{self.flight_no}:{self.dep_dt.timestamp()}:{self.arr_dt.timestamp()}:{self.aircraft_id}'
+
     class Meta:
         db_table = 'Schedule'
+        indexes = [
+            # Searches: route + departure window
+            models.Index(fields=['dep_icao', 'arr_icao', 'dep_dt'], name='schedule_route_dep_dt_idx'),
+            # Flights on a local day: route + local departure date
+            models.Index(fields=['dep_icao', 'arr_icao', 'dep_local_date'], name='schedule_route_local_date_idx'),
+            # Calendar: route + departure, only flights with seats
+            models.Index(
+                fields=['dep_icao', 'arr_icao', 'dep_dt'],
+                condition=Q(seats_avail__gte=1),
+                name='schedule_route_avail_idx',
+            ),
+        ]
+        constraints = [
+            models.CheckConstraint(condition=Q(seats_avail__gte=0), name='schedule_seats_avail_gte_0'),
+        ]
+
+
+class RouteAvailability(models.Model):
+    """
+    Flights with seats and the lowest base fare among them for a route on a
+    local (origin timezone) departure date. Maintained from Schedule by
+    views_utils.refresh_availability and views_utils.rebuild_availability.
+    """
+    dep_icao = models.ForeignKey(
+        Airport,
+        related_name='+',
+        on_delete=models.CASCADE
+    )
+    arr_icao = models.ForeignKey(
+        Airport,
+        related_name='+',
+        on_delete=models.CASCADE
+    )
+    local_date = models.DateField()
+    flights = models.IntegerField()
+    min_fare = models.FloatField(null=True)
+
+    class Meta:
+        db_table = 'RouteAvailability'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['dep_icao', 'arr_icao', 'local_date'],
+                name='route_availability_unique'
+            ),
+        ]
+
+
+class Counter(models.Model):
+    """
+    Named monotonic counters, e.g. for allocating booking reference blocks.
+    """
+    name = models.CharField(max_length=50, primary_key=True)
+    value = models.BigIntegerField(default=0)
+
+    class Meta:
+        db_table = 'Counter'
 
 
 class Customer(models.Model):
@@ -124,4 +250,8 @@ class Booking(models.Model):
     class Meta:
         ordering = ['-created_at']
         db_table = 'Booking'
+        indexes = [
+            # Bookings page: keyset pagination newest first
+            models.Index(fields=['customer', '-created_at', '-ref'], name='booking_customer_keyset_idx'),
+        ]
 
@@ -0,0 +1,209 @@
+"""
+In-process registries for small, rarely changing data, e.g. airports, aircraft
+and the route network.
+"""
+
+import time
+import threading
+from typing import Optional
+from datetime import datetime, timezone
+gmt = timezone.utc
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+import app.models as m
+from app.metrics import metrics
+
+
+VERSION_CHECK_INTERVAL = 1.0  # seconds; longest another worker's invalidate() goes unseen
+
+
+class Registry:
+    """
+    Data loaded once per process and reloaded when the version stamp in the
+    shared cache changes. invalidate() replaces the stamp so that every worker
+    reloads on its next access. The stamp is re-read at most every
+    VERSION_CHECK_INTERVAL, so that lookups don't each cost a cache round trip.
+    """
+    version_key = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._data = None
+        self._checked = (None, float('-inf'))  # (stamp, time.monotonic() read)
+
+    def load(self):
+        raise NotImplementedError
+
+    def version(self) -> int:
+        stamp, checked = self._checked
+        if time.monotonic() - checked < VERSION_CHECK_INTERVAL:
+            return stamp
+        stamp = cache.get_or_set(self.version_key, time.time_ns, timeout=None)
+        self._checked = (stamp, time.monotonic())
+        return stamp
+
+    async def aversion(self) -> int:
+        stamp, checked = self._checked
+        if time.monotonic() - checked < VERSION_CHECK_INTERVAL:
+            return stamp
+        stamp = await cache.aget_or_set(self.version_key, time.time_ns, timeout=None)
+        self._checked = (stamp, time.monotonic())
+        return stamp
+
+    def invalidate(self) -> None:
+        stamp = time.time_ns()
+        cache.set(self.version_key, stamp, timeout=None)
+        self._checked = (stamp, time.monotonic())
+
+    @property
+    def data(self):
+        version = self.version()
+        if version != self._version:
+            with self._lock:
+                if version != self._version:
+                    self._data = self.load()
+                    self._version = version
+                    metrics.inc('app_cache_requests_total', cache=self.version_key, result='miss')
+                    return self._data
+        metrics.inc('app_cache_requests_total', cache=self.version_key, result='hit')
+        return self._data
+
+    async def adata(self):
+        """
+        data for async views. A reload, which is rare, runs in a worker thread.
+        """
+        version = await self.aversion()
+        if version != self._version:
+            return await sync_to_async(lambda: self.data)()
+        metrics.inc('app_cache_requests_total', cache=self.version_key, result='hit')
+        return self._data
+
+
+class ReferenceData(Registry):
+    """
+    Airport and Aircraft rows keyed by primary key.
+    """
+    version_key = 'registry:reference_data'
+
+    def load(self) -> dict:
+        return {
+            'airports': {a.icao: a for a in m.Airport.objects.all()},
+            'aircraft': {a.name: a for a in m.Aircraft.objects.all()},
+        }
+
+    def airports(self) -> dict[str, m.Airport]:
+        return self.data['airports']
+
+    async def aairports(self) -> dict[str, m.Airport]:
+        return (await self.adata())['airports']
+
+    def airport(self, icao: str) -> Optional[m.Airport]:
+        return self.data['airports'].get(icao)
+
+    def aircraft(self, name: str) -> Optional[m.Aircraft]:
+        return self.data['aircraft'].get(name)
+
+    def attach(self, *schedules: Optional[m.Schedule]) -> None:
+        """
+        Set the related airports and aircraft of schedules from the registry so
+        templates don't lazily query them per row.
+        """
+        data = self.data
+        for s in schedules:
+            if s is None:
+                continue
+            if airport := data['airports'].get(s.dep_icao_id):
+                s.dep_icao = airport
+            if airport := data['airports'].get(s.arr_icao_id):
+                s.arr_icao = airport
+            if aircraft := data['aircraft'].get(s.aircraft_id):
+                s.aircraft = aircraft
+
+
+class RouteGraph(Registry):
+    """
+    Origin ICAO -> set of destination ICAOs with at least one Schedule row.
+    """
+    version_key = 'registry:route_graph'
+
+    def load(self) -> dict[str, set[str]]:
+        # One index search per origin rather than a scan of the whole table
+        graph = {}
+        for origin in reference_data.airports():
+            destinations = set(
+                m.Schedule.objects
+                .filter(dep_icao=origin)
+                .values_list('arr_icao', flat=True)
+                .distinct()
+            )
+            if destinations:
+                graph[origin] = destinations
+        return graph
+
+    def destinations(self, origin: str) -> list[str]:
+        return sorted(self.data.get(origin, ()))
+
+    async def adestinations(self, origin: str) -> list[str]:
+        return sorted((await self.adata()).get(origin, ()))
+
+    def last_modified(self, version: Optional[int] = None) -> datetime:
+        return datetime.fromtimestamp((version or self.version()) / 1e9, gmt)
+
+
+reference_data = ReferenceData()
+route_graph = RouteGraph()
+
+
+def route_version(origin: str, destination: str) -> int:
+    """
+    Inventory version of a route, for keys of cached search results. Bumped
+    whenever seats or schedules on the route change. Kept in the shared cache
+    (see settings.CACHES) and, unlike registry stamps, read on every use, so a
+    booking in any worker invalidates every worker's results at once.
+    """
+    return cache.get_or_set(f'route_version:{origin}:{destination}', time.time_ns, timeout=None)
+
+
+async def aroute_version(origin: str, destination: str) -> int:
+    return await cache.aget_or_set(f'route_version:{origin}:{destination}', time.time_ns, timeout=None)
+
+
+def bump_route_version(*routes: tuple[str, str]) -> None:
+    cache.set_many({f'route_version:{o}:{d}': time.time_ns() for o, d in routes}, timeout=None)
+
+
+@receiver([post_save, post_delete], sender=m.Airport)
+@receiver([post_save, post_delete], sender=m.Aircraft)
+def invalidate_reference_data(sender, **kwargs):
+    # Again on commit, in case another worker reloaded before the change was visible
+    reference_data.invalidate()
+    transaction.on_commit(reference_data.invalidate)
+
+
+@receiver(post_save, sender=m.Airport)
+def refresh_local_dates(sender, instance, created, **kwargs):
+    # A new gmt_offset moves departures to other local dates
+    if not created and instance.refresh_local_dates():
+        from app.views_utils import rebuild_availability  # Imports this module
+        rebuild_availability()
+
+
+@receiver([post_save, post_delete], sender=m.Schedule)
+def invalidate_route_graph(sender, created=True, **kwargs):
+    # Seat changes don't add or remove routes
+    if created:
+        route_graph.invalidate()
+        transaction.on_commit(route_graph.invalidate)
+
+
+@receiver([post_save, post_delete], sender=m.Schedule)
+def invalidate_route_version(sender, instance, **kwargs):
+    route = (instance.dep_icao_id, instance.arr_icao_id)
+    bump_route_version(route)
+    transaction.on_commit(lambda: bump_route_version(route))
@@ -0,0 +1,15 @@
+"""
+Database sessions counting the writes and bytes stored. Used as SESSION_ENGINE.
+"""
+
+from django.contrib.sessions.backends import db
+
+from app.metrics import metrics
+
+
+class SessionStore(db.SessionStore):
+    def create_model_instance(self, data):
+        obj = super().create_model_instance(data)
+        metrics.inc('app_session_writes_total')
+        metrics.inc('app_session_write_bytes_total', len(obj.session_data))
+        return obj
@@ -0,0 +1,165 @@
+"""
+Coalesce identical concurrent computations, e.g. a popular search, so that one
+caller runs the query set and the rest share its result.
+"""
+
+import time
+import random
+import asyncio
+import threading
+
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+
+from app.metrics import metrics
+
+
+LOCK_TIMEOUT = 10  # seconds; longest a computation is trusted to hold the lock
+
+POLL_INTERVAL = 0.05  # seconds
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    In-process: callers with the key of a call in flight wait for its result.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key: str, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Call()
+
+        if not leader:
+            metrics.inc('app_coalesced_requests_total', scope='process')
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+flights = SingleFlight()
+
+
+class AsyncSingleFlight:
+    """
+    In-process for coroutines: callers with the key of a call in flight on the
+    same event loop await its result.
+    """
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key: str, fn):
+        loop = asyncio.get_running_loop()
+        if (future := self._calls.get((loop, key))) is not None:
+            metrics.inc('app_coalesced_requests_total', scope='process')
+            return await asyncio.shield(future)
+
+        future = self._calls[(loop, key)] = loop.create_future()
+        try:
+            result = await fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # Retrieved, in case nobody was waiting
+            raise
+        finally:
+            del self._calls[(loop, key)]
+
+
+async_flights = AsyncSingleFlight()
+
+
+def shared(using: str) -> bool:
+    """
+    Whether other processes can read what is stored in cache `using`, and so wait
+    for another process to fill it.
+    """
+    return not isinstance(caches[using], LocMemCache)
+
+
+def single_flight(key: str, compute, cached=lambda: None, using='data'):
+    """
+    Return cached() if not None, else compute() run by one caller per key. Callers
+    in this process share the leader's result. If compute() stores its result in
+    a cache `using` shared across processes, the leader holds a lock in the
+    default cache and the others poll cached() until it's filled, computing it
+    themselves only if the lock outlives LOCK_TIMEOUT.
+
+    compute() is expected to store its result where cached() finds it.
+    """
+    def lead():
+        if (value := cached()) is not None:
+            return value
+        if not shared(using):
+            return compute()
+
+        lock = f'lock:{key}'
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        while not cache.add(lock, 1, LOCK_TIMEOUT):
+            # Jittered so that waiting processes don't poll in step
+            time.sleep(POLL_INTERVAL * random.uniform(0.5, 1.5))
+            if (value := cached()) is not None:
+                metrics.inc('app_coalesced_requests_total', scope='cache')
+                return value
+            if time.monotonic() >= deadline:
+                return compute()
+
+        try:
+            return compute()
+        finally:
+            cache.delete(lock)
+
+    return flights.do(key, lead)
+
+
+async def asingle_flight(key: str, compute, cached, using='data'):
+    """
+    single_flight for coroutines: `compute` and `cached` are coroutine functions,
+    the lock uses the async cache API and waiting doesn't block the event loop.
+    """
+    async def lead():
+        if (value := await cached()) is not None:
+            return value
+        if not shared(using):
+            return await compute()
+
+        lock = f'lock:{key}'
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        while not await cache.aadd(lock, 1, LOCK_TIMEOUT):
+            await asyncio.sleep(POLL_INTERVAL * random.uniform(0.5, 1.5))
+            if (value := await cached()) is not None:
+                metrics.inc('app_coalesced_requests_total', scope='cache')
+                return value
+            if time.monotonic() >= deadline:
+                return await compute()
+
+        try:
+            return await compute()
+        finally:
+            await cache.adelete(lock)
+
+    return await async_flights.do(key, lead)
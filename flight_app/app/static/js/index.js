@@ -248,7 +248,8 @@ async function swapOrigDest() {
 function getDateMarkerer(fpCal) {
   return (dateObj, dateStr, flatpickr, dayElem) => {
     // Called by Flatpickr onDayCreate callback,
-    // compares current date to marked set and adds mark
+    // compares current date to marked set and adds mark,
+    // then the day's lowest fare if known
     const dateStr1 = flatpickr.formatDate(dayElem.dateObj, "Y-m-d");
     if (fpCal.markedDates.has(dateStr1)) {
       const createMark = () => {
@@ -258,28 +259,54 @@ function getDateMarkerer(fpCal) {
       }
       dayElem.appendChild(createMark());
     }
+
+    const fare = fpCal.fares.get(dateStr1);
+    if (fare) {
+      const label = document.createElement('span');
+      label.classList.add('date-fare');
+      if (!fare.available) label.classList.add('sold-out');
+      label.textContent = `$${Math.round(fare.price)}`;
+      dayElem.title = `From $${fare.price.toFixed(2)}${fare.available ? '' : ' (sold out)'}`;
+      dayElem.appendChild(label);
+    }
   };
 }
 
 function setUpDateMarking(fpCal) {
   fpCal.markedDates = new Set();
+  fpCal.fares = new Map();
   fpCal.config.onDayCreate.push(getDateMarkerer(fpCal));
 }
 
+async function fetchFares(orig, dest) {
+  // Lowest fare per day for the next quarter, keyed by date
+  const resp = await fetch(`/fare_calendar/?o=${orig}&d=${dest}&days=90`);
+  const { days } = await resp.json();
+  return new Map((days || []).map(day => [day.date, day]));
+}
+
 async function markFlightDates() {
   // Fetch depart and return flight dates, filter out dates before today,
   // and append to respective calendar's marked set and redraw
 
   if (noFlights || !departCal || !returnCal) return;
 
-  const resp1 = await fetch(`/flight_dates/?o=${origSelect.value}&d=${destSelect.value}`);
-  const { dates: departDates } = await resp1.json();
+  const flightDates = async (orig, dest) => {
+    const resp = await fetch(`/flight_dates/?o=${orig}&d=${dest}`);
+    return (await resp.json()).dates;
+  };
 
-  const resp2 = await fetch(`/flight_dates/?o=${destSelect.value}&d=${origSelect.value}`);
-  const { dates: returnDates} = await resp2.json();
+  const [departDates, returnDates, departFares, returnFares] = await Promise.all([
+    flightDates(origSelect.value, destSelect.value),
+    flightDates(destSelect.value, origSelect.value),
+    fetchFares(origSelect.value, destSelect.value),
+    fetchFares(destSelect.value, origSelect.value),
+  ]);
 
   departCal.markedDates.clear();
   returnCal.markedDates.clear();
+  departCal.fares = departFares;
+  returnCal.fares = returnFares;
 
   const futureDates = dates => dates >= TODAY;
   const removePrev = dates => dates.filter(futureDates);
@@ -7,9 +7,20 @@ from django.utils.safestring import mark_safe
 from datetime import datetime, date, timezone
 gmt = timezone.utc
 
+from app.registry import reference_data
+
 register = template.Library()
 
 
+@register.filter
+def fragment_key(schedule):
+    """
+    Key of a schedule's cached fragments: its details and the reference data version,
+    read here rather than from the context so that it holds without a request.
+    """
+    return f'{schedule.details_key}:{reference_data.version()}'
+
+
 @register.filter
 def format_duration(duration):
     if not duration:
@@ -1,3 +1,1516 @@
-from django.test import TestCase
+import os
+import re
+import asyncio
+import json
+import time
+import random
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+from unittest import mock
+from datetime import date, datetime, timedelta, timezone
+gmt = timezone.utc
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core import signing
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.cache.utils import make_template_fragment_key
+from django.template.loader import render_to_string
+from django.db import IntegrityError, connection, connections
+from django.http import QueryDict
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils.html import escape
+
+import app.models as m
+from app.metrics import FLUSH_INTERVAL, Metrics, metrics
+from app.connections import (
+    MAX_CONNECTION_TIME, MAX_LEGS, MIN_CONNECTION_TIME, Leg, Network, connection_graph, search_connections
+)
+from app.middleware import profile_token
+from app.singleflight import asingle_flight, single_flight
+from app.templatetags.filters import fragment_key
+from app.registry import VERSION_CHECK_INTERVAL, ReferenceData, reference_data, route_graph
+from app.utils import REF_CHARS, dynamic_price, gmt_to_local, permute_ref
+from app.views_utils import (
+    BOOKING_COOKIE, BOOKINGS_PAGE_SIZE, FLIGHTS_CACHE_BUCKET, QUOTE_SALT, QUOTE_TTL, SEARCH_TTL, SoldOut,
+    aavailable_dates, book_flight, booking_refs, bookings_cursor, cheapest_pairs, delete_booking, flights_by_day,
+    issue_quote, load_search, quotes_query, read_quote, rebuild_availability, save_search
+)
+
+
+def create_reference_data():
+    m.Aircraft.objects.create(name='SF50', brand='Cirrus', max_seats=4)
+    m.Airport.objects.create(icao='NZNE', name='North Shore', region='Auckland North Shore', gmt_offset='+12:00')
+    m.Airport.objects.create(icao='NZRO', name='Rotorua', region='Rotorua', gmt_offset='+12:00')
+
+
+def create_schedules(days=14):
+    """
+    Two flights a day in each direction between NZNE and NZRO, starting tomorrow.
+    """
+    start = datetime.now(gmt).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    schedules = []
+    for d in range(days):
+        for i, (orig, dest) in enumerate([('NZNE', 'NZRO'), ('NZRO', 'NZNE')] * 2):
+            dep_dt = start + timedelta(days=d, hours=2 + 6 * i)
+            schedules.append(m.Schedule.objects.create(
+                flight_no=f'BA{i + 1:03d}',
+                dep_dt=dep_dt,
+                arr_dt=dep_dt + timedelta(minutes=45),
+                seats_avail=4,
+                aircraft_id='SF50',
+                dep_icao_id=orig,
+                arr_icao_id=dest,
+                base_price=80,
+            ))
+    return schedules
+
+
+def data_queries(captured):
+    """
+    SQL of the captured queries other than the database cache's and the
+    savepoints around its writes.
+    """
+    return [
+        q['sql'] for q in captured.captured_queries
+        if '"cache"' not in q['sql'] and 'SAVEPOINT' not in q['sql']
+    ]
+
+
+def clear_caches():
+    for c in caches.all():
+        c.clear()
+
+
+class ResetRegistries:
+    """
+    Invalidate the process-global registries and clear the in-memory caches after
+    each test, since rolling back the test transaction doesn't.
+    """
+    def tearDown(self):
+        super().tearDown()
+        caches['data'].clear()
+        caches['fragments'].clear()
+        for registry in (reference_data, route_graph, connection_graph):
+            registry.invalidate()
+
+
+class RegistryTestCase(ResetRegistries, TestCase):
+    pass
+
+
+class RegistryTransactionTestCase(ResetRegistries, TransactionTestCase):
+    pass
+
+
+class QueryPlanTests(RegistryTestCase):
+    """
+    Run EXPLAIN QUERY PLAN on every statement issued by the views and fail if
+    Schedule, Booking or RouteAvailability is read with a full table scan.
+    """
+    SCAN = re.compile(r'\bSCAN (Schedule|Booking|RouteAvailability)\b')
+    ROUTE_SEARCH = re.compile(r'\bSEARCH Schedule USING (COVERING )?INDEX schedule_route_\w+')
+
+    @classmethod
+    def setUpTestData(cls):
+        create_reference_data()
+        cls.schedules = create_schedules()
+        cls.customer = m.Customer.objects.create(
+            title='mr', fname='Ojas', lname='Naik', sex='m', email='ojas.naik@proton.com'
+        )
+        cls.ref = book_flight(1, cls.customer, cls.schedules[0], 80, cls.schedules[5], 80)
+
+    def setUp(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('EXPLAIN QUERY PLAN is SQLite specific')
+        session = self.client.session
+        session['customer_id'] = self.customer.id
+        session.save()
+
+    @contextmanager
+    def assertNoTableScans(self, route_search=False):
+        """
+        If `route_search`, statements filtering Schedule by route must also use
+        one of the route indexes.
+        """
+        statements = []
+
+        def record(execute, sql, params, many, context):
+            if not many and sql.lstrip().upper().startswith('SELECT'):
+                statements.append((sql, params))
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(record):
+            yield
+
+        self.assertTrue(statements)
+        with connection.cursor() as cursor:
+            for sql, params in statements:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                plan = '\n'.join(row[-1] for row in cursor.fetchall())
+                self.assertIsNone(self.SCAN.search(plan), f'{sql}\n{plan}')
+                if route_search and 'FROM "Schedule"' in sql and '"Schedule"."arr_icao_id" =' in sql:
+                    self.assertIsNotNone(self.ROUTE_SEARCH.search(plan), f'{sql}\n{plan}')
+
+    def search_params(self, return_trip=True):
+        depart = self.schedules[0].dep_dt.date() + timedelta(days=3)
+        params = {
+            'origin': 'NZNE',
+            'destination': 'NZRO',
+            'depart_date': depart.strftime('%Y-%m-%d'),
+            'travellers': 2,
+        }
+        if return_trip:
+            params['return_date'] = (depart + timedelta(days=2)).strftime('%Y-%m-%d')
+        return params
+
+    def test_index(self):
+        with self.assertNoTableScans():
+            self.client.get(reverse('index'))
+
+    def test_destinations(self):
+        route_graph.invalidate()
+        with self.assertNoTableScans():
+            self.client.get(reverse('destinations'), {'o': 'NZNE'})
+
+    def test_flight_dates(self):
+        with self.assertNoTableScans(route_search=True):
+            self.client.get(reverse('flight_dates'), {'o': 'NZNE', 'd': 'NZRO'})
+
+    def test_fare_calendar(self):
+        with self.assertNoTableScans(route_search=True):
+            self.client.get(reverse('fare_calendar'), {'o': 'NZNE', 'd': 'NZRO'})
+
+    def test_flights_search(self):
+        for return_trip in (False, True):
+            with self.assertNoTableScans(route_search=True):
+                self.client.get(reverse('flights'), self.search_params(return_trip))
+
+    def selection(self):
+        response = self.client.get(reverse('flights'), self.search_params(return_trip=False))
+        [flight] = [s for s in response.context['results']['depart'] if s.id == self.schedules[12].id]
+        return {'search': response.context['form'].initial['search'], 'select_depart': flight.quote}
+
+    def test_flights_select(self):
+        selection = self.selection()
+        with self.assertNoTableScans():
+            self.client.post(reverse('flights'), selection)
+
+    def test_confirm(self):
+        query = self.client.post(reverse('flights'), self.selection()).url.split('?')[1]
+        with self.assertNoTableScans():
+            self.client.get(f"{reverse('confirm')}?{query}")
+            self.client.post(reverse('confirm'), QueryDict(query))
+
+    def test_bookings(self):
+        with self.assertNoTableScans():
+            self.client.get(reverse('bookings'))
+            self.client.get(reverse('bookings'), {'after': bookings_cursor(m.Booking.objects.get(ref=self.ref))})
+
+    def test_cancel(self):
+        with self.assertNoTableScans():
+            self.client.post(reverse('bookings'), {'ref': self.ref})
+
+    def test_invoice(self):
+        with self.assertNoTableScans():
+            self.client.get(reverse('invoice'), {'ref': self.ref})
+
+
+class ReferenceDataTests(RegistryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_reference_data()
+        cls.schedules = create_schedules(days=7)
+
+    def test_search_without_reference_queries(self):
+        reference_data.data  # warm up
+        depart = self.schedules[0].dep_dt.date() + timedelta(days=1)
+        params = {
+            'origin': 'NZNE',
+            'destination': 'NZRO',
+            'depart_date': depart.strftime('%Y-%m-%d'),
+            'return_date': (depart + timedelta(days=1)).strftime('%Y-%m-%d'),
+            'travellers': 1,
+        }
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('flights'), params)
+            self.client.get(reverse('flight_dates'), {'o': 'NZNE', 'd': 'NZRO'})
+
+        self.assertContains(response, 'Rotorua (NZRO)')
+        for q in queries.captured_queries:
+            self.assertNotRegex(q['sql'], r'FROM "(Airport|Aircraft)"')
+
+    def test_invalidation_reaches_other_workers(self):
+        # Another worker's registry, sharing only the cache with this one
+        self.assertNotIsInstance(cache, LocMemCache)
+        other = ReferenceData()
+        self.assertEqual(other.airport('NZRO').region, 'Rotorua')
+
+        m.Airport.objects.filter(icao='NZRO').update(region='Rotorua Lakes')
+        reference_data.invalidate()
+        self.assertEqual(other.airport('NZRO').region, 'Rotorua')  # Until its next check
+        later = time.monotonic() + VERSION_CHECK_INTERVAL
+        with mock.patch('app.registry.time.monotonic', return_value=later):
+            self.assertEqual(other.airport('NZRO').region, 'Rotorua Lakes')
+
+    def test_shared_tzinfo(self):
+        self.assertIs(reference_data.airport('NZNE').tzinfo, reference_data.airport('NZRO').tzinfo)
+        self.assertEqual(reference_data.airport('NZNE').tzinfo.utcoffset(None), timedelta(hours=12))
+
+        schedule = m.Schedule.objects.get(pk=self.schedules[0].pk)
+        reference_data.attach(schedule)
+        with mock.patch.object(m.Airport, 'tzinfo', new_callable=mock.PropertyMock) as tzinfo:
+            tzinfo.return_value = gmt
+            schedule.next_day_tag
+            schedule.dep_dt_local, schedule.arr_dt_local
+        self.assertEqual(tzinfo.call_count, 2)
+
+    def test_invalidated_on_save(self):
+        self.assertEqual(reference_data.airport('NZRO').region, 'Rotorua')
+        airport = m.Airport.objects.get(icao='NZRO')
+        airport.region = 'Bay of Plenty'
+        airport.save()
+        self.assertEqual(reference_data.airport('NZRO').region, 'Bay of Plenty')
+        airport.delete()
+        self.assertIsNone(reference_data.airport('NZRO'))
+
+
+class RouteGraphTests(RegistryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_reference_data()
+        cls.schedules = create_schedules(days=1)
+
+    def test_destinations_without_schedule_queries(self):
+        self.client.get(reverse('destinations'), {'o': 'NZNE'})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('destinations'), {'o': 'NZNE'})
+        self.assertEqual(response.json(), {'destinations': ['NZRO']})
+        self.assertEqual(data_queries(queries), [])
+
+        response = self.client.get(reverse('destinations'), {'o': 'NZCI'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_conditional_get(self):
+        response = self.client.get(reverse('destinations'), {'o': 'NZNE'})
+        etag = response['ETag']
+        self.assertIn('Last-Modified', response)
+
+        response = self.client.get(reverse('destinations'), {'o': 'NZNE'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        m.Airport.objects.create(icao='NZGB', name='Claris', region='Great Barrier Island')
+        s = self.schedules[0]
+        s.seats_avail -= 1
+        s.save()
+        response = self.client.get(reverse('destinations'), {'o': 'NZNE'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        m.Schedule.objects.create(
+            flight_no='BA009', dep_dt=s.dep_dt, arr_dt=s.arr_dt, seats_avail=4,
+            aircraft_id='SF50', dep_icao_id='NZNE', arr_icao_id='NZGB', base_price=130
+        )
+        response = self.client.get(reverse('destinations'), {'o': 'NZNE'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'destinations': ['NZGB', 'NZRO']})
+
+
+class AvailabilityTests(RegistryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_reference_data()
+        cls.schedules = create_schedules(days=3)
+        cls.customer = m.Customer.objects.create(
+            title='ms', fname='Ella', lname='Lee', sex='f', email='ella.lee@blobmail.com'
+        )
+        rebuild_availability()
+
+    def flight_dates(self):
+        response = self.client.get(reverse('flight_dates'), {'o': 'NZNE', 'd': 'NZRO'})
+        return response.json()['dates']
+
+    def test_matches_schedule(self):
+        expected = sorted({
+            gmt_to_local(s.dep_dt, '+12:00').date().isoformat()
+            for s in self.schedules if s.dep_icao_id == 'NZNE'
+        })
+        self.assertEqual(self.flight_dates(), expected)
+
+    def test_book_and_cancel(self):
+        # The only NZNE -> NZRO flight on the first local day
+        first = self.schedules[0]
+        day = self.flight_dates()[0]
+
+        ref = book_flight(4, self.customer, first, 80)
+        self.assertNotIn(day, self.flight_dates())
+        row = m.RouteAvailability.objects.get(dep_icao='NZNE', arr_icao='NZRO', local_date=day)
+        self.assertEqual((row.flights, row.min_fare), (0, None))
+
+        delete_booking(m.Booking.objects.get(ref=ref))
+        self.assertIn(day, self.flight_dates())
+        row.refresh_from_db()
+        self.assertEqual((row.flights, row.min_fare), (1, 80))
+
+    def test_departed_today(self):
+        # The only NZNE -> NZRO flight on the first local day
+        first = self.schedules[0]
+        day = gmt_to_local(first.dep_dt, '+12:00').date()
+        local = timezone(timedelta(hours=12))
+
+        available_dates = async_to_sync(aavailable_dates)
+
+        before = available_dates('NZNE', 'NZRO', (first.dep_dt - timedelta(minutes=1)).astimezone(local))
+        self.assertEqual(before[0], day)
+        after = available_dates('NZNE', 'NZRO', (first.dep_dt + timedelta(minutes=1)).astimezone(local))
+        self.assertNotIn(day, after)
+        self.assertEqual(after, before[1:])
+
+    def test_local_dates(self):
+        for s in m.Schedule.objects.all():
+            self.assertEqual(s.dep_local_date, gmt_to_local(s.dep_dt, '+12:00').date())
+
+    def test_airport_offset_change(self):
+        airport = m.Airport.objects.get(icao='NZNE')
+        airport.gmt_offset = '-10:00'
+        airport.save()
+        reference_data.invalidate()
+
+        for s in m.Schedule.objects.filter(dep_icao='NZNE'):
+            self.assertEqual(s.dep_local_date, gmt_to_local(s.dep_dt, '-10:00').date())
+        expected = sorted({
+            gmt_to_local(s.dep_dt, '-10:00').date()
+            for s in self.schedules if s.dep_icao_id == 'NZNE'
+        })
+        self.assertEqual(
+            list(
+                m.RouteAvailability.objects.filter(dep_icao='NZNE').order_by('local_date')
+                .values_list('local_date', flat=True)
+            ),
+            expected
+        )
+
+
+class SeatInventoryTests(RegistryTransactionTestCase):
+    THREADS = 16
+    BOOKINGS_PER_THREAD = 8
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest('In-memory SQLite does not wait on locks between connections')
+        create_reference_data()
+        self.schedule = create_schedules(days=1)[0]
+        self.customer = m.Customer.objects.create(
+            title='mr', fname='Ojas', lname='Naik', sex='m', email='ojas.naik@proton.com'
+        )
+        rebuild_availability()
+
+    def test_no_oversell_under_concurrent_confirms(self):
+        results = {'booked': 0, 'sold_out': 0, 'errors': []}
+        lock = threading.Lock()
+        barrier = threading.Barrier(self.THREADS)
+
+        def confirm():
+            barrier.wait()
+            try:
+                for _ in range(self.BOOKINGS_PER_THREAD):
+                    try:
+                        book_flight(1, self.customer.id, self.schedule.id, 80)
+                        outcome = 'booked'
+                    except SoldOut:
+                        outcome = 'sold_out'
+                    with lock:
+                        results[outcome] += 1
+            except Exception as e:
+                with lock:
+                    results['errors'].append(e)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=confirm) for _ in range(self.THREADS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(results['errors'], [])
+        self.schedule.refresh_from_db()
+        self.assertEqual(results['booked'], 4)
+        self.assertEqual(results['sold_out'], self.THREADS * self.BOOKINGS_PER_THREAD - 4)
+        self.assertEqual(self.schedule.seats_avail, 0)
+        self.assertEqual(m.Booking.objects.filter(depart_schedule=self.schedule).count(), 4)
+
+    def test_cancel_releases_seats(self):
+        ref = book_flight(4, self.customer, self.schedule, 80)
+        with self.assertRaises(SoldOut):
+            book_flight(1, self.customer, self.schedule, 80)
+
+        delete_booking(m.Booking.objects.get(ref=ref))
+        self.schedule.refresh_from_db()
+        self.assertEqual(self.schedule.seats_avail, 4)
+
+    def test_seats_avail_check_constraint(self):
+        with self.assertRaises(IntegrityError):
+            m.Schedule.objects.filter(id=self.schedule.id).update(seats_avail=-1)
+
+
+class BookingRefTests(RegistryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_reference_data()
+        cls.schedules = create_schedules(days=1)
+        cls.customer = m.Customer.objects.create(
+            title='mr', fname='Ojas', lname='Naik', sex='m', email='ojas.naik@proton.com'
+        )
+
+    def test_permutation_is_unique_and_well_formed(self):
+        refs = [permute_ref(n, b'key') for n in range(50_000)]
+        self.assertEqual(len(set(refs)), len(refs))
+        self.assertTrue(all(len(r) == 6 and set(r) <= set(REF_CHARS) for r in refs))
+        self.assertNotEqual(refs[:3], sorted(refs[:3]))
+        self.assertEqual(permute_ref(36 ** 6 - 1, b'key'), permute_ref(36 ** 6 - 1, b'key'))
+        with self.assertRaises(ValueError):
+            permute_ref(36 ** 6, b'key')
+
+    def test_book_flight_without_ref_lookups(self):
+        with CaptureQueriesContext(connection) as queries:
+            for _ in range(3):
+                book_flight(1, self.customer, self.schedules[0], 80)
+        for q in queries.captured_queries:
+            self.assertNotRegex(q['sql'], r'^SELECT .* FROM "Booking"')
+
+    def test_collision_is_retried(self):
+        booking_refs.next_ref()  # reserve a block
+        taken = permute_ref(booking_refs._next, booking_refs.key)
+        m.Booking.objects.create(
+            ref=taken, tickets=1, customer=self.customer,
+            depart_schedule=self.schedules[1], depart_price=80
+        )
+        ref = book_flight(1, self.customer, self.schedules[0], 80)
+        self.assertNotEqual(ref, taken)
+        self.assertEqual(m.Booking.objects.get(ref=taken).depart_schedule, self.schedules[1])
+
+
+class BenchmarkTests(RegistryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_reference_data()
+        create_schedules(days=21)
+        cls.customer = m.Customer.objects.create(
+            title='mr', fname='Ojas', lname='Naik', sex='m', email='ojas.naik@proton.com'
+        )
+        book_flight(1, cls.customer, m.Schedule.objects.first(), 80)
+
+    def test_replay_and_summarise(self):
+        import bench
+        random.seed(0)
+        route_graph.invalidate()
+        with mock.patch.object(bench.dbprime, 'SCHEDULE_DAYS', 21):
+            summary = bench.summarise(bench.run(sessions=40, warmup=0))
+
+        for key in ['GET index', 'GET destinations', 'GET flight_dates', 'GET flights', 'GET bookings']:
+            self.assertIn(key, summary)
+        flights = summary['GET flights']
+        self.assertLessEqual(flights['p50_ms'], flights['p95_ms'])
+        self.assertLessEqual(flights['p95_ms'], flights['p99_ms'])
+        self.assertGreater(flights['queries_per_request'], 0)
+        self.assertGreater(summary['GET flight_dates']['rows_per_request'], 0)
+
+
+class PerfMiddlewareTests(RegistryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_reference_data()
+        create_schedules(days=7)
+
+    def search(self):
+        depart_date = (datetime.now(gmt) + timedelta(days=2)).date().isoformat()
+        return self.client.get(
+            reverse('flights'),
+            {'origin': 'NZNE', 'destination': 'NZRO', 'depart_date': depart_date, 'travellers': 1}
+        )
+
+    @override_settings(PERF_INSTRUMENTATION=True)
+    def test_server_timing_and_log(self):
+        with self.assertLogs('app.perf', level='INFO') as logs:
+            response = self.search()
+        self.assertRegex(
+            response['Server-Timing'],
+            r'^view;dur=[\d.]+, sql;dur=[\d.]+;desc="[1-9]\d* queries", tpl;dur=[\d.]+$'
+        )
+        self.assertEqual(len(logs.records), 1)
+        self.assertRegex(logs.output[0], r'url=flights method=GET status=200 .*queries=[1-9]')
+        self.assertGreater(logs.records[0].template_ms, 0)
+
+    def test_disabled_by_default(self):
+        self.assertNotIn('Server-Timing', self.search())
+
+
+class ProfilerMiddlewareTests(RegistryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_reference_data()
+        create_schedules(days=1)
+
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def profiles(self):
+        return sorted(p.name for p in self.directory.glob('*.txt'))
+
+    def test_signed_header(self):
+        with self.settings(PROFILING=True, PROFILE_SAMPLE_RATE=0, PROFILE_DIR=self.directory), \
+                self.assertLogs('app.perf'):
+            self.client.get(reverse('flight_dates'), {'o': 'NZNE', 'd': 'NZRO'})
+            self.client.get(reverse('flight_dates'), {'o': 'NZNE', 'd': 'NZRO'}, HTTP_X_PROFILE='profile:forged')
+            self.assertEqual(self.profiles(), [])
+
+            clear_caches()  # Profile the query rather than a cache hit
+            response = self.client.get(
+                reverse('flight_dates'), {'o': 'NZNE', 'd': 'NZRO'}, HTTP_X_PROFILE=profile_token()
+            )
+        self.assertEqual(response.status_code, 200)
+        [name] = self.profiles()
+        self.assertIn('-flight_dates-', name)
+        self.assertTrue((self.directory / name).with_suffix('.prof').exists())
+        report = (self.directory / name).read_text()
+        self.assertIn('GET /flight_dates/', report)
+        self.assertIn('function calls', report)
+        self.assertRegex(report, r'SQL: [1-9]\d* statements')
+        self.assertIn('FROM "RouteAvailability"', report)
+
+    def test_sql_params_redacted(self):
+        for sql_params in (False, True):
+            with self.settings(
+                PROFILING=True, PROFILE_SAMPLE_RATE=1, PROFILE_DIR=self.directory, PROFILE_SQL_PARAMS=sql_params
+            ), self.assertLogs('app.perf'):
+                clear_caches()
+                Client().get(reverse('flight_dates'), {'o': 'NZNE', 'd': 'NZRO'})  # Loads the settings
+            report = (self.directory / self.profiles()[-1]).read_text()
+            self.assertIn('FROM "RouteAvailability"', report)
+            self.assertEqual("'NZNE'" in report, sql_params)
+
+    def test_sampled_and_rotated(self):
+        with self.settings(PROFILING=True, PROFILE_SAMPLE_RATE=1, PROFILE_DIR=self.directory, PROFILE_KEEP=2), \
+                self.assertLogs('app.perf'):
+            for _ in range(3):
+                self.client.get(reverse('destinations'), {'o': 'NZNE'})
+        self.assertEqual(len(self.profiles()), 2)
+        self.assertEqual(len(list(self.directory.glob('*.prof'))), 2)
+
+
+class MetricsTests(RegistryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_reference_data()
+        cls.schedules = create_schedules(days=1)
+        cls.customer = m.Customer.objects.create(
+            title='mr', fname='Ojas', lname='Naik', sex='m', email='ojas.naik@proton.com'
+        )
+
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def scrape(self) -> dict[str, float]:
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        samples = {}
+        for line in response.content.decode().splitlines():
+            if line and not line.startswith('#'):
+                series, value = line.rsplit(' ', 1)
+                samples[series] = float(value)
+        return samples
+
+    def delta(self, before, after, series):
+        return after.get(series, 0) - before.get(series, 0)
+
+    def test_counters(self):
+        before = self.scrape()
+        ref = book_flight(4, self.customer, self.schedules[0], 80)
+        with self.assertRaises(SoldOut):
+            book_flight(1, self.customer, self.schedules[0], 80)
+        delete_booking(m.Booking.objects.get(ref=ref))
+        self.client.get(reverse('destinations'), {'o': 'NZNE'})
+        session = self.client.session
+        session['customer_id'] = self.customer.id
+        session.save()
+        after = self.scrape()
+
+        self.assertEqual(self.delta(before, after, 'app_bookings_created_total'), 1)
+        self.assertEqual(self.delta(before, after, 'app_bookings_cancelled_total'), 1)
+        self.assertEqual(self.delta(before, after, 'app_sold_out_total'), 1)
+        self.assertGreaterEqual(self.delta(before, after, 'app_session_writes_total'), 1)
+        self.assertGreater(self.delta(before, after, 'app_session_write_bytes_total'), 0)
+        self.assertGreaterEqual(
+            self.delta(before, after, 'app_cache_requests_total{cache="registry:route_graph",result="hit"}')
+            + self.delta(before, after, 'app_cache_requests_total{cache="registry:route_graph",result="miss"}'),
+            1
+        )
+        self.assertEqual(self.delta(before, after, 'app_request_duration_seconds_count{view="destinations"}'), 1)
+        self.assertEqual(
+            self.delta(before, after, 'app_request_duration_seconds_bucket{le="+Inf",view="destinations"}'),
+            1
+        )
+
+    def test_aggregates_processes(self):
+        other = [['app_bookings_created_total', [], 5]]
+        (self.directory / '999999.json').write_text(json.dumps(other))
+
+        with self.settings(METRICS_DIR=self.directory):
+            before = self.scrape()
+            book_flight(1, self.customer, self.schedules[1], 80)
+            after = self.scrape()
+        self.assertTrue((self.directory / f'{os.getpid()}.json').exists())
+        self.assertEqual(self.delta(before, after, 'app_bookings_created_total'), 1)
+        # This process's own value plus the other's
+        self.assertEqual(after['app_bookings_created_total'], metrics.value('app_bookings_created_total') + 5)
+
+    def test_flushed_in_background(self):
+        flushes = []
+        with self.settings(METRICS_DIR=self.directory):
+            with mock.patch.object(metrics, 'flush', side_effect=lambda: flushes.append(threading.current_thread())):
+                self.client.get(reverse('destinations'), {'o': 'NZNE'})
+                self.assertNotIn(threading.current_thread(), flushes)
+                time.sleep(FLUSH_INTERVAL * 1.5)
+        self.assertTrue(flushes)
+        self.assertNotIn(threading.current_thread(), flushes)
+
+    def test_flush_thread_needs_directory(self):
+        process = Metrics()
+        with mock.patch('app.metrics.threading.Thread') as thread:
+            process.inc('app_sold_out_total')
+            thread.assert_not_called()
+
+            with self.settings(METRICS_DIR=self.directory):
+                process.inc('app_sold_out_total')
+                process.inc('app_sold_out_total')
+            thread.return_value.start.assert_called_once()
+
+    def test_internal_only(self):
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='203.0.113.7')
+        self.assertEqual(response.status_code, 403)
+
+
+class SearchStateTests(RegistryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_reference_data()
+        cls.schedules = create_schedules(days=7)
+
+    def search(self):
+        depart_date = (datetime.now(gmt) + timedelta(days=2)).date().isoformat()
+        return self.client.get(
+            reverse('flights'),
+            {'origin': 'NZNE', 'destination': 'NZRO', 'depart_date': depart_date, 'travellers': 2}
+        )
+
+    def test_anonymous_search_without_session_writes(self):
+        writes = metrics.value('app_session_writes_total')
+        for _ in range(3):
+            response = self.search()
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(metrics.value('app_session_writes_total'), writes)
+        self.assertFalse(Session.objects.exists())
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, response.cookies)
+
+    def test_select_from_saved_search(self):
+        response = self.search()
+        flight = response.context['results']['depart'][0]
+
+        search = response.context['form'].initial['search']
+        response = self.client.post(reverse('flights'), {'search': search, 'select_depart': flight.quote})
+        query = quotes_query({'depart': flight.quote}, search)
+        self.assertRedirects(response, f"{reverse('register')}?{query}", fetch_redirect_response=False)
+        self.assertEqual(response.cookies[BOOKING_COOKIE].value, query)
+        self.assertFalse(Session.objects.exists())
+
+        # The booking is read back from the quotes, with a link back to the search
+        response = self.client.get(response.url)
+        booking = response.context['booking']
+        self.assertEqual(booking['depart_id'], flight.id)
+        self.assertEqual(booking['tickets'], 2)
+        self.assertEqual(booking['prices']['depart'], flight.price)
+        self.assertTrue(response.context['search_url'].startswith(reverse('flights') + '?'))
+
+    def test_expired_search(self):
+        response = self.search()
+        search = response.context['form'].initial['search']
+        with mock.patch('django.core.signing.time.time', return_value=time.time() + SEARCH_TTL + 1):
+            for token in (search, search[:-1], 'x' * 200, ''):
+                response = self.client.post(reverse('flights'), {'search': token, 'select_depart': 'quote'})
+                self.assertContains(response, 'Search expired')
+                self.assertNotIn(BOOKING_COOKIE, response.cookies)
+
+    def test_search_state_is_stateless(self):
+        # The token carries the search, so a worker that didn't issue it can read it
+        response = self.search()
+        search = response.context['form'].initial['search']
+        clear_caches()
+        self.assertEqual(
+            load_search(search), {'path': response.wsgi_request.get_full_path(), 'return_trip': False}
+        )
+
+
+class FareQuoteTests(RegistryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_reference_data()
+        cls.schedules = create_schedules(days=2)
+        cls.customer = m.Customer.objects.create(
+            title='mr', fname='Ojas', lname='Naik', sex='m', email='ojas.naik@proton.com'
+        )
+
+    def setUp(self):
+        session = self.client.session
+        session['customer_id'] = self.customer.id
+        self.depart_quote = self.quote(self.schedules[0])
+        session.save()
+
+    def confirm(self, token=None):
+        return self.client.post(reverse('confirm'), {'depart_quote': token or self.depart_quote['token']})
+
+    def quote(self, schedule, tickets=2):
+        return read_quote(issue_quote(m.Schedule.objects.with_price().get(id=schedule.id), tickets))
+
+    def reprice(self, schedule, base_price):
+        m.Schedule.objects.filter(id=schedule.id).update(base_price=base_price)
+
+    def test_annotated_price_matches_quote(self):
+        # Quotes and Itinerary.price use dynamic_price; listings use the annotation
+        s = self.schedules[0]
+        for base_price in (80, 99.99, 133.35, 2.675, 1234.565):
+            for seats_avail in range(5):
+                m.Schedule.objects.filter(id=s.id).update(base_price=base_price, seats_avail=seats_avail)
+                for days in range(0, 30, 3):
+                    now = s.dep_dt - timedelta(days=days, hours=1)
+                    self.assertEqual(
+                        m.Schedule.objects.with_price(now).get(id=s.id).price,
+                        dynamic_price(base_price, s.dep_dt, seats_avail, 4, now),
+                        (base_price, seats_avail, days)
+                    )
+
+    def test_quoted_price_is_honoured(self):
+        self.reprice(self.schedules[0], 120)
+        self.confirm()
+        booking = m.Booking.objects.get(customer=self.customer)
+        self.assertEqual((booking.tickets, booking.depart_price), (2, 80))
+
+    def test_expired_quote_is_repriced(self):
+        self.reprice(self.schedules[0], 120)
+        later = time.time() + QUOTE_TTL + 1
+        with mock.patch('django.core.signing.time.time', return_value=later):
+            response = self.confirm()
+            self.assertContains(response, 'Fares have changed')
+            self.assertFalse(m.Booking.objects.exists())
+            self.assertEqual(response.context['booking']['prices']['depart'], 120)
+
+            # The confirm form carries the re-issued quote
+            self.confirm(response.context['quotes_form'].initial['depart_quote'])
+        self.assertEqual(m.Booking.objects.get(customer=self.customer).depart_price, 120)
+
+    def test_expired_quote_at_same_price_is_booked(self):
+        with mock.patch('django.core.signing.time.time', return_value=time.time() + QUOTE_TTL + 1):
+            self.confirm()
+        self.assertEqual(m.Booking.objects.get(customer=self.customer).depart_price, 80)
+
+    def test_tampered_quote_is_rejected(self):
+        response = self.confirm(self.depart_quote['token'][:-1])
+        self.assertContains(response, 'Invalid fare quote')
+        self.assertFalse(m.Booking.objects.exists())
+
+    def test_quotes_carried_by_forms(self):
+        response = self.client.get(reverse('flights'), {
+            'origin': 'NZNE', 'destination': 'NZRO', 'travellers': 2,
+            'depart_date': gmt_to_local(self.schedules[0].dep_dt, '+12:00').date().isoformat(),
+        })
+        flight = response.context['results']['depart'][0]
+        response = self.client.post(
+            reverse('flights'), {'search': response.context['form'].initial['search'], 'select_depart': flight.quote}
+        )
+        self.assertNotIn('booking', self.client.session)
+
+        # register -> confirm, with the quote in the query string and hidden fields
+        response = self.client.get(response.url)
+        self.assertContains(response, f'name="depart_quote" value="{flight.quote}"')
+        response = self.client.post(reverse('register'), {'email': self.customer.email, 'depart_quote': flight.quote})
+        response = self.client.get(response.url)
+        self.assertContains(response, f'name="depart_quote" value="{flight.quote}"')
+        self.client.post(reverse('confirm'), {'depart_quote': flight.quote})
+        self.assertEqual(m.Booking.objects.get(customer=self.customer).depart_schedule_id, flight.id)
+
+    def test_confirm_without_quotes(self):
+        self.assertRedirects(self.client.get(reverse('confirm')), reverse('index'))
+        self.assertContains(self.client.post(reverse('confirm')), 'Booking not available')
+
+    def test_continue_from_index(self):
+        search = save_search(reverse('flights'), False)
+        response = self.client.post(reverse('flights'), {'search': search, 'select_depart': self.depart_quote['token']})
+        response = self.client.get(reverse('index'))
+        self.assertEqual(response.context['depart_schedule'], self.schedules[0])
+
+        # Continued later, at the quoted price
+        self.reprice(self.schedules[0], 120)
+        link = f"{reverse('confirm')}?{quotes_query({'depart': self.depart_quote['token']}, search)}"
+        self.assertContains(response, f'href="{escape(link)}"')
+        response = self.client.get(link)
+        self.assertEqual(response.context['booking']['prices']['depart'], 80)
+        response = self.confirm()
+        self.assertEqual(response.cookies[BOOKING_COOKIE].value, '')
+        self.assertIsNone(self.client.get(reverse('index')).context['depart_schedule'])
+
+    def test_forged_selection(self):
+        # A cheaper payload under the genuine timestamp and signature
+        payload, timestamp, signature = self.quote(self.schedules[0])['token'].split(':')
+        cheaper = signing.dumps([self.schedules[0].id, 1, 2], salt=QUOTE_SALT).split(':')[0]
+        search = save_search(reverse('flights'), False)
+        response = self.client.post(
+            reverse('flights'), {'search': search, 'select_depart': f'{cheaper}:{timestamp}:{signature}'}
+        )
+        self.assertRedirects(response, reverse('flights'), fetch_redirect_response=False)
+        self.assertNotIn(BOOKING_COOKIE, response.cookies)
+
+
+class FlightsCacheTests(RegistryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_reference_data()
+        cls.schedules = create_schedules(days=7)
+        cls.customer = m.Customer.objects.create(
+            title='mr', fname='Ojas', lname='Naik', sex='m', email='ojas.naik@proton.com'
+        )
+
+    def search(self):
+        depart_date = gmt_to_local(self.schedules[8].dep_dt, '+12:00').date().isoformat()
+        return self.client.get(
+            reverse('flights'),
+            {'origin': 'NZNE', 'destination': 'NZRO', 'depart_date': depart_date, 'travellers': 1}
+        )
+
+    def schedule_queries(self, queries):
+        return [q['sql'] for q in queries.captured_queries if 'FROM "Schedule"' in q['sql']]
+
+    def test_repeat_search_without_schedule_queries(self):
+        first = self.search()
+        with CaptureQueriesContext(connection) as queries:
+            second = self.search()
+        self.assertEqual(self.schedule_queries(queries), [])
+        self.assertEqual(
+            [(s.id, s.price, s.seats_avail) for s in first.context['results']['depart']],
+            [(s.id, s.price, s.seats_avail) for s in second.context['results']['depart']]
+        )
+        self.assertEqual(first.context['week_price_avail'], second.context['week_price_avail'])
+
+    def test_shared_cache_holds_versions(self):
+        self.search()
+        with CaptureQueriesContext(connection) as queries:
+            self.search()
+        shared = [q['sql'] for q in queries.captured_queries if '"cache"' in q['sql']]
+        self.assertTrue(shared)
+        for sql in shared:
+            self.assertIn('route_version', sql)
+
+    def test_booking_invalidates(self):
+        self.search()
+        ref = book_flight(4, self.customer, self.schedules[8], 80)
+        seats = {s.id: s.seats_avail for s in self.search().context['results']['depart']}
+        self.assertEqual(seats[self.schedules[8].id], 0)
+
+        delete_booking(m.Booking.objects.select_related('depart_schedule').get(ref=ref))
+        seats = {s.id: s.seats_avail for s in self.search().context['results']['depart']}
+        self.assertEqual(seats[self.schedules[8].id], 4)
+
+    def test_other_worker_booking_invalidates(self):
+        self.search()
+        # Another worker sells the seats and bumps the route in the shared cache
+        m.Schedule.objects.filter(id=self.schedules[8].id).update(seats_avail=0)
+        cache.set('route_version:NZNE:NZRO', time.time_ns(), timeout=None)
+        seats = {s.id: s.seats_avail for s in self.search().context['results']['depart']}
+        self.assertEqual(seats[self.schedules[8].id], 0)
+
+    def test_fragments_cached(self):
+        first = self.search()
+        schedule = first.context['results']['depart'][0]
+        key = fragment_key(schedule)
+        fragments = caches['fragments']
+        self.assertIsNotNone(fragments.get(make_template_fragment_key('schedule_details', [key])))
+        card = fragments.get(make_template_fragment_key('flight_card', [key, schedule.seats_avail, schedule.price]))
+        # A whole element, without the per-request radio
+        self.assertNotIn('<input', card)
+        self.assertEqual(card.count('<div'), card.count('</div>'))
+        # Quotes are signed per request, so only the rest of the page repeats
+        strip = lambda r: re.sub(r'value="[^"]*"', '', r.content.decode())
+        self.assertEqual(strip(first), strip(self.search()))
+
+    def test_fragments_without_request(self):
+        schedule = m.Schedule.objects.get(pk=self.schedules[8].pk)
+        reference_data.attach(schedule)
+        render = lambda: render_to_string('partials/schedule_details.html', {'schedule': schedule})
+        self.assertIn('Rotorua (NZRO)', render())
+
+        m.Airport.objects.filter(icao='NZRO').update(region='Rotorua Lakes')
+        reference_data.invalidate()
+        reference_data.attach(schedule)
+        self.assertIn('Rotorua Lakes (NZRO)', render())
+
+    def test_fragments_follow_seats_and_airports(self):
+        self.search()
+        book_flight(3, self.customer, self.schedules[8], 80)
+        self.assertContains(self.search(), '1 seat left at this price')
+
+        m.Airport.objects.filter(icao='NZRO').update(region='Rotorua Lakes')
+        reference_data.invalidate()
+        self.assertContains(self.search(), 'Rotorua Lakes')
+
+    def test_time_bucket(self):
+        days = [gmt_to_local(self.schedules[8].dep_dt, '+12:00').date()]
+        now = datetime.now(gmt)
+        flights_by_day(days, 'NZNE', 'NZRO', now)
+        with CaptureQueriesContext(connection) as queries:
+            flights_by_day(days, 'NZNE', 'NZRO', now)
+        self.assertEqual(self.schedule_queries(queries), [])
+        with CaptureQueriesContext(connection) as queries:
+            flights_by_day(days, 'NZNE', 'NZRO', now + timedelta(seconds=FLIGHTS_CACHE_BUCKET))
+        self.assertEqual(len(self.schedule_queries(queries)), 1)
+
+
+class BookingsPageTests(RegistryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_reference_data()
+        cls.schedules = create_schedules(days=7)
+        cls.customer = m.Customer.objects.create(
+            title='mr', fname='Ojas', lname='Naik', sex='m', email='ojas.naik@proton.com'
+        )
+        # Pairs share created_at so that ref breaks the tie
+        start = datetime(2026, 1, 1, tzinfo=gmt)
+        m.Booking.objects.bulk_create([
+            m.Booking(
+                ref=f'P{i:05d}', tickets=1, customer=cls.customer, depart_schedule=cls.schedules[i % 4],
+                return_schedule=cls.schedules[i % 4 + 4] if i % 2 else None, depart_price=80,
+                return_price=80 if i % 2 else None, created_at=start + timedelta(minutes=i // 2)
+            )
+            for i in range(2 * BOOKINGS_PAGE_SIZE + 5)
+        ])
+
+    def setUp(self):
+        session = self.client.session
+        session['customer_id'] = self.customer.id
+        session.save()
+
+    def test_pages(self):
+        reference_data.data  # warm up
+        refs, after, queries = [], None, []
+        while True:
+            with CaptureQueriesContext(connection) as captured:
+                response = self.client.get(reverse('bookings'), {'after': after} if after else {})
+            queries.append(data_queries(captured))
+            self.assertContains(response, f'has {2 * BOOKINGS_PAGE_SIZE + 5} bookings')
+            refs += [b.ref for b in response.context['bookings']]
+            if (after := response.context['next_cursor']) is None:
+                break
+            self.assertContains(response, 'Older bookings')
+
+        expected = list(
+            m.Booking.objects.filter(customer=self.customer).order_by('-created_at', '-ref').values_list('ref', flat=True)
+        )
+        self.assertEqual(refs, expected)
+        # The first page counts the bookings, then every page makes the same queries,
+        # none of them for airports or aircraft
+        self.assertEqual(len(queries[0]), len(queries[1]) + 1)
+        self.assertEqual({len(q) for q in queries[1:]}, {len(queries[1])})
+        self.assertNotIn('COUNT(', ' '.join(queries[1]))
+        self.assertNotIn('FROM "Airport"', ' '.join(q['sql'] for q in captured.captured_queries))
+
+    def test_count_after_booking(self):
+        self.assertContains(self.client.get(reverse('bookings')), f'has {2 * BOOKINGS_PAGE_SIZE + 5} bookings')
+        ref = book_flight(1, self.customer, self.schedules[0], 80)
+        self.assertContains(self.client.get(reverse('bookings')), f'has {2 * BOOKINGS_PAGE_SIZE + 6} bookings')
+        delete_booking(m.Booking.objects.get(ref=ref))
+        self.assertContains(self.client.get(reverse('bookings')), f'has {2 * BOOKINGS_PAGE_SIZE + 5} bookings')
+
+    def test_invalid_cursor(self):
+        first = self.client.get(reverse('bookings'))
+        for after in ('nonsense', f'{10 ** 19}-P00001'):
+            response = self.client.get(reverse('bookings'), {'after': after})
+            self.assertEqual(
+                [b.ref for b in response.context['bookings']], [b.ref for b in first.context['bookings']]
+            )
+
+
+class SingleFlightTests(RegistryTransactionTestCase):
+    def run_threads(self, target, n=8):
+        results, errors = [], []
+
+        def run():
+            try:
+                results.append(target())
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run) for _ in range(n)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results, errors
+
+    def test_concurrent_callers_share_one_computation(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return ['2026-01-01']
+
+        results, errors = self.run_threads(lambda: single_flight('test:share', compute))
+        self.assertEqual((len(calls), errors), (1, []))
+        self.assertEqual(results, [['2026-01-01']] * 8)
+
+    def test_error_is_shared(self):
+        def compute():
+            time.sleep(0.1)
+            raise ValueError('boom')
+
+        results, errors = self.run_threads(lambda: single_flight('test:error', compute))
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 8)
+        self.assertTrue(all(isinstance(e, ValueError) for e in errors))
+
+    def test_waits_on_another_process(self):
+        # Another process holds the lock and fills the cache
+        cache.add('lock:test:remote', 1, 10)
+        self.addCleanup(cache.delete_many, ['lock:test:remote', 'test:remote'])
+        threading.Timer(0.1, cache.set, ['test:remote', 'filled']).start()
+
+        def compute():
+            self.fail('Computed while another process held the lock')
+
+        self.assertEqual(
+            single_flight('test:remote', compute, lambda: cache.get('test:remote'), using='default'), 'filled'
+        )
+
+
+class FlightDatesCacheTests(RegistryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_reference_data()
+        cls.schedules = create_schedules(days=3)
+        rebuild_availability()
+        cls.customer = m.Customer.objects.create(
+            title='mr', fname='Ojas', lname='Naik', sex='m', email='ojas.naik@proton.com'
+        )
+
+    def dates(self):
+        return self.client.get(reverse('flight_dates'), {'o': 'NZNE', 'd': 'NZRO'}).json()['dates']
+
+    def test_cached_until_inventory_changes(self):
+        dates = self.dates()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.dates(), dates)
+        self.assertEqual(data_queries(queries), [])
+
+        # Sell out the flights on the last local date
+        last_date = dates[-1]
+        for s in self.schedules:
+            if s.dep_icao_id == 'NZNE' and gmt_to_local(s.dep_dt, '+12:00').date().isoformat() == last_date:
+                book_flight(4, self.customer, s, 80)
+        self.assertNotIn(last_date, self.dates())
+
+
+class AsyncViewTests(RegistryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_reference_data()
+        cls.schedules = create_schedules(days=3)
+        rebuild_availability()
+
+    async def test_flight_dates(self):
+        expected = sorted({
+            gmt_to_local(s.dep_dt, '+12:00').date().isoformat()
+            for s in self.schedules if s.dep_icao_id == 'NZNE'
+        })
+        response = await self.async_client.get(reverse('flight_dates'), {'o': 'NZNE', 'd': 'NZRO'})
+        self.assertEqual(response.json()['dates'], expected)
+
+        response = await self.async_client.get(reverse('flight_dates'), {'o': 'NZNE', 'd': 'NZNE'})
+        self.assertEqual(response.status_code, 400)
+
+    async def test_destinations(self):
+        response = await self.async_client.get(reverse('destinations'), {'o': 'NZNE'})
+        self.assertEqual(response.json(), {'destinations': ['NZRO']})
+        response = await self.async_client.get(reverse('destinations'), {'o': 'NZNE'}, IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_concurrent_lookups_share_one_query(self):
+        async def lookups():
+            return await asyncio.gather(*[
+                self.async_client.get(reverse('flight_dates'), {'o': 'NZNE', 'd': 'NZRO'}) for _ in range(5)
+            ])
+
+        clear_caches()
+        reference_data.data  # warm up
+        # Sync, so that the queries run on this thread's connection
+        with CaptureQueriesContext(connection) as queries:
+            responses = async_to_sync(lookups)()
+        self.assertEqual(len({r.content for r in responses}), 1)
+        self.assertEqual(len([q for q in queries.captured_queries if 'FROM "RouteAvailability"' in q['sql']]), 1)
+
+    async def test_error_is_shared(self):
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            raise ValueError('boom')
+
+        async def cached():
+            return None
+
+        results = await asyncio.gather(
+            *[asingle_flight('test:async', compute, cached) for _ in range(4)], return_exceptions=True
+        )
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+
+
+class ConnectionTests(RegistryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_reference_data()
+        m.Airport.objects.create(icao='YMML', name='Melbourne', region='Victoria', gmt_offset='+10:00')
+        cls.schedules = create_schedules(days=3)
+        cls.customer = m.Customer.objects.create(
+            title='mr', fname='Ojas', lname='Naik', sex='m', email='ojas.naik@proton.com'
+        )
+        # NZNE -> NZRO departs base + 2h and base + 14h
+        cls.base = cls.schedules[4].dep_dt - timedelta(hours=2)
+        cls.ymml = {}
+        for name, dep, arr in [
+            ('A', timedelta(hours=-2), timedelta(hours=1)),
+            ('B', timedelta(hours=-1), timedelta(hours=1, minutes=15)),  # Exactly MIN_CONNECTION_TIME
+            ('C', timedelta(minutes=-30), timedelta(hours=1, minutes=30)),  # Too short for base + 2h
+        ]:
+            cls.ymml[name] = m.Schedule.objects.create(
+                flight_no=f'BA9{len(cls.ymml)}', dep_dt=cls.base + dep, arr_dt=cls.base + arr, seats_avail=4,
+                aircraft_id='SF50', dep_icao_id='YMML', arr_icao_id='NZNE', base_price=200,
+            )
+        cls.local_date = gmt_to_local(cls.ymml['A'].dep_dt, '+10:00').date()
+
+    def search(self, tickets=1):
+        return search_connections('YMML', 'NZRO', self.local_date, tickets)
+
+    def departures(self, itineraries):
+        return [(i.legs[0].id, i.legs[-1].arr_dt - self.base) for i in itineraries]
+
+    def test_pareto_itineraries(self):
+        itineraries = self.search()
+        # A is dominated by B, which departs later and arrives at the same time; C
+        # misses the base + 2h connection and arrives 12h later
+        self.assertEqual(self.departures(itineraries), [
+            (self.ymml['B'].id, timedelta(hours=2, minutes=45)),
+            (self.ymml['C'].id, timedelta(hours=14, minutes=45)),
+        ])
+        for i in itineraries:
+            self.assertEqual([leg.arr_icao_id for leg in i.legs], ['NZNE', 'NZRO'])
+            [(_, airport, layover), _] = i.stages
+            self.assertEqual(airport.icao, 'NZNE')
+            self.assertGreaterEqual(layover, MIN_CONNECTION_TIME)
+            self.assertEqual(i.price, round(sum(leg.price for leg in i.legs), 2))
+
+        with CaptureQueriesContext(connection) as queries:
+            self.search()
+        self.assertEqual(data_queries(queries), [])
+
+    def test_later_arrival_connects(self):
+        for icao in ['NZGB', 'NZAA', 'NZWN']:
+            m.Airport.objects.create(icao=icao, name=icao, region=icao, gmt_offset='+12:00')
+        legs = []
+        for dep_icao, arr_icao, dep in [
+            ('YMML', 'NZGB', timedelta(hours=-1, minutes=-30)),
+            ('NZGB', 'NZAA', timedelta(hours=1)),  # Arrives too early to connect
+            ('NZGB', 'NZAA', timedelta(hours=20)),
+            ('NZAA', 'NZWN', timedelta(hours=30)),
+        ]:
+            legs.append(m.Schedule.objects.create(
+                flight_no='BA999', dep_dt=self.base + dep, arr_dt=self.base + dep + timedelta(hours=1),
+                seats_avail=4, aircraft_id='SF50', dep_icao_id=dep_icao, arr_icao_id=arr_icao, base_price=100,
+            ))
+        itineraries = search_connections('YMML', 'NZWN', self.local_date)
+        self.assertEqual([[leg.id for leg in i.legs] for i in itineraries], [[legs[0].id, legs[2].id, legs[3].id]])
+
+    def test_seats(self):
+        network = connection_graph.data
+        self.assertEqual(self.search(tickets=5), [])
+
+        book_flight(4, self.customer, self.schedules[4], 80)
+        # The connection is gone, B now arrives with C and is dominated
+        self.assertEqual(
+            self.departures(self.search()), [(self.ymml['C'].id, timedelta(hours=14, minutes=45))]
+        )
+        self.assertIs(connection_graph.data, network)
+
+    def test_schedule_changes(self):
+        network = connection_graph.data
+        self.assertEqual(len(self.search()), 2)
+
+        # A new route, whose flight departs later and arrives earlier than both
+        direct = m.Schedule.objects.create(
+            flight_no='BA998', dep_dt=self.base, arr_dt=self.base + timedelta(hours=2), seats_avail=4,
+            aircraft_id='SF50', dep_icao_id='YMML', arr_icao_id='NZRO', base_price=300,
+        )
+        self.assertEqual(self.departures(self.search()), [(direct.id, timedelta(hours=2))])
+
+        direct.arr_dt += timedelta(hours=12)
+        direct.save()
+        self.assertEqual(self.departures(self.search()), [
+            (self.ymml['B'].id, timedelta(hours=2, minutes=45)),
+            (direct.id, timedelta(hours=14)),
+        ])
+
+        direct.delete()
+        self.assertEqual(len(self.search()), 2)
+        self.assertIs(connection_graph.data, network)
+
+    def test_departed_legs_dropped(self):
+        network = connection_graph.data
+        later = max(s.dep_dt for s in self.schedules) + timedelta(days=2)
+        network.refresh(later)
+        self.assertFalse(any(network.departures.values()))
+        self.assertEqual(network.seats, {})
+
+    def test_cached(self):
+        expected = self.departures(self.search())
+        with mock.patch.object(Network, 'search', wraps=connection_graph.data.search) as search:
+            self.assertEqual(self.departures(self.search()), expected)
+            search.assert_not_called()
+
+            # Any route's bookings can change the connections
+            book_flight(4, self.customer, self.schedules[4], 80)
+            self.assertEqual(
+                self.departures(self.search()), [(self.ymml['C'].id, timedelta(hours=14, minutes=45))]
+            )
+            search.assert_called_once()
+
+    def test_views(self):
+        params = {
+            'origin': 'YMML', 'destination': 'NZRO', 'depart_date': self.local_date.isoformat(), 'travellers': 2
+        }
+        data = self.client.get(reverse('connections'), params).json()
+        self.assertEqual([len(i['legs']) for i in data['depart']], [2, 2])
+        self.assertEqual(data['depart'][0]['legs'][1]['origin'], 'NZNE')
+        self.assertEqual(self.client.get(reverse('connections'), {'origin': 'YMML'}).status_code, 400)
+
+        response = self.client.get(reverse('flights'), params)
+        self.assertContains(response, 'Connecting flights')
+        self.assertContains(response, '45m connection in Auckland North Shore (NZNE)')
+
+
+class NetworkSearchTests(SimpleTestCase):
+    start = datetime(2030, 1, 1, tzinfo=gmt)
+
+    def network(self, airports, per_day, days=3, seed=0):
+        rnd = random.Random(seed)
+        network = Network()
+        icaos = [f'X{i:03}' for i in range(airports)]
+        for origin in icaos:
+            for _ in range(per_day * days):
+                dep = self.start + timedelta(minutes=rnd.randrange(days * 24 * 60))
+                leg = Leg(
+                    len(network.seats), 'BA999', dep, dep + timedelta(minutes=rnd.randrange(45, 300)), 'SF50',
+                    origin, rnd.choice([icao for icao in icaos if icao != origin]), 100, dep.date()
+                )
+                network.departures[origin].append(leg)
+                network.seats[leg.id] = rnd.randrange(5)
+        network.sort()
+        return network, icaos
+
+    def search(self, network, origin, destination, max_legs=MAX_LEGS):
+        return network.search(origin, destination, date(2030, 1, 2), 1, self.start, max_legs)
+
+    def brute_force(self, network, origin, destination, max_legs=MAX_LEGS):
+        paths = []
+
+        def extend(path):
+            last = path[-1]
+            if last.arr_icao_id == destination:
+                paths.append(path)
+                return
+            visited = {leg.dep_icao_id for leg in path} | {last.arr_icao_id}
+            for leg in network.departures[last.arr_icao_id] if len(path) < max_legs else []:
+                if (
+                    last.arr_dt + MIN_CONNECTION_TIME <= leg.dep_dt <= last.arr_dt + MAX_CONNECTION_TIME
+                    and leg.arr_icao_id not in visited and network.seats[leg.id] >= 1
+                ):
+                    extend(path + (leg,))
+
+        for first in network.departures[origin]:
+            if first.dep_local_date == date(2030, 1, 2) and network.seats[first.id] >= 1:
+                extend((first,))
+        keys = {(p[0].dep_dt, p[-1].arr_dt, len(p)) for p in paths}
+        return {k for k in keys if not any(o[0] >= k[0] and o[1] <= k[1] and o[2] <= k[2] and o != k for o in keys)}
+
+    def test_matches_brute_force(self):
+        for seed in range(10):
+            network, icaos = self.network(6, 6, seed=seed)
+            for origin, destination in [(icaos[0], icaos[5]), (icaos[1], icaos[4]), (icaos[2], icaos[3])]:
+                for max_legs in (2, 3, 4):
+                    itineraries = self.search(network, origin, destination, max_legs)
+                    self.assertEqual(
+                        {(i[0].dep_dt, i[-1].arr_dt, len(i)) for i in itineraries},
+                        self.brute_force(network, origin, destination, max_legs),
+                        (seed, origin, destination, max_legs)
+                    )
+
+    def test_scale(self):
+        # 30 airports with 400 departures each a day
+        network, icaos = self.network(30, 400)
+        truncated = metrics.value('app_connection_searches_truncated_total')
+        start = time.perf_counter()
+        for destination in icaos[1:6]:
+            self.assertTrue(self.search(network, icaos[0], destination))
+        self.assertLess(time.perf_counter() - start, 10)
+        self.assertEqual(metrics.value('app_connection_searches_truncated_total'), truncated)
+
+    def test_work_cap(self):
+        network, icaos = self.network(30, 400)
+        truncated = metrics.value('app_connection_searches_truncated_total')
+        with mock.patch('app.connections.MAX_SEARCH_WORK', 1000):
+            capped = self.search(network, icaos[0], icaos[1])
+        self.assertEqual(metrics.value('app_connection_searches_truncated_total'), truncated + 1)
+        # Direct flights are still found
+        itineraries = self.search(network, icaos[0], icaos[1])
+        self.assertLessEqual({i for i in itineraries if len(i) == 1}, {i for i in capped if len(i) == 1})
+
+
+class FareCalendarTests(RegistryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_reference_data()
+        cls.schedules = create_schedules(days=14)
+        cls.customer = m.Customer.objects.create(
+            title='mr', fname='Ojas', lname='Naik', sex='m', email='ojas.naik@proton.com'
+        )
+
+    def calendar(self, **params):
+        response = self.client.get(reverse('fare_calendar'), {'o': 'NZNE', 'd': 'NZRO', **params})
+        return {day['date']: (day['price'], day['available']) for day in response.json()['days']}
+
+    def test_matches_week_strip(self):
+        depart = gmt_to_local(self.schedules[20].dep_dt, '+12:00').date()
+        # Sell out one day and part of another
+        for s in self.schedules[16:24]:
+            if s.dep_icao_id == 'NZNE' and gmt_to_local(s.dep_dt, '+12:00').date() == depart:
+                book_flight(4, self.customer, s, 80)
+        book_flight(2, self.customer, self.schedules[28], 80)
+
+        calendar = self.calendar()
+        response = self.client.get(reverse('flights'), {
+            'origin': 'NZNE', 'destination': 'NZRO', 'depart_date': depart.isoformat(), 'travellers': 1
+        })
+        for d, price, available in response.context['week_price_avail']['depart']:
+            if price is not None:
+                self.assertEqual(calendar[d.isoformat()], (price, available))
+        self.assertFalse(calendar[depart.isoformat()][1])
+
+    def test_one_grouped_query(self):
+        clear_caches()
+        with CaptureQueriesContext(connection) as queries:
+            calendar = self.calendar(days=90)
+        [query] = [q['sql'] for q in queries.captured_queries if 'FROM "Schedule"' in q['sql']]
+        self.assertIn('GROUP BY', query)
+        self.assertEqual(len(calendar), len({
+            gmt_to_local(s.dep_dt, '+12:00').date() for s in self.schedules if s.dep_icao_id == 'NZNE'
+        }))
+
+        with CaptureQueriesContext(connection) as queries:
+            self.calendar(days=90)
+        self.assertEqual(data_queries(queries), [])
+
+    def test_range(self):
+        dates = sorted(self.calendar())
+        self.assertEqual(sorted(self.calendar(start=dates[2], days=3)), dates[2:5])
+        for params in [{'days': 0}, {'days': 1000}, {'start': 'soon'}, {'start': '9999-12-30'}, {'d': 'NZNE'}]:
+            response = self.client.get(reverse('fare_calendar'), {'o': 'NZNE', 'd': 'NZRO', **params})
+            self.assertEqual(response.status_code, 400)
+
+
+class RoundTripPairsTests(RegistryTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_reference_data()
+        cls.schedules = create_schedules(days=10)
+        rng = random.Random(1)
+        for s in cls.schedules:
+            s.base_price = rng.randint(50, 150)
+            s.seats_avail = rng.randint(0, 4)
+            s.save()
+
+    def params(self, **params):
+        depart = gmt_to_local(self.schedules[16].dep_dt, '+12:00').date()
+        return {
+            'origin': 'NZNE',
+            'destination': 'NZRO',
+            'depart_date': depart.isoformat(),
+            'return_date': (depart + timedelta(days=2)).isoformat(),
+            'travellers': 2,
+            **params
+        }
+
+    def test_matches_brute_force(self):
+        schedules = list(m.Schedule.objects.with_price())
+        outbound = [s for s in schedules if s.dep_icao_id == 'NZNE']
+        inbound = [s for s in schedules if s.dep_icao_id == 'NZRO']
+        for travellers in (1, 3):
+            pairs = cheapest_pairs(outbound, inbound, travellers, n=10)
+            expected = sorted(
+                o.price + r.price for o in outbound for r in inbound
+                if o.arr_dt < r.dep_dt and min(o.seats_avail, r.seats_avail) >= travellers
+            )[:10]
+            self.assertEqual([o.price + r.price for o, r in pairs], expected)
+            for o, r in pairs:
+                self.assertLess(o.arr_dt, r.dep_dt)
+                self.assertGreaterEqual(min(o.seats_avail, r.seats_avail), travellers)
+
+    def test_flights_page(self):
+        response = self.client.get(reverse('flights'), self.params())
+        pairs = response.context['pairs']
+        self.assertTrue(pairs)
+        self.assertEqual([p['total'] for p in pairs], sorted(p['total'] for p in pairs))
+        self.assertContains(response, 'Cheapest round trips')
+
+        # Each pair books as if selected in the week strips
+        html = response.content.decode()
+        form = re.search(r'<form method="post" action="/flights/">(.*?)</form>', html, re.S).group(1)
+        data = dict(re.findall(r'name="(\w+)" value="([^"]+)"', form))
+        response = self.client.post(reverse('flights'), data)
+        tokens = {'depart': data['select_depart'], 'return': data['select_return']}
+        query = quotes_query(tokens, data['search'])
+        self.assertRedirects(response, f"{reverse('register')}?{query}", fetch_redirect_response=False)
+        booking = self.client.get(response.url).context['booking']
+        self.assertEqual(booking['prices']['total'], pairs[0]['total'])
+
+    def test_one_way_has_no_pairs(self):
+        response = self.client.get(reverse('flights'), self.params(return_date=''))
+        self.assertEqual(response.context['pairs'], [])
+        self.assertNotContains(response, 'Cheapest round trips')
+
+    def test_json(self):
+        params = self.params()
+        pairs = self.client.get(reverse('round_trips'), params).json()['pairs']
+        page = self.client.get(reverse('flights'), params).context['pairs']
+        self.assertEqual(
+            [(p['depart']['id'], p['return']['id'], p['total']) for p in pairs],
+            [(p['depart'].id, p['return'].id, p['total']) for p in page]
+        )
+
+        response = self.client.get(reverse('round_trips'), self.params(return_date=''))
+        self.assertEqual(response.status_code, 400)
@@ -5,11 +5,15 @@ urlpatterns = [
     path('', views.index, name='index'),
     path('destinations/', views.destinations, name='destinations'),
     path('flight_dates/', views.flight_dates, name='flight_dates'),
+    path('fare_calendar/', views.fare_calendar, name='fare_calendar'),
     path('flights/', views.flights, name='flights'),
+    path('connections/', views.connections, name='connections'),
+    path('round_trips/', views.round_trips, name='round_trips'),
     path('register/', views.register, name='register'),
     path('login_logout/', views.login_logout, name='login_logout'),
     path('confirm/', views.confirm, name='confirm'),
     path('bookings/', views.bookings, name='bookings'),
     path('invoice/', views.invoice, name='invoice'),
+    path('metrics/', views.metrics, name='metrics'),
 ]
 
@@ -3,9 +3,14 @@ Utility functions used primarily by dbprime.py.
 """
 
 import csv
+import hmac
+import math
 import random
 import string
-from datetime import datetime, date, time, timedelta, timezone
+import hashlib
+from functools import lru_cache
+from itertools import islice
+from datetime import datetime, date, timedelta, timezone
 gmt = timezone.utc
 
 
@@ -26,13 +31,24 @@ def project_dates(n_days: int, date=datetime.today().date()) -> list[date]:
     return [date + timedelta(days=i) for i in range(n_days)]
 
 
+def batched(iterable, n: int):
+    """
+    Yield lists of up to n items.
+    """
+    it = iter(iterable)
+    while batch := list(islice(it, n)):
+        yield batch
+
+
 def flights_on_date(date, sched_list: list[dict]) -> list:
     return [s for s in sched_list if date.weekday() in int_days(s['days'])]
 
 
+@lru_cache(maxsize=None)
 def convert_gmt_offset(offset: str) -> timezone:
     """
-    Convert GMT (UTC) offset string like '+12:00' to timezone
+    Convert GMT (UTC) offset string like '+12:00' to timezone. Cached, so every
+    caller with the same offset shares one (immutable) instance.
     """
     pm = 1 if offset[0] == '+' else -1
     h_str, m_str = offset[1:].split(':')
@@ -60,6 +76,34 @@ def duration_to_datetimes(
     return dep_dt, arr_dt
 
 
+def dynamic_price(
+    base_price: float,
+    dep_dt: datetime,
+    seats_avail: int,
+    max_seats: int,
+    now: datetime
+) -> float:
+    """
+    Dynamic price:
+     - 50% weighted seat ratio
+     - +1.5% for each day within 28 days
+     - base price 3 days before departure
+     - cap of +40% over base price
+    """
+    n_days = (dep_dt - now).days
+
+    if n_days <= 3:
+        return base_price
+
+    days = max(0, 28 - n_days)
+    seat_ratio = (max_seats - seats_avail) / max_seats
+    pct = min(0.015 * days + 0.5 * seat_ratio, 0.4)
+    mult = 1 + pct
+    # Half a cent up, spelt out so ScheduleQuerySet.with_price rounds identically in
+    # SQL (round() and SQL ROUND disagree on halves)
+    return math.floor(base_price * mult * 100 + 0.5) / 100
+
+
 def rand_csv_rows(csv_path, n):
     """
     Randomly sample n non-header rows.
@@ -69,9 +113,37 @@ def rand_csv_rows(csv_path, n):
     return random.sample(rows, min(n, len(rows)))
 
 
-def generate_booking_ref(length=6):
-    poss_chars = string.digits + string.ascii_uppercase
-    return ''.join(random.choices(poss_chars, k=length))
+REF_CHARS = string.digits + string.ascii_uppercase
+
+
+def permute_ref(n: int, key: bytes, length=6, rounds=4) -> str:
+    """
+    Map n in [0, 36^length) to a booking reference with a keyed Feistel permutation.
+    Distinct n give distinct references, but consecutive n don't look sequential.
+    Values outside the domain are walked through the permutation again.
+    """
+    domain = len(REF_CHARS) ** length
+    if not 0 <= n < domain:
+        raise ValueError(f'{n} is outside the booking reference space')
+
+    half_bits = (domain.bit_length() + 1) // 2
+    mask = (1 << half_bits) - 1
+
+    x = n
+    while True:
+        left, right = x >> half_bits, x & mask
+        for r in range(rounds):
+            digest = hmac.new(key, bytes([r]) + right.to_bytes(8, 'big'), hashlib.sha256).digest()
+            left, right = right, left ^ (int.from_bytes(digest[:8], 'big') & mask)
+        x = (left << half_bits) | right
+        if x < domain:
+            break
+
+    chars = []
+    for _ in range(length):
+        x, i = divmod(x, len(REF_CHARS))
+        chars.append(REF_CHARS[i])
+    return ''.join(reversed(chars))
 
 
 def del_dupl_vals(dict_list: list[dict], key: str):
@@ -96,20 +168,3 @@ def random_instance(Model, **filters):
 def gmt_to_local(gmt_dt: datetime, offset: str) -> datetime:
     local_tz = convert_gmt_offset(offset)
     return gmt_dt.astimezone(local_tz)
-
-
-def gmt_range_about(
-    local_date: date,
-    offset: str,
-    days_fwd: int = 1,
-    days_bwd: int = 0
-) -> tuple[datetime, datetime]:
-    """
-    Create a range (default = 24h) from the start of a date and convert to GMT.
-    """
-    local_tz = convert_gmt_offset(offset)
-    day0 = datetime.combine(local_date, time.min).replace(tzinfo=local_tz)
-    start = day0 - timedelta(days=days_bwd)
-    end = day0 + timedelta(days=days_fwd)
-    return start.astimezone(gmt), end.astimezone(gmt)
-
@@ -1,20 +1,32 @@
 from django.shortcuts import render, redirect
 from django.template.loader import render_to_string
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse, HttpResponseForbidden, QueryDict
 from django.views.decorators.http import require_GET, require_http_methods
+from django.views.decorators.cache import cache_control
 from django.db import IntegrityError
+from django.core import signing
 from django.contrib import messages
 from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from django.conf import settings
 from urllib.parse import urlencode
 from datetime import datetime, timezone
 gmt = timezone.utc
 
 import app.models as m
-from app.forms import FlightSearchForm, FlightBookForm, CustomerDetailsForm, EmailForm, ConfirmForm, CancelForm
-from app.utils import convert_gmt_offset
+from app.forms import (
+    FlightSearchForm, FlightBookForm, CustomerDetailsForm, EmailForm, ConfirmForm, CancelForm, QuotesForm
+)
+from app.registry import reference_data, route_graph
+from app.connections import search_connections
+from app.metrics import metrics as app_metrics
 from app.views_utils import (
-    ParamErrors, validate_airports, parse_search, fix_date_errors, get_result_price_avail,
-    get_booking_dict, book_flight, delete_booking, get_schedules, get_price_dict
+    ParamErrors, SoldOut, validate_airports, parse_search, fix_date_errors, get_result_price_avail,
+    get_booking_dict, book_flight, delete_booking, get_schedules, get_price_dict, save_search, load_search,
+    search_path, issue_quote, read_quote, limit_quote, verify_quotes, quotes_query, aavailable_dates,
+    afare_calendar, bookings_page, bookings_count, round_trip_pairs,
+    FARE_CALENDAR_DAYS, FARE_CALENDAR_MAX_DAYS, BOOKING_COOKIE
 )
 
 
@@ -30,14 +42,16 @@ def index(request):
     customer_id = request.session.get('customer_id')
     customer = m.Customer.objects.get(id=customer_id) if customer_id else None
 
-    depart_id = request.session.get('booking', {}).get('depart_id')
-    depart_schedule = (
-        m.Schedule.objects
-        .select_related('arr_icao')
-        .get(id=depart_id)
-    ) if depart_id else None
+    # A booking in progress, from the quotes last selected on this browser
+    depart_schedule, continue_query = None, request.COOKIES.get(BOOKING_COOKIE, '')
+    try:
+        depart_quote = read_quote(QuotesForm(QueryDict(continue_query)).tokens()['depart'], max_age=None)
+        depart_schedule = m.Schedule.objects.filter(id=depart_quote['schedule_id']).first()
+    except signing.BadSignature:
+        pass
+    reference_data.attach(depart_schedule)
 
-    info = {airport.icao: (airport.name, airport.region) for airport in m.Airport.objects.all()}
+    info = {icao: (airport.name, airport.region) for icao, airport in reference_data.airports().items()}
     choices = [(icao, f"{region} ({icao})") for icao, (name, region) in info.items()]
     form = FlightSearchForm(origin_choices=choices, destination_choices=choices)
 
@@ -46,59 +60,153 @@ def index(request):
         'customer': customer,
         'is_customer': customer is not None,
         'depart_schedule': depart_schedule,
+        'continue_query': continue_query,
         'info': info
     }
     return render(request, 'index.html', context)
 
 
 @require_GET
-def destinations(request):
+@cache_control(no_cache=True)
+async def destinations(request):
     """
-    Return all destinations for an origin as JSON.
+    Return all destinations for an origin as JSON. Served from the route graph,
+    with validators derived from its version so that clients can revalidate.
+    Async, like flight_dates, so that under ASGI calendar lookups don't each hold
+    a worker thread. The validators are computed here rather than with @condition,
+    which would read the version from the cache synchronously.
     """
     origin = request.GET.get('o', '').upper()
 
-    destinations = (
-        m.Schedule.objects
-        .filter(dep_icao=origin)
-        .values_list('arr_icao', flat=True)
-        .distinct()
-    )
+    version = await route_graph.aversion()
+    etag = quote_etag(str(version))
+    last_modified = int(route_graph.last_modified(version).timestamp())
 
-    if destinations.count() == 0:
-        return JsonResponse({'Error': 'Invalid or missing `o` query parameter'}, status=400)
+    if (response := get_conditional_response(request, etag=etag, last_modified=last_modified)) is None:
+        destinations = await route_graph.adestinations(origin)
+        if not destinations:
+            return JsonResponse({'Error': 'Invalid or missing `o` query parameter'}, status=400)
+        response = JsonResponse({'destinations': destinations})
 
-    return JsonResponse({'destinations': list(destinations)})
+    response.headers['ETag'] = etag
+    response.headers['Last-Modified'] = http_date(last_modified)
+    return response
 
 
 @require_GET
-def flight_dates(request):
+async def flight_dates(request):
     """
-    Given origin and destination, return all future dates with non-full flights.
-    Used to mark calendar dates.
+    Given origin and destination, return all local dates from today with non-full
+    flights yet to depart (see views_utils.aavailable_dates). Used to mark calendar
+    dates.
     """
     origin = request.GET.get('o', '').upper()
     destination = request.GET.get('d', '').upper()
 
-    param_errs, orig_airport, dest_airport = validate_airports(origin, destination)
+    airports = await reference_data.aairports()
+    param_errs, orig_airport, dest_airport = validate_airports(origin, destination, airports)
 
     if param_errs:
         return JsonResponse({'Error': param_errs}, status=400)
 
-    orig_tz = convert_gmt_offset(orig_airport.gmt_offset)
-    dates = [
-        s[0].astimezone(orig_tz).date()
-        for s in m.Schedule.objects
-            .filter(
-                dep_icao=origin,
-                arr_icao=destination,
-                seats_avail__gte=1,
-                dep_dt__gte=datetime.now(gmt)
-            )
-            .values_list('dep_dt')
-            .distinct()
-    ]
-    return JsonResponse({'dates': dates})
+    now = datetime.now(orig_airport.tzinfo)
+    return JsonResponse({'dates': await aavailable_dates(origin, destination, now)})
+
+
+@require_GET
+async def fare_calendar(request):
+    """
+    Given origin and destination, return the lowest current price and whether
+    any flight has seats for each local date with flights in the `days` (default
+    FARE_CALENDAR_DAYS) from `start` (default today). Used to show prices in the
+    date pickers.
+    """
+    origin = request.GET.get('o', '').upper()
+    destination = request.GET.get('d', '').upper()
+
+    airports = await reference_data.aairports()
+    param_errs, orig_airport, dest_airport = validate_airports(origin, destination, airports)
+
+    if param_errs:
+        return JsonResponse({'Error': param_errs}, status=400)
+
+    # Dates before today (at the origin) have no flights to price, and a start at
+    # most FARE_CALENDAR_MAX_DAYS ahead keeps start + days within date's range
+    now = datetime.now(gmt)
+    today = start = now.astimezone(orig_airport.tzinfo).date()
+    try:
+        if start_str := request.GET.get('start'):
+            start = max(start, datetime.strptime(start_str, '%Y-%m-%d').date())
+        days = int(request.GET.get('days', FARE_CALENDAR_DAYS))
+        if not 1 <= days <= FARE_CALENDAR_MAX_DAYS or (start - today).days > FARE_CALENDAR_MAX_DAYS:
+            raise ValueError()
+    except ValueError:
+        return JsonResponse(
+            {'Error': [f'Invalid `start` or `days` (1 to {FARE_CALENDAR_MAX_DAYS}) query parameter']}, status=400
+        )
+
+    calendar = await afare_calendar(origin, destination, start, days, now)
+    return JsonResponse({
+        'days': [{'date': d, 'price': price, 'available': available} for d, price, available in calendar]
+    })
+
+
+@require_GET
+def round_trips(request):
+    """
+    The cheapest valid outbound/return pairs (see views_utils.round_trip_pairs)
+    for the same query parameters as flights/ as JSON.
+    """
+    try:
+        orig_airport, dest_airport, dates, travellers = parse_search(request)
+        if not dates.get('return'):
+            raise ParamErrors(['Return date is required.'])
+    except ParamErrors as e:
+        return JsonResponse({'Error': e.param_errs}, status=400)
+
+    def schedule_dict(s):
+        return {
+            'id': s.id,
+            'flight_no': s.flight_no,
+            'depart': s.dep_dt_local.isoformat(),
+            'arrive': s.arr_dt_local.isoformat(),
+            'price': s.price,
+            'seats_avail': s.seats_avail,
+        }
+
+    pairs = round_trip_pairs(orig_airport, dest_airport, dates['depart'], dates['return'], travellers)
+    return JsonResponse({
+        'pairs': [
+            {
+                'depart': schedule_dict(p['depart']),
+                'return': schedule_dict(p['return']),
+                'price': p['price'],
+                'total': p['total'],
+            }
+            for p in pairs
+        ]
+    })
+
+
+@require_GET
+def connections(request):
+    """
+    Itineraries, direct or connecting, for the same query parameters as flights/
+    as JSON (see connections.search_connections).
+    """
+    try:
+        orig_airport, dest_airport, dates, travellers = parse_search(request)
+    except ParamErrors as e:
+        return JsonResponse({'Error': e.param_errs}, status=400)
+
+    trips = {'depart': (orig_airport, dest_airport, dates['depart'])}
+    if dates.get('return'):
+        trips['return'] = (dest_airport, orig_airport, dates['return'])
+
+    return JsonResponse({
+        trip: [i.as_dict() for i in search_connections(origin.icao, destination.icao, d.date(), travellers)]
+        for trip, (origin, destination, d) in trips.items()
+    })
 
 
 @require_http_methods(['GET', 'POST'])
@@ -111,8 +219,6 @@ def flights(request):
           resend the form with errors.
     """
     if request.method == 'GET':
-        request.session['search_path'] = request.get_full_path()
-
         try:
             orig_airport, dest_airport, dates, travellers = parse_search(request)
         except ParamErrors as e:
@@ -155,17 +261,37 @@ def flights(request):
                 remove_before_now=True
             )
 
-        request.session['travellers'] = travellers
-        prices = request.session['prices'] = {s.id: s.current_price for s in results['depart'] + results['return']}
+        # Itineraries with stops, which can't be booked in one go yet
+        connections = {'depart': [], 'return': []}
+        connections['depart'] = [
+            i for i in search_connections(orig_airport.icao, dest_airport.icao, dates['depart'].date(), travellers)
+            if i.stops
+        ]
+        if dates.get('return'):
+            connections['return'] = [
+                i for i in search_connections(dest_airport.icao, orig_airport.icao, dates['return'].date(), travellers)
+                if i.stops
+            ]
+
+        # Cheapest valid pairs across both week strips, each bookable as is
+        pairs = []
+        if dates.get('return'):
+            pairs = round_trip_pairs(orig_airport, dest_airport, dates['depart'], dates['return'], travellers)
 
-        depart_choices = request.session['depart_choices'] = [(str(s.id), '') for s in results['depart']]
-        return_choices = request.session['return_choices'] = [(str(s.id), '') for s in results['return']]
-        form = FlightBookForm(depart_choices=depart_choices, return_choices=return_choices)
+        # Prices are posted back as signed quotes and the rest kept out of the
+        # session so that searching doesn't write to it
+        paired = [s for p in pairs for s in (p['depart'], p['return'])]
+        for s in results['depart'] + results['return'] + paired:
+            s.quote = issue_quote(s, travellers)
+        token = save_search(request.get_full_path(), bool(dates.get('return')))
+        form = FlightBookForm(initial={'search': token}, return_trip=bool(dates.get('return')))
 
         context = {
             'is_customer': request.session.get('customer_id') is not None,
             'search': search,
             'results': results,
+            'connections': connections,
+            'pairs': pairs,
             'week_price_avail': week_price_avail,
             'form': form,
             'messages': messages.get_messages(request),
@@ -173,16 +299,26 @@ def flights(request):
         return render(request, 'flights.html', context)
 
     else:  # POST - process form submission
-        form = FlightBookForm(
-            request.POST,
-            depart_choices=request.session.get('depart_choices'),
-            return_choices=request.session.get('return_choices')
-        )
+        search = load_search(request.POST.get('search'))
+        if search is None:
+            return render(
+                request,
+                'error.html',
+                {
+                    'h2': 'Search expired',
+                    'errors': ['Your search has expired, please search again.'],
+                    'link': 'index',
+                    'link_text': 'Search again'
+                })
+
+        form = FlightBookForm(request.POST, return_trip=search['return_trip'])
 
         if form.is_valid():
+            depart_quote = form.cleaned_data['select_depart']
+            return_quote = form.cleaned_data.get('select_return')
             depart_schedule, return_schedule = get_schedules(
-                form.cleaned_data['select_depart'],
-                form.cleaned_data.get('select_return'),
+                depart_quote['schedule_id'],
+                return_quote['schedule_id'] if return_quote else None,
                 include_None=True
             )
             depart_seats = depart_schedule.seats_avail
@@ -197,21 +333,22 @@ def flights(request):
                 form.add_error('select_return', 'Return flight must depart after outbound flight arrives.')
 
             if not form.errors:
-                request.session['booking'] = get_booking_dict(
-                    request.session.get('prices'),
-                    request.session.get('travellers'),
-                    depart_schedule.id,
-                    depart_seats,
-                    return_schedule.id if return_schedule else None,
-                    return_seats
-                )
-                return redirect('register')
+                # Book as many seats as are left
+                tickets = min(depart_seats, return_seats or depart_seats)
+                depart_quote = limit_quote(depart_quote, tickets)
+                return_quote = return_quote and limit_quote(return_quote, tickets)
+                # The quotes go on with the customer, not in the session
+                tokens = {'depart': depart_quote['token'], 'return': return_quote and return_quote['token']}
+                query = quotes_query(tokens, request.POST['search'])
+                response = redirect(f"{reverse('register')}?{query}")
+                response.set_cookie(BOOKING_COOKIE, query, max_age=settings.SESSION_COOKIE_AGE, httponly=True)
+                return response
 
         # GET + messages to keep query params
         for errs in form.errors.values():
             for err in errs:
                 messages.error(request, err)
-        return redirect(request.session.get('search_path'))
+        return redirect(search['path'])
 
 
 @require_http_methods(['GET', 'POST'])
@@ -221,24 +358,26 @@ def register(request):
     POST: Validate form (unique email) and proceed to index or
           confirmation, depending on whether a booking is in process.
     """
-    booking = request.session.get('booking')
-    if not booking:
+    quotes_form = QuotesForm(request.POST if request.method == 'POST' else request.GET, auto_id=False)
+    try:
+        depart_quote, return_quote, _ = verify_quotes(quotes_form.tokens())
+    except signing.BadSignature:
         return redirect('index')
-
-    if request.GET.get('action') == 'modify':
-        # User clicked 'go back'
-        if sp := request.session.get('search_path'):
-            return redirect(sp)
+    booking = get_booking_dict(depart_quote, return_quote)
 
     schedules = get_schedules(booking['depart_id'], booking['return_id'])
     email_form = EmailForm(request.POST or None)
     customer_form = CustomerDetailsForm(request.POST or None)
+    confirm_url = f"{reverse('confirm')}?{quotes_query(quotes_form.tokens(), quotes_form.search_token())}"
 
     context = {
         'booking': booking,
         'schedules': schedules,
         'email_form': email_form,
-        'customer_form': customer_form
+        'customer_form': customer_form,
+        'quotes_form': quotes_form,
+        'confirm_url': confirm_url,
+        'search_url': search_path(quotes_form.search_token(), reverse('index'))
     }
 
     if cid := request.session.get('customer_id', None):
@@ -246,7 +385,7 @@ def register(request):
 
     def confirm_as(new_id):
         request.session['customer_id'] = new_id
-        return redirect('confirm')
+        return redirect(confirm_url)
 
     if request.method == 'POST':
         if customer_form.is_valid():
@@ -324,9 +463,11 @@ def confirm(request):
           and show invoice.
     """
     customer_id = request.session.get('customer_id')
-    booking = request.session.get('booking')
+    quotes_form = QuotesForm(request.POST if request.method == 'POST' else request.GET)
+    tokens = quotes_form.tokens()
+    search = quotes_form.search_token()
 
-    if request.method == 'POST' and not booking:
+    if request.method == 'POST' and tokens['depart'] is None:
         return render(
             request,
             'error.html',
@@ -336,41 +477,85 @@ def confirm(request):
                 'link': 'bookings',
                 'link_text': 'All bookings'
             })
-    if not booking:
+    if tokens['depart'] is None:
         return redirect('index')
     if not customer_id:
-        return redirect('register')
+        return redirect(f"{reverse('register')}?{quotes_query(tokens, search)}")
+
+    def error_page(h2, errors):
+        response = render(
+            request,
+            'error.html',
+            {
+                'h2': h2,
+                'errors': errors,
+                'link': 'index',
+                'link_text': 'Search again'
+            })
+        response.delete_cookie(BOOKING_COOKIE)
+        return response
+
+    # The quotes are what the customer books and pays
+    try:
+        depart_quote, return_quote, repriced = verify_quotes(tokens)
+    except signing.BadSignature:
+        return error_page('Error', ['Invalid fare quote.'])
+    tokens = {'depart': depart_quote['token'], 'return': return_quote and return_quote['token']}
+    booking = get_booking_dict(depart_quote, return_quote)
 
     customer = m.Customer.objects.get(id=customer_id)
     form = ConfirmForm(request.POST or None)
 
-    if request.method == 'GET' or not form.is_valid():
+    def confirm_page(repriced=False):
         context = {
             'schedules': get_schedules(booking['depart_id'], booking['return_id']),
             'booking': booking,
             'customer': customer,
-            'form': form
+            'form': form,
+            'quotes_form': QuotesForm(
+                initial={'depart_quote': tokens['depart'], 'return_quote': tokens['return'], 'search': search},
+                auto_id=False
+            ),
+            'register_url': f"{reverse('register')}?{quotes_query(tokens, search)}",
+            'search_url': search_path(search, reverse('index')),
+            'repriced': repriced
         }
         return render(request, 'confirm.html', context)
-    
-    ref = book_flight(
-        tickets=booking['tickets'],
-        customer=customer,
-        depart_schedule=booking['depart_id'],
-        depart_price=booking['prices']['depart'],
-        return_schedule=booking['return_id'],
-        return_price=booking['prices']['return']
-    )
-    del request.session['booking']
+
+    if repriced:
+        return confirm_page(repriced=True)
+
+    if request.method == 'GET' or not form.is_valid():
+        return confirm_page()
+
+    try:
+        ref = book_flight(
+            tickets=booking['tickets'],
+            customer=customer,
+            depart_schedule=booking['depart_id'],
+            depart_price=depart_quote['price'],
+            return_schedule=booking['return_id'],
+            return_price=return_quote['price'] if return_quote else None
+        )
+    except SoldOut as e:
+        return error_page(
+            'Sold out',
+            [
+                f'Sorry, flight {e.schedule.flight_no} no longer has {booking["tickets"]} '
+                f'seat{"s" if booking["tickets"] > 1 else ""} available.'
+            ])
     request.session['book_ref'] = ref
-    return redirect('bookings')
+    response = redirect('bookings')
+    response.delete_cookie(BOOKING_COOKIE)
+    return response
 
 
 @require_http_methods(['GET', 'POST'])
 def bookings(request):
     """
-    GET:  Show bookings if customer exists in session - book_ref and cancel_ref tell the
-          template whether to display a thank you or confirmation message.
+    GET:  Show a page of bookings if customer exists in session, older pages following
+          the `after` cursor - book_ref and cancel_ref tell the template whether to
+          display a thank you or confirmation message.
     POST: Validate then cancel a booking
     """
     err = render(
@@ -407,13 +592,14 @@ def bookings(request):
         request.session['cancel_ref'] = ref
         return redirect('bookings')
 
-    bookings = (
-        m.Booking.objects
-        .select_related('depart_schedule', 'return_schedule')
-        .filter(customer=customer)
-    )
+    after = request.GET.get('after')
+    bookings, next_cursor = bookings_page(customer, after)
+
     context = {
         'bookings': bookings,
+        'n_bookings': bookings_count(customer),
+        'after': after,
+        'next_cursor': next_cursor,
         'customer': customer,
         'is_customer': True,
         'book_ref': request.session.pop('book_ref', None),
@@ -446,6 +632,7 @@ def invoice(request):
         schedules = [booking.depart_schedule]
         if booking.return_schedule:
             schedules.append(booking.return_schedule)
+        reference_data.attach(*schedules)
 
         context = {'booking': booking, 'schedules': schedules, 'prices': prices, 'customer': customer }
         return render(request, 'invoice.html', context)
@@ -453,3 +640,14 @@ def invoice(request):
         err.update({'errors': ['Invalid booking reference.']})
         return render(request, 'error.html', err)
 
+
+
+@require_GET
+def metrics(request):
+    """
+    Expose app.metrics in Prometheus text format to internal addresses.
+    """
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+
+    return HttpResponse(app_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -2,12 +2,28 @@
 Utility functions for views.py.
 """
 
+import os
+import re
+import heapq
+import threading
 from typing import Optional
+from urllib.parse import urlencode
+from functools import cached_property
 from datetime import datetime, date, timedelta, timezone
 gmt = timezone.utc
 
+from django.core import signing
+from django.core.cache import cache, caches
+from django.utils.connection import ConnectionProxy
+from django.db import IntegrityError, transaction
+from django.utils.crypto import salted_hmac
+from django.db.models import Count, F, Max, Min, Q
+
 import app.models as m
-from app.utils import gmt_range_about, generate_booking_ref
+from app.utils import permute_ref
+from app.registry import reference_data, route_version, aroute_version, bump_route_version
+from app.metrics import metrics
+from app.singleflight import single_flight, asingle_flight
 
 
 class ParamErrors(Exception):
@@ -15,17 +31,25 @@ class ParamErrors(Exception):
         self.param_errs = param_errs
 
 
-def validate_airports(origin: str, destination: str) -> list:
+class SoldOut(Exception):
+    def __init__(self, schedule):
+        self.schedule = schedule
+
+
+def validate_airports(origin: str, destination: str, airports: Optional[dict]=None) -> list:
+    """
+    `airports` defaults to reference_data.airports(); async views pass their own.
+    """
     param_errs, orig_airport, dest_airport = [], None, None
+    airports = reference_data.airports() if airports is None else airports
 
     if origin and destination:
-        try:
-            orig_airport = m.Airport.objects.get(icao=origin)
-            dest_airport = m.Airport.objects.get(icao=destination)
-            if orig_airport == dest_airport:
-                param_errs.append('Origin and destination cannot be the same.')
-        except m.Airport.DoesNotExist:
+        orig_airport = airports.get(origin)
+        dest_airport = airports.get(destination)
+        if orig_airport is None or dest_airport is None:
             param_errs.append('Invalid origin and/or destination.')
+        elif orig_airport == dest_airport:
+            param_errs.append('Origin and destination cannot be the same.')
     else:
         param_errs.append('Origin and destination are required.')
 
@@ -89,31 +113,181 @@ def fix_date_errors(dates: dict, search: dict) -> tuple[bool, dict]:
     return date_err, search
 
 
-def flights_on_date(
-    date: date,
-    depart_gmt_offset: str,
+# Results keyed by route and registry versions; each process may keep its own
+data_cache = ConnectionProxy(caches, 'data')
+
+FLIGHT_DATES_TTL = 5 * 60  # seconds
+
+
+async def aavailable_dates(origin: str, destination: str, now: datetime) -> list[date]:
+    """
+    Local dates from today (`now` at the origin) with non-full flights on a route,
+    read from RouteAvailability with the async ORM. Today counts only until its
+    last flight with seats departs. Cached under the route's inventory version and
+    coalesced across concurrent lookups.
+    """
+    today = now.date()
+    key = f'flight_dates:{origin}:{destination}:{today.isoformat()}:{await aroute_version(origin, destination)}'
+
+    async def compute():
+        dates = [
+            d async for d in
+            m.RouteAvailability.objects
+            .filter(
+                dep_icao=origin,
+                arr_icao=destination,
+                local_date__gte=today,
+                flights__gte=1
+            )
+            .order_by('local_date')
+            .values_list('local_date', flat=True)
+        ]
+        # RouteAvailability counts the whole day, including flights already departed
+        last_dep = None
+        if dates and dates[0] == today:
+            last_dep = (await m.Schedule.objects.filter(
+                dep_icao=origin,
+                arr_icao=destination,
+                dep_local_date=today,
+                seats_avail__gte=1
+            ).aaggregate(last_dep=Max('dep_dt')))['last_dep']
+        await data_cache.aset(key, (dates, last_dep), FLIGHT_DATES_TTL)
+        return dates, last_dep
+
+    async def cached():
+        return await data_cache.aget(key)
+
+    entry = await cached()
+    metrics.inc('app_cache_requests_total', cache='flight_dates', result='miss' if entry is None else 'hit')
+    dates, last_dep = entry if entry is not None else await asingle_flight(key, compute, cached)
+    if dates and dates[0] == today and (last_dep is None or last_dep < now):
+        dates = dates[1:]
+    return dates
+
+
+FLIGHTS_CACHE_BUCKET = 60  # seconds; prices drift with the clock
+
+FLIGHTS_FIELDS = [
+    'id', 'flight_no', 'dep_dt', 'arr_dt', 'seats_avail', 'aircraft_id', 'dep_icao_id', 'arr_icao_id',
+    'base_price', 'dep_local_date', 'price'
+]
+
+
+def flights_by_day(
+    days: list[date],
     origin: str,
     destination: str,
-    remove_before_now=False
-) -> list[m.Schedule]:
+    now: datetime
+) -> dict[date, list[m.Schedule]]:
     """
-    Query flights within 24 hours w.r.t. the departure timezone
+    Flights on a route by local departure date, priced at the start of the time
+    bucket of `now`. Days are cached under the route's inventory version, so
+    bookings and cancellations are never served stale, and the days not cached
+    are read with a single range query, coalesced across concurrent searches.
     """
-    start, end = gmt_range_about(date, depart_gmt_offset)
-    if remove_before_now:
-        now = datetime.now(gmt)
-        if start < now:
-            start = now
-
-    schedules = list(
-        m.Schedule.objects.filter(
-            dep_icao=origin,
-            arr_icao=destination,
-            dep_dt__gte=start,
-            dep_dt__lt=end,
+    bucket = int(now.timestamp()) // FLIGHTS_CACHE_BUCKET
+    priced_at = datetime.fromtimestamp(bucket * FLIGHTS_CACHE_BUCKET, gmt)
+    version = route_version(origin, destination)
+    keys = {d: f'flights:{origin}:{destination}:{d.isoformat()}:{version}:{bucket}' for d in days}
+
+    rows = data_cache.get_many(keys.values())
+    metrics.inc('app_cache_requests_total', len(rows), cache='flights', result='hit')
+    if missing := [d for d in days if keys[d] not in rows]:
+        metrics.inc('app_cache_requests_total', len(missing), cache='flights', result='miss')
+        missing_keys = [keys[d] for d in missing]
+
+        def cached():
+            found = data_cache.get_many(missing_keys)
+            return found if len(found) == len(missing_keys) else None
+
+        def compute():
+            found = {key: [] for key in missing_keys}
+            schedules = (
+                m.Schedule.objects
+                .with_price(priced_at)
+                .filter(
+                    dep_icao=origin,
+                    arr_icao=destination,
+                    dep_local_date__gte=min(missing),
+                    dep_local_date__lte=max(missing),
+                )
+                .order_by('dep_dt')
+                .values_list(*FLIGHTS_FIELDS)
+            )
+            for s in schedules:
+                if (key := keys.get(s[-2])) in found:
+                    found[key].append(s)
+            data_cache.set_many(found, timeout=2 * FLIGHTS_CACHE_BUCKET)
+            return found
+
+        key = f'flights:{origin}:{destination}:{",".join(d.isoformat() for d in missing)}:{version}:{bucket}'
+        rows.update(single_flight(key, compute, cached))
+
+    flights = {}
+    for d in days:
+        flights[d] = []
+        for row in rows[keys[d]]:
+            s = m.Schedule(**dict(zip(FLIGHTS_FIELDS[:-1], row)))
+            s.price = row[-1]
+            reference_data.attach(s)
+            flights[d].append(s)
+    return flights
+
+
+FARE_CALENDAR_DAYS = 90
+
+FARE_CALENDAR_MAX_DAYS = 366
+
+
+async def afare_calendar(
+    origin: str,
+    destination: str,
+    start: date,
+    days: int,
+    now: datetime
+) -> list[tuple[date, float, bool]]:
+    """
+    (local date, price, available) for each day with flights on a route in the
+    `days` from `start`, as in price_availability: the lowest current price among
+    flights with seats, else among all of them. One query grouped by local
+    departure date, cached like flights_by_day under the route's inventory
+    version and the time bucket of `now`.
+    """
+    bucket = int(now.timestamp()) // FLIGHTS_CACHE_BUCKET
+    priced_at = datetime.fromtimestamp(bucket * FLIGHTS_CACHE_BUCKET, gmt)
+    version = await aroute_version(origin, destination)
+    key = f'fare_calendar:{origin}:{destination}:{start.isoformat()}:{days}:{version}:{bucket}'
+
+    async def compute():
+        seats = Q(seats_avail__gte=1)
+        rows = (
+            m.Schedule.objects
+            .with_price(priced_at)
+            .filter(
+                dep_icao=origin,
+                arr_icao=destination,
+                dep_local_date__gte=start,
+                dep_local_date__lt=start + timedelta(days=days),
+                dep_dt__gte=priced_at,
+            )
+            .values('dep_local_date')
+            .annotate(avail_price=Min('price', filter=seats), min_price=Min('price'))
+            .order_by('dep_local_date')
         )
-    )
-    return schedules
+        calendar = [
+            (row['dep_local_date'], row['min_price'] if row['avail_price'] is None else row['avail_price'],
+             row['avail_price'] is not None)
+            async for row in rows
+        ]
+        await data_cache.aset(key, calendar, 2 * FLIGHTS_CACHE_BUCKET)
+        return calendar
+
+    async def cached():
+        return await data_cache.aget(key)
+
+    calendar = await cached()
+    metrics.inc('app_cache_requests_total', cache='fare_calendar', result='miss' if calendar is None else 'hit')
+    return calendar if calendar is not None else await asingle_flight(key, compute, cached)
 
 
 def flights_in_week(
@@ -124,38 +298,38 @@ def flights_in_week(
     remove_before_now=False
 ) -> list[tuple[date, list[m.Schedule]]]:
     """
-    Query flights in week about `date`
+    Flights in week about `date`, bucketed by local departure date w.r.t. the
+    departure timezone
     """
-    result = []
-    for d in range(-3, 4):
-        curr = date + timedelta(days=d)
-        if remove_before_now and curr.date() < datetime.now(gmt).date():
-            s = []
-        else:
-            s = flights_on_date(
-                curr,
-                depart_gmt_offset,
-                origin,
-                destination,
-                remove_before_now=remove_before_now
-            )
-        result.append((curr.date(), s))
-    
-    return result
+    now = datetime.now(gmt)
+    days = [(date + timedelta(days=d)).date() for d in range(-3, 4)]
+    buckets = flights_by_day(days, origin, destination, now)
+
+    if remove_before_now:
+        for d in days:
+            if d < now.date():
+                buckets[d] = []
+            else:
+                buckets[d] = [s for s in buckets[d] if s.dep_dt >= now]
+
+    return [(d, buckets[d]) for d in days]
 
 
 
 def price_availability(schedules: list[m.Schedule]) -> tuple[Optional[float], bool]:
+    """
+    Schedules must be annotated with `price` (see ScheduleQuerySet.with_price)
+    """
     # No flights
     if not schedules:
         return None, False
 
     # Flight(s) with seats -> show minimum price with seats
-    if avail_prices := [s.current_price for s in schedules if s.seats_avail >= 1]:
+    if avail_prices := [s.price for s in schedules if s.seats_avail >= 1]:
         return min(avail_prices), True
 
     # Flight(s) but no seats -> show old min price
-    return min(s.current_price for s in schedules), False
+    return min(s.price for s in schedules), False
 
 
 def get_result_price_avail(
@@ -186,6 +360,7 @@ def get_schedules(
 
     depart_schedule = m.Schedule.objects.get(id=depart_id)
     return_schedule = m.Schedule.objects.get(id=return_id) if return_id else None
+    reference_data.attach(depart_schedule, return_schedule)
 
     if not include_None and not return_schedule:
         return [depart_schedule]
@@ -201,34 +376,340 @@ def get_price_dict(tickets: int, depart_price: float, return_price: Optional[flo
     }
 
 
-def get_booking_dict(
-    prices: dict,
+ROUND_TRIP_PAIRS = 5
+
+
+def cheapest_pairs(
+    outbound: list[m.Schedule],
+    inbound: list[m.Schedule],
     travellers: int,
-    depart_schedule_id: int,
-    depart_seats: int,
-    return_schedule_id: Optional[int]=None,
-    return_seats: Optional[int]=None
-) -> dict:
+    n: int=ROUND_TRIP_PAIRS
+) -> list[tuple[m.Schedule, m.Schedule]]:
+    """
+    The n cheapest (outbound, return) pairs, by `price`, in which the return departs
+    after the outbound arrives and both have seats for `travellers`. Returns are
+    swept in departure order while outbounds are admitted in arrival order, so
+    each return is priced against the n cheapest outbounds admitted so far:
+    O((o + r) log n + r n log n) rather than o * r.
+    """
+    outbound = sorted((s for s in outbound if s.seats_avail >= travellers), key=lambda s: s.arr_dt)
+    inbound = sorted((s for s in inbound if s.seats_avail >= travellers), key=lambda s: s.dep_dt)
+
+    admitted = []  # Max-heap of the n cheapest outbounds as (-price, index)
+    best = []  # Max-heap of the n cheapest pairs as (-total, -return index, -outbound index)
+    i = 0
+    for j, r in enumerate(inbound):
+        while i < len(outbound) and outbound[i].arr_dt < r.dep_dt:
+            heapq.heappush(admitted, (-outbound[i].price, i))
+            if len(admitted) > n:
+                heapq.heappop(admitted)
+            i += 1
+
+        for neg_price, k in admitted:
+            pair = (neg_price - r.price, -j, -k)
+            if len(best) < n:
+                heapq.heappush(best, pair)
+            elif pair > best[0]:
+                heapq.heapreplace(best, pair)
+
+    return [(outbound[-k], inbound[-j]) for _, j, k in sorted(best, reverse=True)]
+
+
+def round_trip_pairs(
+    orig_airport: m.Airport,
+    dest_airport: m.Airport,
+    depart_date: datetime,
+    return_date: datetime,
+    travellers: int,
+    n: int=ROUND_TRIP_PAIRS
+) -> list[dict]:
+    """
+    The n cheapest round trips departing within 3 days of `depart_date` and
+    returning within 3 days of `return_date`, i.e. over the flights page's week
+    strips, with prices per traveller and in total.
+    """
+    outbound = flights_in_week(depart_date, orig_airport.gmt_offset, orig_airport.icao, dest_airport.icao, True)
+    inbound = flights_in_week(return_date, dest_airport.gmt_offset, dest_airport.icao, orig_airport.icao, True)
+    pairs = cheapest_pairs(
+        [s for _, day in outbound for s in day],
+        [s for _, day in inbound for s in day],
+        travellers,
+        n
+    )
+    return [
+        {
+            'depart': o,
+            'return': r,
+            'price': round(o.price + r.price, 2),
+            'total': round(get_price_dict(travellers, o.price, r.price)['total'], 2),
+        }
+        for o, r in pairs
+    ]
+
+
+SEARCH_SALT = 'app.views_utils.search'
+
+SEARCH_TTL = 30 * 60  # seconds
+
+
+def save_search(path: str, return_trip: bool) -> str:
+    """
+    Sign the context of a flights search into a token for the results form, so that
+    it isn't written to the session until a flight is selected and any worker can
+    read it back. Prices are carried by the fare quotes of the results instead.
+    """
+    return signing.dumps([path, return_trip], salt=SEARCH_SALT, compress=True)
+
+
+def load_search(token: Optional[str]) -> Optional[dict]:
+    """
+    The search signed into `token`, or None if it's invalid or older than SEARCH_TTL.
+    """
+    try:
+        path, return_trip = signing.loads(token or '', salt=SEARCH_SALT, max_age=SEARCH_TTL)
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+    return {'path': path, 'return_trip': return_trip}
+
+
+def search_path(token: Optional[str], default: str) -> str:
     """
-    Create a booking with the advertised price and correct number of seats
+    The path of the search signed into `token`, to go back to from the booking funnel.
+    """
+    search = load_search(token)
+    return search['path'] if search else default
+
+
+QUOTE_SALT = 'app.views_utils.fare_quote'
+
+QUOTE_TTL = 20 * 60  # seconds
+
+# Cookie remembering the quotes of a booking in progress, for the index page
+BOOKING_COOKIE = 'booking_quotes'
+
+
+def issue_quote(schedule: m.Schedule, tickets: int) -> str:
+    """
+    Sign a fare quote for `tickets` seats on `schedule` at its annotated price. The
+    signature is timestamped with the issue time.
+    """
+    return signing.dumps([schedule.id, schedule.price, tickets], salt=QUOTE_SALT)
+
+
+def read_quote(token: str, max_age: Optional[int]=QUOTE_TTL) -> dict:
+    """
+    Raises signing.SignatureExpired if the quote is older than `max_age` and
+    signing.BadSignature if it wasn't issued here.
+    """
+    try:
+        schedule_id, price, tickets = signing.loads(token, salt=QUOTE_SALT, max_age=max_age)
+    except (TypeError, ValueError):
+        raise signing.BadSignature('Malformed fare quote')
+    return {'schedule_id': schedule_id, 'price': price, 'tickets': tickets, 'token': token}
+
+
+def limit_quote(quote: dict, tickets: int) -> dict:
+    """
+    The fare quote for at most `tickets` seats at the quoted price, e.g. when fewer
+    seats are left than were searched for.
+    """
+    if quote['tickets'] <= tickets:
+        return quote
+    return read_quote(signing.dumps([quote['schedule_id'], quote['price'], tickets], salt=QUOTE_SALT))
+
+
+def verify_quotes(tokens: dict) -> tuple[dict, Optional[dict], bool]:
     """
-    depart_price = prices[str(depart_schedule_id)]
-    return_price = prices[str(return_schedule_id)] if return_schedule_id else None
-    tickets = min(travellers, depart_seats, return_seats or float('inf'))
+    Verify the fare quote `tokens` of a booking, as carried by the register and
+    confirm forms, and return the quotes of the outbound and return flights, and
+    whether any had expired and were re-issued at a different price. Raises
+    signing.BadSignature if the outbound quote is missing or a quote is forged.
+    """
+    if tokens.get('depart') is None:
+        raise signing.BadSignature('Missing fare quote')
+
+    quotes, repriced = {}, False
+    for leg in ['depart', 'return']:
+        if (token := tokens.get(leg)) is None:
+            quotes[leg] = None
+            continue
+
+        try:
+            quote = read_quote(token)
+        except signing.SignatureExpired:
+            expired = read_quote(token, max_age=None)
+            schedule = m.Schedule.objects.with_price().get(id=expired['schedule_id'])
+            quote = read_quote(issue_quote(schedule, expired['tickets']))
+            repriced = repriced or quote['price'] != expired['price']
+        quotes[leg] = quote
+
+    return quotes['depart'], quotes['return'], repriced
+
+
+def quotes_query(tokens: dict, search: Optional[str]=None) -> str:
+    """
+    Fare quote tokens, and the search they were selected from, as a query string,
+    as they're carried from page to page of the booking funnel rather than in the
+    session.
+    """
+    query = {f'{leg}_quote': token for leg, token in tokens.items() if token}
+    if search:
+        query['search'] = search
+    return urlencode(query)
+
+
+def get_booking_dict(depart_quote: dict, return_quote: Optional[dict]=None) -> dict:
+    """
+    Create a booking from the fare quotes, for the seats quoted on every flight
+    """
+    tickets = min(depart_quote['tickets'], return_quote['tickets'] if return_quote else float('inf'))
     booking = {
-        'depart_id': depart_schedule_id,
-        'return_id': return_schedule_id,
+        'depart_id': depart_quote['schedule_id'],
+        'return_id': return_quote['schedule_id'] if return_quote else None,
         'tickets': tickets,
-        'prices': get_price_dict(tickets, depart_price, return_price)
+        'prices': get_price_dict(
+            tickets, depart_quote['price'], return_quote['price'] if return_quote else None
+        ),
     }
     return booking
 
 
-def unique_booking_ref(length=6):
-    while True:
-        booking_ref = generate_booking_ref(length)
-        if not m.Booking.objects.filter(ref=booking_ref).exists():
-            return booking_ref
+def availability_key(schedule: m.Schedule) -> tuple[str, str, date]:
+    return schedule.dep_icao_id, schedule.arr_icao_id, schedule.dep_local_date
+
+
+def refresh_availability(*schedules: Optional[m.Schedule]) -> None:
+    """
+    Recompute the RouteAvailability row for the route and local departure date
+    of each schedule from that day's Schedule rows.
+    """
+    for origin, destination, local_date in {availability_key(s) for s in schedules if s}:
+        summary = (
+            m.Schedule.objects
+            .filter(
+                dep_icao=origin,
+                arr_icao=destination,
+                dep_local_date=local_date,
+            )
+            .aggregate(
+                total=Count('id'),
+                flights=Count('id', filter=Q(seats_avail__gte=1)),
+                min_fare=Min('base_price', filter=Q(seats_avail__gte=1)),
+            )
+        )
+        key = {'dep_icao_id': origin, 'arr_icao_id': destination, 'local_date': local_date}
+
+        if summary['total'] == 0:
+            m.RouteAvailability.objects.filter(**key).delete()
+        else:
+            m.RouteAvailability.objects.update_or_create(
+                **key,
+                defaults={'flights': summary['flights'], 'min_fare': summary['min_fare']}
+            )
+
+
+def rebuild_availability() -> None:
+    """
+    Recompute RouteAvailability from all of Schedule, e.g. after generating schedules,
+    grouped by route and local departure date in the database.
+    """
+    seats = Q(seats_avail__gte=1)
+    summary = {
+        (row['dep_icao'], row['arr_icao'], row['dep_local_date']): (row['flights'], row['min_fare'])
+        for row in (
+            m.Schedule.objects
+            .values('dep_icao', 'arr_icao', 'dep_local_date')
+            .annotate(flights=Count('id', filter=seats), min_fare=Min('base_price', filter=seats))
+            .order_by()
+        )
+    }
+
+    with transaction.atomic():
+        m.RouteAvailability.objects.all().delete()
+        m.RouteAvailability.objects.bulk_create(
+            [
+                m.RouteAvailability(
+                    dep_icao_id=dep_icao,
+                    arr_icao_id=arr_icao,
+                    local_date=local_date,
+                    flights=flights,
+                    min_fare=min_fare
+                )
+                for (dep_icao, arr_icao, local_date), (flights, min_fare) in summary.items()
+            ],
+            batch_size=1000
+        )
+    bump_route_version(*{(dep_icao, arr_icao) for dep_icao, arr_icao, _ in summary})
+
+
+class BookingRefAllocator:
+    """
+    Unique booking references without lookup queries: each process reserves a
+    block of counter values from Counter and maps them through permute_ref.
+    The Booking primary key remains the backstop for uniqueness.
+    """
+    counter = 'booking_ref'
+
+    def __init__(self, block_size=100):
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._next = self._end = 0
+
+    def reserve_block(self) -> tuple[int, int]:
+        with transaction.atomic():
+            m.Counter.objects.get_or_create(name=self.counter)
+            m.Counter.objects.filter(name=self.counter).update(value=F('value') + self.block_size)
+            end = m.Counter.objects.get(name=self.counter).value
+        return end - self.block_size, end
+
+    def next_ref(self) -> str:
+        with self._lock:
+            # Blocks must not be shared with forked workers
+            if self._next >= self._end or self._pid != os.getpid():
+                self._next, self._end = self.reserve_block()
+                self._pid = os.getpid()
+            n = self._next
+            self._next += 1
+        return permute_ref(n, self.key)
+
+    @cached_property
+    def key(self) -> bytes:
+        return salted_hmac('app.views_utils.BookingRefAllocator', self.counter).digest()
+
+
+booking_refs = BookingRefAllocator()
+
+
+def reserve_seats(schedule: m.Schedule, tickets: int) -> None:
+    """
+    Decrement seats_avail in a single conditional UPDATE so that concurrent
+    bookings can't oversell. Raises SoldOut if fewer than `tickets` remain.
+    """
+    updated = (
+        m.Schedule.objects
+        .filter(id=schedule.id, seats_avail__gte=tickets)
+        .update(seats_avail=F('seats_avail') - tickets)
+    )
+    if not updated:
+        metrics.inc('app_sold_out_total')
+        raise SoldOut(schedule)
+    schedule.seats_avail -= tickets
+
+
+def release_seats(schedule: m.Schedule, tickets: int) -> None:
+    m.Schedule.objects.filter(id=schedule.id).update(seats_avail=F('seats_avail') + tickets)
+    schedule.seats_avail += tickets
+
+
+def bump_inventory(*schedules: Optional[m.Schedule]) -> None:
+    """
+    Bump the inventory version of the schedules' routes now and again on commit,
+    so a search between the two can't cache the old seats under the new version.
+    """
+    routes = {(s.dep_icao_id, s.arr_icao_id) for s in schedules if s}
+    bump_route_version(*routes)
+    transaction.on_commit(lambda: bump_route_version(*routes))
 
 
 def book_flight(
@@ -247,7 +728,7 @@ def book_flight(
         return_schedule = m.Schedule.objects.get(id=return_schedule)
 
     booking = m.Booking(
-        ref=unique_booking_ref(),
+        ref=booking_refs.next_ref(),
         tickets=tickets,
         customer=customer,
         depart_schedule=depart_schedule,
@@ -255,20 +736,112 @@ def book_flight(
         depart_price=depart_price,
         return_price=return_price
     )
-    booking.save()
-
-    for schedule in [depart_schedule, return_schedule]:
-        if schedule:
-            schedule.seats_avail -= tickets
-            schedule.save()
 
+    with transaction.atomic():
+        for schedule in [depart_schedule, return_schedule]:
+            if schedule:
+                reserve_seats(schedule, tickets)
+
+        # Retry on the rare collision with a reference issued before the allocator
+        for attempt in range(3):
+            try:
+                with transaction.atomic():
+                    booking.save(force_insert=True)
+                break
+            except IntegrityError:
+                if attempt == 2:
+                    raise
+                booking.ref = booking_refs.next_ref()
+
+        refresh_availability(depart_schedule, return_schedule)
+        bump_inventory(depart_schedule, return_schedule)
+        forget_bookings_count(customer.id)
+
+    metrics.inc('app_bookings_created_total')
     return booking.ref
 
 
 def delete_booking(booking: m.Booking) -> None:
-    for schedule in [booking.depart_schedule, booking.return_schedule]:
-        if schedule:
-            schedule.seats_avail += booking.tickets
-            schedule.save()
-    booking.delete()
+    with transaction.atomic():
+        for schedule in [booking.depart_schedule, booking.return_schedule]:
+            if schedule:
+                release_seats(schedule, booking.tickets)
+        booking.delete()
+        refresh_availability(booking.depart_schedule, booking.return_schedule)
+        bump_inventory(booking.depart_schedule, booking.return_schedule)
+        forget_bookings_count(booking.customer_id)
+
+    metrics.inc('app_bookings_cancelled_total')
+
+
+
+BOOKINGS_PAGE_SIZE = 20
+
+BOOKINGS_COUNT_TTL = 60 * 60  # seconds; bookings and cancellations also clear it
+
+BOOKINGS_CURSOR = re.compile(r'(\d+)-([0-9A-Z]{1,6})')
 
+EPOCH = datetime(1970, 1, 1, tzinfo=gmt)
+
+
+def bookings_cursor(booking: m.Booking) -> str:
+    """
+    Position after `booking` in a customer's bookings, newest first.
+    """
+    return f'{(booking.created_at - EPOCH) // timedelta(microseconds=1)}-{booking.ref}'
+
+
+def bookings_page(
+    customer: m.Customer,
+    cursor: Optional[str]=None,
+    size: int=BOOKINGS_PAGE_SIZE
+) -> tuple[list[m.Booking], Optional[str]]:
+    """
+    Up to `size` of the customer's bookings after `cursor` (the first page if it's
+    missing or invalid) and the cursor for the next page, or None if this is the
+    last. Keyset pagination on (created_at, ref), so every page is an index range
+    of the same cost however long the history; airports and aircraft are attached
+    from the registry.
+    """
+    bookings = (
+        m.Booking.objects
+        .select_related('depart_schedule', 'return_schedule')
+        .filter(customer=customer)
+        .order_by('-created_at', '-ref')
+    )
+    if cursor and (match := BOOKINGS_CURSOR.fullmatch(cursor)):
+        try:
+            created_at = EPOCH + timedelta(microseconds=int(match[1]))
+        except (OverflowError, ValueError):
+            created_at = None  # Out of datetime's range
+        if created_at is not None:
+            bookings = bookings.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, ref__lt=match[2]))
+
+    bookings = list(bookings[:size + 1])
+    next_cursor = bookings_cursor(bookings[size - 1]) if len(bookings) > size else None
+    bookings = bookings[:size]
+    for b in bookings:
+        reference_data.attach(b.depart_schedule, b.return_schedule)
+    return bookings, next_cursor
+
+
+def bookings_count(customer: m.Customer) -> int:
+    """
+    Number of the customer's bookings, cached so paging through a long history
+    doesn't count it again for every page.
+    """
+    key = f'bookings_count:{customer.id}'
+    count = cache.get(key)
+    if count is None:
+        count = m.Booking.objects.filter(customer=customer).count()
+        cache.set(key, count, BOOKINGS_COUNT_TTL)
+    return count
+
+
+def forget_bookings_count(customer_id: int) -> None:
+    """
+    Clear the cached count now and again on commit, as in bump_inventory.
+    """
+    key = f'bookings_count:{customer_id}'
+    cache.delete(key)
+    transaction.on_commit(lambda: cache.delete(key))
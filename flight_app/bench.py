@@ -0,0 +1,417 @@
+"""
+Benchmark the endpoints in-process with the Django test client.
+
+A throwaway database (the TEST database in settings) is seeded at the given scale
+with dbprime's bulk generators, then a mix of user sessions is replayed against it:
+    search    index, destinations, flight_dates and a flights search
+    calendar  destinations and flight_dates for a few routes
+    book      flight_dates, flights search, select, register (login), confirm, bookings,
+              invoice and, for half, cancel
+    manage    bookings and invoice for an existing customer
+For each endpoint (method and URL name) the p50/p95/p99 latency, queries, SQL time and
+rows fetched per request are written as JSON. Pass --baseline with an earlier output
+to exit non-zero when an endpoint's p95 or queries per request regress.
+
+    python bench.py --bookings 100000 --sessions 2000 --seed 1 --output bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+from collections import defaultdict
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qsl, urlsplit
+gmt = timezone.utc
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'flight_app.settings')
+
+import django
+django.setup()
+
+from django.db import connection
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import resolve, reverse
+
+import dbprime
+import app.models as m
+from app.registry import reference_data, route_graph
+
+
+SESSIONS = 500
+
+WARMUP = 20
+
+# Scenario, weight
+MIX = [
+    ('search', 50),
+    ('calendar', 20),
+    ('book', 20),
+    ('manage', 10),
+]
+
+
+class CountingCursor:
+    """
+    Proxy for a DB-API cursor counting the rows fetched through it.
+    """
+    def __init__(self, cursor, recorder):
+        self._cursor = cursor
+        self._recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._recorder.rows += 1
+            yield row
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._recorder.rows += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        self._recorder.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._recorder.rows += len(rows)
+        return rows
+
+
+class Recorder:
+    """
+    Execute wrapper counting queries, SQL time and rows fetched.
+    """
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.rows = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        wrapper = context['cursor']
+        if not isinstance(wrapper.cursor, CountingCursor):
+            wrapper.cursor = CountingCursor(wrapper.cursor, self)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_time += time.perf_counter() - start
+            self.queries += 1
+
+
+class Bench:
+    """
+    Test client wrapper recording a sample per request, keyed by method and URL name.
+    """
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.recording = True
+
+    def request(self, client, method, path, data=None):
+        recorder = Recorder()
+        with connection.execute_wrapper(recorder):
+            start = time.perf_counter()
+            response = getattr(client, method.lower())(path, data)
+            elapsed = time.perf_counter() - start
+
+        if self.recording:
+            key = f'{method} {resolve(urlsplit(path).path).url_name}'
+            self.samples[key].append((elapsed, recorder.queries, recorder.sql_time, recorder.rows))
+        return response
+
+    def get(self, client, path, data=None):
+        return self.request(client, 'GET', path, data)
+
+    def post(self, client, path, data=None):
+        return self.request(client, 'POST', path, data)
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of sorted values.
+    """
+    k = max(0, min(len(values) - 1, round(p / 100 * len(values) + 0.5) - 1))
+    return values[k]
+
+
+def summarise(samples):
+    summary = {}
+    for key, rows in sorted(samples.items()):
+        latency = sorted(r[0] * 1000 for r in rows)
+        n = len(rows)
+        summary[key] = {
+            'requests': n,
+            'p50_ms': round(percentile(latency, 50), 3),
+            'p95_ms': round(percentile(latency, 95), 3),
+            'p99_ms': round(percentile(latency, 99), 3),
+            'mean_ms': round(sum(latency) / n, 3),
+            'queries_per_request': round(sum(r[1] for r in rows) / n, 2),
+            'max_queries': max(r[1] for r in rows),
+            'sql_ms_per_request': round(sum(r[2] for r in rows) * 1000 / n, 3),
+            'rows_per_request': round(sum(r[3] for r in rows) / n, 2),
+        }
+    return summary
+
+
+class Workload:
+    """
+    Random inputs drawn from the seeded database.
+    """
+    def __init__(self):
+        self.routes = [(o, d) for o in reference_data.airports() for d in route_graph.destinations(o)]
+        self.emails = list(m.Customer.objects.values_list('email', flat=True)[:1000])
+        self.bookings = list(m.Booking.objects.values_list('ref', 'customer_id')[:1000])
+        self.today = datetime.now(gmt).date()
+
+    def route(self):
+        return random.choice(self.routes)
+
+    def search_params(self):
+        origin, destination = self.route()
+        depart_date = self.today + timedelta(days=random.randint(0, dbprime.SCHEDULE_DAYS - 14))
+        params = {
+            'origin': origin,
+            'destination': destination,
+            'depart_date': depart_date.isoformat(),
+            'travellers': random.choice([1, 1, 1, 2, 2, 3, 4]),
+        }
+        if random.randint(0, 1):
+            params['return_date'] = (depart_date + timedelta(days=random.randint(1, 10))).isoformat()
+        return params
+
+
+def search(bench, work, client):
+    params = work.search_params()
+    bench.get(client, reverse('index'))
+    bench.get(client, reverse('destinations'), {'o': params['origin']})
+    bench.get(client, reverse('flight_dates'), {'o': params['origin'], 'd': params['destination']})
+    bench.get(client, reverse('flights'), params)
+
+
+def calendar(bench, work, client):
+    for _ in range(3):
+        origin, destination = work.route()
+        bench.get(client, reverse('destinations'), {'o': origin})
+        bench.get(client, reverse('flight_dates'), {'o': origin, 'd': destination})
+
+
+def book(bench, work, client):
+    # Pick dates the calendar marks available, as a user would, so the search has flights
+    origin, destination = work.route()
+    depart_dates = bench.get(client, reverse('flight_dates'), {'o': origin, 'd': destination}).json()['dates']
+    if not depart_dates:
+        return
+    depart_date = random.choice(depart_dates)
+    params = {
+        'origin': origin,
+        'destination': destination,
+        'depart_date': depart_date,
+        'travellers': random.choice([1, 1, 1, 2, 2, 3, 4]),
+    }
+    if random.randint(0, 1):
+        return_dates = bench.get(client, reverse('flight_dates'), {'o': destination, 'd': origin}).json()['dates']
+        if return_dates := [d for d in return_dates if d > depart_date]:
+            params['return_date'] = random.choice(return_dates)
+
+    response = bench.get(client, reverse('flights'), params)
+    if response.status_code != 200 or not response.context:
+        return
+    results = response.context['results']
+    depart = [s for s in results['depart'] if s.seats_avail >= params['travellers']]
+    return_ = [s for s in results['return'] if s.seats_avail >= params['travellers']]
+    if not depart or ('return_date' in params and not return_):
+        return
+
+    selection = {
+        'search': response.context['form'].initial['search'],
+        'select_depart': random.choice(depart).quote
+    }
+    if return_:
+        selection['select_return'] = random.choice(return_).quote
+    response = bench.post(client, reverse('flights'), selection)
+    if urlsplit(response.url).path != reverse('register'):
+        return  # Full or return departs before outbound arrives
+
+    # The fare quotes are carried by the query string and hidden fields
+    quotes = dict(parse_qsl(urlsplit(response.url).query))
+    response = bench.post(client, reverse('register'), {'email': random.choice(work.emails), **quotes})
+    bench.get(client, response.url)
+    bench.post(client, reverse('confirm'), {'book': 1, **quotes})
+
+    ref = client.session.get('book_ref')
+    bench.get(client, reverse('bookings'))
+    if ref is None:
+        return  # Sold out
+    bench.get(client, reverse('invoice'), {'ref': ref})
+
+    if random.randint(0, 1):
+        bench.post(client, reverse('bookings'), {'ref': ref})
+
+
+def manage(bench, work, client):
+    if not work.bookings:
+        return
+    ref, customer_id = random.choice(work.bookings)
+    session = client.session
+    session['customer_id'] = customer_id
+    session.save()
+
+    bench.get(client, reverse('bookings'))
+    bench.get(client, reverse('invoice'), {'ref': ref})
+
+
+SCENARIOS = {'search': search, 'calendar': calendar, 'book': book, 'manage': manage}
+
+
+def seed():
+    for f, tbl in (
+        (dbprime.set_aircraft, 'Aircraft'),
+        (dbprime.set_airport, 'Airport'),
+        (dbprime.bulk_set_schedule, 'Schedule'),
+        (dbprime.bulk_set_customer, 'Customer'),
+        (dbprime.bulk_set_booking, 'Booking'),
+    ):
+        print(f'Seeding {tbl}')
+        f()
+
+    reference_data.invalidate()
+    route_graph.invalidate()
+
+
+def run(sessions=SESSIONS, warmup=WARMUP):
+    """
+    Replay `sessions` random scenarios from MIX after `warmup` unrecorded ones and
+    return the samples.
+    """
+    bench = Bench()
+    work = Workload()
+    names, weights = zip(*MIX)
+    scenarios = random.choices(names, weights, k=warmup + sessions)
+
+    for i, name in enumerate(scenarios):
+        bench.recording = i >= warmup
+        SCENARIOS[name](bench, work, Client())
+
+    return bench.samples
+
+
+def missing_phases(samples):
+    """
+    Endpoints of the booking flow with no recorded samples, e.g. when no search found
+    bookable flights.
+    """
+    expected = ['POST flights', 'POST register', 'GET confirm', 'POST confirm', 'GET invoice']
+    return [key for key in expected if not samples.get(key)]
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def regressions(summary, baseline, threshold):
+    """
+    Endpoints whose p95 latency or queries per request exceed the baseline by `threshold`.
+    """
+    found = []
+    for key, cur in summary.items():
+        old = baseline.get('endpoints', {}).get(key)
+        if not old:
+            continue
+        if cur['p95_ms'] > old['p95_ms'] * threshold:
+            found.append(f"{key}: p95 {old['p95_ms']}ms -> {cur['p95_ms']}ms")
+        if cur['queries_per_request'] > old['queries_per_request']:
+            found.append(f"{key}: queries {old['queries_per_request']} -> {cur['queries_per_request']}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the endpoints with the test client')
+    parser.add_argument('--schedule-days', type=int, default=dbprime.SCHEDULE_DAYS, help='Days of schedules to seed')
+    parser.add_argument('--customers', type=int, default=dbprime.SYNTH_CUSTOMERS, help='Customers to seed')
+    parser.add_argument('--bookings', type=int, default=dbprime.SYNTH_BOOKINGS, help='Bookings to seed')
+    parser.add_argument('--sessions', type=int, default=SESSIONS, help='Recorded user sessions to replay')
+    parser.add_argument('--warmup', type=int, default=WARMUP, help='Unrecorded sessions to replay first')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed for the data and the request mix')
+    parser.add_argument('--output', default='-', help='JSON output file (default: stdout)')
+    parser.add_argument('--baseline', default=None, help='Earlier JSON output to compare against')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=1.25,
+        help='p95 latency ratio over the baseline counted as a regression'
+    )
+    args = parser.parse_args()
+
+    if args.schedule_days < 15:
+        parser.error('--schedule-days must be at least 15')
+
+    dbprime.SCHEDULE_DAYS = args.schedule_days
+    dbprime.SYNTH_CUSTOMERS = args.customers
+    dbprime.SYNTH_BOOKINGS = args.bookings
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        with redirect_stdout(sys.stderr):  # Keep stdout for the JSON
+            seed()
+        counts = {model.__name__: model.objects.count() for model in (m.Schedule, m.Customer, m.Booking)}
+        samples = run(args.sessions, args.warmup)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+    result = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.now(gmt).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'seed': args.seed,
+            'sessions': args.sessions,
+            'rows': counts,
+        },
+        'endpoints': summarise(samples),
+    }
+
+    for key in missing_phases(samples):
+        print(f'Warning: no samples for {key}', file=sys.stderr)
+
+    out = json.dumps(result, indent=2)
+    if args.output == '-':
+        print(out)
+    else:
+        with open(args.output, 'w') as fout:
+            fout.write(out + '\n')
+
+    if args.baseline:
+        with open(args.baseline) as fin:
+            found = regressions(result['endpoints'], json.load(fin), args.threshold)
+        for r in found:
+            print(f'Regression: {r}', file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
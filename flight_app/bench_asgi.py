@@ -0,0 +1,219 @@
+"""
+Compare WSGI and ASGI throughput of the calendar endpoints at high concurrency.
+
+The database is seeded as in bench.py, then destinations and flight_dates lookups
+for random routes are served in-process by:
+    wsgi  the WSGI application, called from a pool of --concurrency threads as a
+          threaded WSGI server would
+    asgi  the ASGI application, with --concurrency requests in flight at once on
+          one event loop as a single ASGI worker would
+For each, the requests per second and p50/p95/p99 latency are written as JSON.
+Pass --uncached to clear the cache before every request and so measure the
+database path rather than cache hits.
+
+    python bench_asgi.py --requests 5000 --concurrency 200 --seed 1 --output asgi.json
+"""
+
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from io import BytesIO
+from urllib.parse import urlencode
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+
+from bench import Workload, git_commit, percentile, seed
+
+import django
+from django.core.asgi import get_asgi_application
+from django.core.cache import cache
+from django.core.wsgi import get_wsgi_application
+from django.db import connection, connections
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+import dbprime
+
+
+REQUESTS = 2000
+
+CONCURRENCY = 100
+
+
+def requests(work, n):
+    """
+    `n` (path, query string) pairs, half destinations and half flight_dates.
+    """
+    reqs = []
+    for _ in range(n):
+        origin, destination = work.route()
+        if random.randint(0, 1):
+            reqs.append((reverse('destinations'), urlencode({'o': origin})))
+        else:
+            reqs.append((reverse('flight_dates'), urlencode({'o': origin, 'd': destination})))
+    return reqs
+
+
+def run_wsgi(reqs, concurrency, uncached=False):
+    """
+    Latencies (s) and elapsed time serving `reqs` with `concurrency` threads.
+    """
+    application = get_wsgi_application()
+
+    def request(req):
+        path, query = req
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': path,
+            'QUERY_STRING': query,
+            'SERVER_NAME': 'testserver',
+            'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': BytesIO(),
+            'wsgi.errors': sys.stderr,
+        }
+        if uncached:
+            cache.clear()
+        start = time.perf_counter()
+        response = application(environ, lambda status, headers: None)
+        try:
+            b''.join(response)
+        finally:
+            response.close()  # Returns the thread's DB connection
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        latencies = list(pool.map(request, reqs))
+    elapsed = time.perf_counter() - start
+    connections.close_all()
+    return latencies, elapsed
+
+
+def run_asgi(reqs, concurrency, uncached=False):
+    """
+    Latencies (s) and elapsed time serving `reqs` with up to `concurrency` in
+    flight on one event loop.
+    """
+    application = get_asgi_application()
+
+    async def request(req):
+        path, query = req
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': 'GET',
+            'scheme': 'http',
+            'path': path,
+            'raw_path': path.encode(),
+            'query_string': query.encode(),
+            'root_path': '',
+            'headers': [(b'host', b'testserver')],
+            'server': ('testserver', 80),
+            'client': ('127.0.0.1', 0),
+        }
+        disconnect = asyncio.Event()
+        requested = False
+
+        async def receive():
+            nonlocal requested
+            if not requested:
+                requested = True
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await disconnect.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.body' and not message.get('more_body'):
+                disconnect.set()
+
+        if uncached:
+            await cache.aclear()
+        start = time.perf_counter()
+        await application(scope, receive, send)
+        return time.perf_counter() - start
+
+    async def main():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def limited(req):
+            async with semaphore:
+                return await request(req)
+
+        start = time.perf_counter()
+        latencies = await asyncio.gather(*[limited(r) for r in reqs])
+        return latencies, time.perf_counter() - start
+
+    return asyncio.run(main())
+
+
+def summarise(latencies, elapsed):
+    latency = sorted(t * 1000 for t in latencies)
+    return {
+        'requests': len(latency),
+        'requests_per_second': round(len(latency) / elapsed, 1),
+        'p50_ms': round(percentile(latency, 50), 3),
+        'p95_ms': round(percentile(latency, 95), 3),
+        'p99_ms': round(percentile(latency, 99), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare WSGI and ASGI throughput of the calendar endpoints')
+    parser.add_argument('--schedule-days', type=int, default=dbprime.SCHEDULE_DAYS, help='Days of schedules to seed')
+    parser.add_argument('--bookings', type=int, default=dbprime.SYNTH_BOOKINGS, help='Bookings to seed')
+    parser.add_argument('--requests', type=int, default=REQUESTS, help='Requests per server')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help='Requests in flight at once')
+    parser.add_argument('--uncached', action='store_true', help='Clear the cache before every request')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed for the data and the requests')
+    parser.add_argument('--output', default='-', help='JSON output file (default: stdout)')
+    args = parser.parse_args()
+
+    dbprime.SCHEDULE_DAYS = args.schedule_days
+    dbprime.SYNTH_BOOKINGS = args.bookings
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        with redirect_stdout(sys.stderr):  # Keep stdout for the JSON
+            seed()
+        reqs = requests(Workload(), args.requests)
+        connections.close_all()  # Each server opens its own
+        servers = {}
+        for name, run in (('wsgi', run_wsgi), ('asgi', run_asgi)):
+            run(reqs[:100], args.concurrency, args.uncached)  # Warm up
+            servers[name] = summarise(*run(reqs, args.concurrency, args.uncached))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+    result = {
+        'meta': {
+            'commit': git_commit(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'seed': args.seed,
+            'concurrency': args.concurrency,
+            'uncached': args.uncached,
+        },
+        'servers': servers,
+    }
+
+    out = json.dumps(result, indent=2)
+    if args.output == '-':
+        print(out)
+    else:
+        with open(args.output, 'w') as fout:
+            fout.write(out + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -13,13 +13,21 @@ Synthetic data
     Booking rows consist of a random customer asigned to a random departure Schedule and possibly also return
     Schedule. The reference and prices are dynamically allocated (prices are based on the number of seats
     remaining and days until departure).
+Bulk mode
+    Run with --bulk to insert Schedule, Customer and Booking rows in batches of --batch-size with bulk_create.
+    Bookings are sampled from schedules and customers preloaded into memory and seat counts are decremented
+    in aggregate afterwards, so large staging databases (e.g. --bookings 10000000) can be built. Customers
+    beyond the rows in randomnames.csv reuse names with numbered emails. Pass --seed for reproducible data.
 """
 
 import os
 import csv
+import bisect
 import random
 import argparse
 import urllib.parse
+from datetime import datetime, timezone
+gmt = timezone.utc
 from tqdm import tqdm
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'flight_app.settings')
@@ -27,9 +35,13 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'flight_app.settings')
 import django
 django.setup()
 
+from django.db.models import F
+
 import app.models as m
 import app.utils as utils
-from app.views_utils import book_flight
+from app.registry import route_graph
+from app.connections import connection_graph
+from app.views_utils import SoldOut, BookingRefAllocator, book_flight, rebuild_availability
 
 
 SCHEDULE_DAYS = 100  # from today
@@ -38,6 +50,8 @@ SYNTH_CUSTOMERS = 400
 
 SYNTH_BOOKINGS = 500
 
+BATCH_SIZE = 10000  # bulk mode
+
 # Name, Brand, Max seats
 AIRCRAFT = [
     ('SJ30i', 'SyberJet', 6),
@@ -84,7 +98,10 @@ def set_airport():
         a.save()
 
 
-def set_schedule():
+def generate_schedules():
+    """
+    Yield unsaved Schedule rows for SCHEDULE_DAYS from today.
+    """
     sched_list = [
         dict(zip(['dep_icao', 'arr_icao', 'dep_time', 'duration', 'aircraft', 'days', 'price'], i))
         for i in WEEKLY_FLIGHT_SCHEDULE
@@ -105,7 +122,7 @@ def set_schedule():
                 duration=f['duration'],
                 dep_gmt_offset=gmt_offsets[f['dep_icao']]
             )
-            s = m.Schedule(
+            yield m.Schedule(
                 flight_no=f['flight_no'],
                 dep_dt=dep_dt,
                 arr_dt=arr_dt,
@@ -114,8 +131,25 @@ def set_schedule():
                 dep_icao_id=f['dep_icao'],
                 arr_icao_id=f['arr_icao'],
                 base_price=f['price'],
+                dep_local_date=date,  # Schedule.save() isn't called by bulk_create
             )
-            s.save()
+
+
+def set_schedule():
+    for s in generate_schedules():
+        s.save()
+
+    rebuild_availability()
+
+
+def bulk_set_schedule():
+    for batch in utils.batched(generate_schedules(), BATCH_SIZE):
+        m.Schedule.objects.bulk_create(batch)
+
+    # bulk_create doesn't send the signals that maintain these
+    route_graph.invalidate()
+    connection_graph.invalidate()
+    rebuild_availability()
 
 
 def set_customer():
@@ -147,7 +181,7 @@ def set_booking():
             depart_price = depart_schedule.current_price
 
             # Biased to more seats but simulates n_travellers in search menu
-            tickets = min(random.randint(1, 6), depart_schedule.aircraft.max_seats)
+            tickets = min(random.randint(1, 6), depart_schedule.seats_avail)
 
             # Assign random return trips to half
             if random.randint(0, 1):
@@ -177,8 +211,145 @@ def set_booking():
     if skip_count > 0:
         print(f'Skipping {skip_count} inconsistent bookings')
 
+    sold_out = 0
     for booking in tqdm(bookings, desc='Saving bookings'):
-        book_flight(**booking)
+        try:
+            book_flight(**booking)
+        except SoldOut:
+            sold_out += 1
+
+    if sold_out > 0:
+        print(f'Skipping {sold_out} sold out bookings')
+
+
+def generate_customers(n):
+    """
+    Yield n unsaved Customer rows from randomnames.csv in random order, numbering
+    the emails of repeated rows once the file is exhausted.
+    """
+    with open('randomnames.csv', newline='') as fin:
+        rows = [row[1:] for row in list(csv.reader(fin))[1:]]  # Remove header and ID
+    random.shuffle(rows)
+
+    for i in range(n):
+        title, fname, lname, sex, email = rows[i % len(rows)]
+        if repeat := i // len(rows):
+            user, domain = email.split('@')
+            email = f'{user}{repeat}@{domain}'
+        yield m.Customer(title=title, fname=fname, lname=lname, sex=sex, email=email)
+
+
+def bulk_set_customer():
+    customers = tqdm(generate_customers(SYNTH_CUSTOMERS), total=SYNTH_CUSTOMERS)
+    for batch in utils.batched(customers, BATCH_SIZE):
+        m.Customer.objects.bulk_create(batch, ignore_conflicts=True)  # UNIQUE email
+
+
+def bulk_set_booking():
+    """
+    Populate Booking by sampling customer and schedule ids held in memory, tracking seats
+    locally and applying the decrements to Schedule once all bookings are inserted.
+    """
+    now = datetime.now(gmt)
+    customer_ids = list(m.Customer.objects.values_list('id', flat=True))
+    schedules = list(
+        m.Schedule.objects
+        .order_by('dep_dt')
+        .values_list('id', 'dep_icao', 'arr_icao', 'dep_dt', 'arr_dt', 'seats_avail', 'aircraft__max_seats', 'base_price')
+    )
+    if not customer_ids or not schedules:
+        raise ValueError('Customer and Schedule must be populated before Booking')
+    ids, dep_icaos, arr_icaos, dep_dts, arr_dts, seats, max_seats, base_prices = map(list, zip(*schedules))
+
+    # Route -> departure times and schedule indices in departure order, for return flights
+    routes = {}
+    for i in range(len(ids)):
+        times, indices = routes.setdefault((dep_icaos[i], arr_icaos[i]), ([], []))
+        times.append(dep_dts[i])
+        indices.append(i)
+
+    available = list(range(len(ids)))
+    taken = [0] * len(ids)
+    skip_count = 0
+
+    def random_depart():
+        # Drop full schedules as they're found
+        while available:
+            pos = random.randrange(len(available))
+            i = available[pos]
+            if seats[i] >= 1:
+                return i
+            available[pos] = available[-1]
+            available.pop()
+        return None
+
+    def random_return(i, tickets, attempts=10):
+        times, indices = routes.get((arr_icaos[i], dep_icaos[i]), ([], []))
+        first = bisect.bisect_right(times, arr_dts[i])
+        if first == len(indices):
+            return None
+        for _ in range(attempts):
+            j = indices[random.randrange(first, len(indices))]
+            if seats[j] >= tickets:
+                return j
+        return None
+
+    def price(i):
+        return utils.dynamic_price(base_prices[i], dep_dts[i], seats[i], max_seats[i], now)
+
+    def generate_bookings():
+        nonlocal skip_count
+        refs = BookingRefAllocator(block_size=BATCH_SIZE)
+
+        for _ in range(SYNTH_BOOKINGS):
+            i = random_depart()
+            if i is None:
+                skip_count += 1
+                continue
+
+            # Biased to more seats but simulates n_travellers in search menu
+            tickets = min(random.randint(1, 6), seats[i])
+
+            # Assign random return trips to half
+            j = None
+            if random.randint(0, 1):
+                j = random_return(i, tickets)
+                if j is None:
+                    skip_count += 1
+                    continue
+
+            booking = m.Booking(
+                ref=refs.next_ref(),
+                tickets=tickets,
+                customer_id=random.choice(customer_ids),
+                depart_schedule_id=ids[i],
+                return_schedule_id=ids[j] if j is not None else None,
+                depart_price=price(i),
+                return_price=price(j) if j is not None else None
+            )
+            for k in (i, j):
+                if k is not None:
+                    seats[k] -= tickets
+                    taken[k] += tickets
+            yield booking
+
+    bookings = tqdm(generate_bookings(), total=SYNTH_BOOKINGS, desc='Saving bookings')
+    for batch in utils.batched(bookings, BATCH_SIZE):
+        m.Booking.objects.bulk_create(batch)
+
+    if skip_count > 0:
+        print(f'Skipping {skip_count} inconsistent bookings')
+
+    # One UPDATE per distinct decrement and chunk of ids
+    by_tickets = {}
+    for i, n in enumerate(taken):
+        if n:
+            by_tickets.setdefault(n, []).append(ids[i])
+    for n, schedule_ids in tqdm(by_tickets.items(), desc='Updating seats'):
+        for chunk in utils.batched(schedule_ids, 500):
+            m.Schedule.objects.filter(id__in=chunk).update(seats_avail=F('seats_avail') - n)
+
+    rebuild_availability()
 
 
 def main():
@@ -193,6 +364,17 @@ def main():
             (set_booking, 'Booking'),
         ),
     }
+    bulk_tables = {
+        'basic': (
+            (set_aircraft, 'Aircraft'),
+            (set_airport, 'Airport'),
+            (bulk_set_schedule, 'Schedule'),
+        ),
+        'synth': (
+            (bulk_set_customer, 'Customer'),
+            (bulk_set_booking, 'Booking'),
+        ),
+    }
 
     parser = argparse.ArgumentParser(description='Populate the database')
     parser.add_argument(
@@ -206,7 +388,7 @@ def main():
         help=f"Exclude synthetic data ({', '.join([i[1] for i in tables['synth']])})"
     )
 
-    global SCHEDULE_DAYS, SYNTH_CUSTOMERS, SYNTH_BOOKINGS
+    global SCHEDULE_DAYS, SYNTH_CUSTOMERS, SYNTH_BOOKINGS, BATCH_SIZE
 
     parser.add_argument(
         '--schedule-days',
@@ -227,11 +409,36 @@ def main():
         help='Number of synthetic rows to insert into Bookings'
     )
 
+    parser.add_argument(
+        '--bulk',
+        action='store_true', default=False,
+        help='Insert Schedule, Customer and Booking rows in batches'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=BATCH_SIZE,
+        help='Rows per batch in bulk mode'
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=None,
+        help='Random seed for reproducible synthetic data'
+    )
+
     args = parser.parse_args()
     
     SCHEDULE_DAYS = args.schedule_days
     SYNTH_CUSTOMERS = args.customers
     SYNTH_BOOKINGS = args.bookings
+    BATCH_SIZE = args.batch_size
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    if args.bulk:
+        tables = bulk_tables
 
     for k, v in tables.items():
         if not getattr(args, f'no_{k}'):
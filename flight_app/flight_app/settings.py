@@ -45,6 +45,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'app.middleware.MetricsMiddleware',
+    'app.middleware.PerfMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -52,13 +54,45 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'app.middleware.ProfilerMiddleware',
 ]
 
 ROOT_URLCONF = 'flight_app.urls'
 
+# Server-Timing headers and per-request logs from app.middleware.PerfMiddleware
+PERF_INSTRUMENTATION = os.getenv('PERF_INSTRUMENTATION', '0') == '1'
+
+# Per-process values from app.metrics are written here and summed by /metrics;
+# unset for single-process servers
+METRICS_DIR = os.getenv('METRICS_DIR')
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+SESSION_ENGINE = 'app.sessions'
+
+# cProfile reports from app.middleware.ProfilerMiddleware for a sampled fraction of
+# requests or those with an X-Profile header from app.middleware.profile_token()
+PROFILING = os.getenv('PROFILING', '0') == '1'
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', BASE_DIR / 'profiles')
+PROFILE_KEEP = 50
+PROFILE_TOKEN_MAX_AGE = 3600
+# SQL parameters (customer details) in the reports; for local debugging only
+PROFILE_SQL_PARAMS = os.getenv('PROFILE_SQL_PARAMS', '0') == '1'
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'app.perf': {'handlers': ['console'], 'level': 'INFO', 'propagate': False},
+    },
+}
+
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'app.middleware.PerfTemplates',  # Times renders for PerfMiddleware
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -82,10 +116,67 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # Take the write lock at BEGIN so concurrent bookings queue on the
+            # busy timeout instead of failing to upgrade a read lock
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
+        # File-backed so that tests can exercise concurrent connections
+        'TEST': {
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
     }
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+
+# 'default' is shared by every worker: registry and route version stamps,
+# single-flight locks and booking counts must be seen by all of them. Redis if
+# REDIS_URL is set (needs the redis package), else a table in the database
+# (created by `manage.py createcachetable`).
+# 'data' holds results keyed by those versions (flights by day, flight dates,
+# fare calendars), so each worker may keep its own: in memory, or in Redis when
+# there is one. 'fragments' holds template fragments, keyed by the same versions,
+# in memory.
+if os.getenv('REDIS_URL'):
+    redis = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('REDIS_URL'),
+    }
+    CACHES = {
+        'default': redis,
+        'data': redis,
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'cache',
+            'OPTIONS': {
+                'MAX_ENTRIES': 10000,
+            },
+        },
+        'data': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'data',
+            'OPTIONS': {
+                'MAX_ENTRIES': 10000,
+            },
+        },
+    }
+
+CACHES['fragments'] = {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'fragments',
+    'OPTIONS': {
+        'MAX_ENTRIES': 10000,
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 